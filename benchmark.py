@@ -0,0 +1,711 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks for Patrick Mooney's Markov chain-based text generator. These
+are not tests; they're a quick way to see whether a change to text_generator.py
+makes things faster or slower. Run, for instance,
+
+    ./benchmark.py sampling
+
+in a terminal. Available benchmarks are:
+
+  sampling  Token-generation speed with and without the sampling index.
+  memory    Memory used by the plain, compact, and trie chain storage.
+  loading   Time needed to load pickled and binary chains files.
+  compression
+            Size of chains files compressed with gzip, bz2, and lzma, and the time
+            needed to save and load them.
+  batch     Sentence generation one at a time vs. with gen_sentences().
+  automaton Sentence generation with next() vs. with the compiled automaton.
+  characters
+            Character-token generation with the general-purpose sampling index vs.
+            with chain_storage.CharacterMapping.
+  pool      Latency of one-sentence requests with and without a SentencePool.
+  parallel  Seeded generation in one process vs. with a pool of worker processes.
+  substitutions
+            Post-processing with text_handling.multi_replace() vs. the compiled
+            SubstitutionEngine.
+  verbosity Regression check: log messages must never be formatted, and generation
+            must cost the same at any verbosity level, when log output is
+            suppressed.
+  startup   Regression check: importing gen_text.py must take less than --budget
+            milliseconds, and must not import modules that aren't always needed.
+  suite     The full benchmark suite: training time and peak memory, saving and
+            loading (including with chain-interpreter.py), and generation speed,
+            for several corpus sizes, Markov lengths 1 to 5, and both word and
+            character tokens. Writes JSON (to --output, or to stdout) that can be
+            kept and compared with the results of later runs:
+  compare   ... like this: ./benchmark.py compare OLD.json NEW.json
+
+Running the suite both before and after compiling the module with setup_tg.py
+shows what Cython buys you; the JSON records which was being measured.
+
+Everything here runs on a synthetic corpus whose word frequencies follow Zipf's
+law, so that (as in real text) a few very common words have very many possible
+followers.
+
+This script is licensed under the GNU GPL, either version 3, or (at your option)
+any later version. See the files README.md and LICENSE.md for more details.
+"""
+
+
+import argparse
+import datetime
+import importlib.util
+import json
+import logging
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+from array import array
+
+import chain_storage
+import text_generator as tg
+
+
+def zipf_cumulative_weights(n: int):
+    """Yield the running totals of the weights 1/1, 1/2, 1/3, ... 1/N."""
+    total = 0.0
+    for rank in range(1, n + 1):
+        total += 1 / rank
+        yield total
+
+
+def synthetic_corpus(num_words: int=300000,
+                     vocabulary_size: int=20000,
+                     seed: int=1) -> str:
+    """Produce a string of NUM_WORDS random "words" drawn from a vocabulary of
+    VOCABULARY_SIZE words with Zipfian frequencies, broken up into sentences of
+    random lengths. The same SEED always produces the same text.
+    """
+    rng = random.Random(seed)
+    vocabulary = ['the'] + ['w%d' % i for i in range(1, vocabulary_size)]
+    weights = list(zipf_cumulative_weights(vocabulary_size))
+    ret, sentence = [], []
+    for word in rng.choices(vocabulary, cum_weights=weights, k=num_words):
+        sentence.append(word)
+        if len(sentence) >= rng.randint(4, 30):
+            ret.append(' '.join(sentence).capitalize() + rng.choice('...!?'))
+            sentence = []
+    return ' '.join(ret)
+
+
+def trained_generator(markov_length: int=1,
+                      **kwargs) -> tg.TextGenerator:
+    """Return a TextGenerator trained on a synthetic corpus. KWARGS are passed to
+    synthetic_corpus().
+    """
+    genny = tg.TextGenerator()
+    genny._train_from_text(synthetic_corpus(**kwargs), markov_length=markov_length)
+    genny._finalize_mapping()
+    return genny
+
+
+def time_next(genny: tg.TextGenerator,
+              histories: list) -> float:
+    """Call GENNY.next() once for each history in HISTORIES; return tokens per second."""
+    the_mapping = genny.chains.mapping
+    start = time.perf_counter()
+    for h in histories:
+        genny.next(h, the_mapping)
+    return len(histories) / (time.perf_counter() - start)
+
+
+def bench_sampling(args):
+    """Compare TextGenerator.next() with and without the precomputed sampling index."""
+    genny = trained_generator(markov_length=args.markov_length, num_words=args.words)
+    rng = random.Random(2)
+    starts = [h for h in genny.chains.mapping if len(h) == 1]
+    histories = [list(rng.choice(starts)) for _ in range(args.tokens)]
+    histories[::10] = [['the']] * len(histories[::10])     # Make sure the most common history is well represented.
+    print("Largest fan-out: %d followers" % max(len(f) for f in genny.chains.mapping.values()))
+
+    index = genny.chains.sampling_index
+    genny.chains.sampling_index = None
+    before = time_next(genny, histories)
+    genny.chains.sampling_index = index
+    after = time_next(genny, histories)
+    print("Linear scan:     %12.1f tokens/second" % before)
+    print("Sampling index:  %12.1f tokens/second" % after)
+    print("Speedup:         %12.2fx" % (after / before))
+
+
+def deep_sizeof(what) -> int:
+    """Estimate the total memory used by WHAT and everything it refers to, counting
+    each distinct object only once. Understands the containers that the chains are
+    built from; anything else is counted by its own size (and its __dict__, if any).
+    """
+    seen, total, pending = set(), 0, [what]
+    while pending:
+        o = pending.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            pending.extend(o.keys())
+            pending.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            pending.extend(o)
+        elif not isinstance(o, (str, bytes, int, float, array)) and hasattr(o, '__dict__'):
+            pending.append(o.__dict__)
+    return total
+
+
+def bench_memory(args):
+    """Compare the memory used by the dictionary-of-dictionaries mapping with the
+    memory used by a chain_storage.CompactMapping and a chain_storage.TrieMapping
+    holding the same chains.
+    """
+    genny = trained_generator(markov_length=args.markov_length, num_words=args.words)
+    mapping, starts = genny.chains.mapping, genny.chains.starts
+    mapping_size = deep_sizeof(genny.chains.mapping)
+    index_size = deep_sizeof((genny.chains.mapping, genny.chains.sampling_index)) - mapping_size
+    print("Histories:                         %12d" % len(genny.chains.mapping))
+    print("Dictionary mapping:                %12d bytes" % mapping_size)
+    print("  ... plus its sampling index:     %12d bytes" % (mapping_size + index_size))
+    for storage in ('compact', 'trie'):
+        genny.chains.mapping = mapping
+        compact_start = time.perf_counter()
+        genny.chains.compact(storage)
+        compact_time = time.perf_counter() - compact_start
+        compact_size = deep_sizeof(genny.chains.mapping)
+        print("%-35s%12d bytes" % ("%s mapping (its own index):" % storage.capitalize(), compact_size))
+        print("  Savings:                         %12.1f%%" % (100 * (1 - compact_size / (mapping_size + index_size))))
+        print("  Time to build:                   %12.2f seconds" % compact_time)
+        print("  Generation speed:                %12.1f tokens/second" % time_next(genny, [['the']] * args.tokens))
+        print("  ... when backing off:            %12.1f tokens/second" %
+              time_next(genny, [[random.choice(starts) for _ in range(args.markov_length)] for _ in range(args.tokens)]))
+
+
+def bench_loading(args):
+    """Compare the time needed to load chains from a legacy pickle file and from a
+    binary chains file, and the time needed to generate the first few sentences
+    afterwards.
+    """
+    genny = trained_generator(markov_length=args.markov_length, num_words=args.words)
+    with tempfile.TemporaryDirectory() as tempdir:
+        for label, filename in (("Pickle", 'chains.pkl'), ("Binary", 'chains.chains')):
+            path = os.path.join(tempdir, filename)
+            genny.chains.store_chains(path)
+            start = time.perf_counter()
+            loaded = tg.TextGenerator()
+            loaded.chains.read_chains(path)
+            load_time = time.perf_counter() - start
+            loaded.gen_text(sentences_desired=10)
+            print("%s: %10d bytes; loaded in %8.4f seconds; first ten sentences after %8.4f seconds" %
+                  (label, os.path.getsize(path), load_time, time.perf_counter() - start))
+
+
+def bench_compression(args):
+    """Compare the size of binary and pickled chains files compressed with each of the
+    formats that store_chains() supports, and the time needed to save and load them,
+    so that I/O-bound hosts can choose smaller files and CPU-bound hosts faster ones.
+    """
+    genny = trained_generator(markov_length=args.markov_length, num_words=args.words)
+    with tempfile.TemporaryDirectory() as tempdir:
+        for file_format, filename in (('binary', 'chains.chains'), ('pickle', 'chains.pkl')):
+            uncompressed = None
+            for compression in ('none',) + chain_storage.COMPRESSION_FORMATS:
+                path = os.path.join(tempdir, filename)
+                start = time.perf_counter()
+                genny.chains.store_chains(path, file_format=file_format, compression=compression)
+                save_time = time.perf_counter() - start
+                start = time.perf_counter()
+                loaded = tg.TextGenerator()
+                loaded.chains.read_chains(path)
+                load_time = time.perf_counter() - start
+                size = os.path.getsize(path)
+                uncompressed = uncompressed or size
+                print("%-6s %-5s %10d bytes (%5.1f%%); saved in %8.4f seconds; loaded in %8.4f seconds" %
+                      (file_format, compression, size, 100 * size / uncompressed, save_time, load_time))
+
+
+def bench_batch(args):
+    """Compare generating sentences one at a time with _gen_sentence() against
+    generating them in a batch with gen_sentences().
+    """
+    genny = trained_generator(markov_length=args.markov_length, num_words=args.words)
+    sentences = max(args.tokens // 20, 1)
+    start = time.perf_counter()
+    one_at_a_time = [genny._gen_sentence() for _ in range(sentences)]
+    before = time.perf_counter() - start
+    start = time.perf_counter()
+    batched = list(genny.gen_sentences(sentences, seed=1))
+    after = time.perf_counter() - start
+    print("One at a time:  %12.1f sentences/second (%12.1f tokens/second)" %
+          (sentences / before, sum(len(s.split()) for s in one_at_a_time) / before))
+    print("Batched:        %12.1f sentences/second (%12.1f tokens/second)" %
+          (sentences / after, sum(len(s.split()) for s in batched) / after))
+
+
+def bench_automaton(args):
+    """Compare generating sentences with _gen_sentence() before and after compiling the
+    chains into a ChainAutomaton with compile(), using the same random numbers.
+    """
+    genny = trained_generator(markov_length=args.markov_length, num_words=args.words)
+    sentences = max(args.tokens // 20, 1)
+    random.seed(1)
+    start = time.perf_counter()
+    uncompiled = [genny._gen_sentence() for _ in range(sentences)]
+    before = time.perf_counter() - start
+    start = time.perf_counter()
+    genny.compile()
+    compiling = time.perf_counter() - start
+    random.seed(1)
+    start = time.perf_counter()
+    compiled = [genny._gen_sentence() for _ in range(sentences)]
+    after = time.perf_counter() - start
+    assert compiled == uncompiled, "ERROR: the compiled automaton generated different sentences!"
+    tokens = sum(len(s.split()) for s in compiled)
+    print("Compiled %d states in %.2f seconds" % (len(genny.chains.automaton), compiling))
+    print("With next():    %12.1f tokens/second" % (tokens / before))
+    print("Compiled:       %12.1f tokens/second" % (tokens / after))
+    print("Speedup:        %12.2fx" % (before / after))
+
+
+def bench_characters(args):
+    """Compare generating sentences from character chains with an ordinary
+    SamplingIndex and with the CharacterMapping that's used for them by default.
+    """
+    genny = tg.TextGenerator()
+    # Character models only begin sentences with capital letters that directly follow sentence-ending punctuation.
+    genny._train_from_text(re.sub(r'([.!?]) ', r'\1', synthetic_corpus(num_words=args.words)),
+                           markov_length=args.markov_length, character_tokens=True)
+    genny._finalize_mapping()
+    sentences = max(args.tokens // 100, 1)
+    chars = list()
+    for index in (tg.chain_storage.SamplingIndex(genny.chains.mapping), genny.chains.sampling_index):
+        genny.chains.sampling_index = index
+        random.seed(1)
+        start = time.perf_counter()
+        chars.append(sum(len(genny._gen_sentence()) for _ in range(sentences)) / (time.perf_counter() - start))
+        print("%-18s %12d bytes  %12.1f characters/second" % (type(index).__name__ + ':', deep_sizeof(index), chars[-1]))
+    print("Speedup:           %12.2fx" % (chars[1] / chars[0]))
+
+
+def bench_pool(args):
+    """Compare the latency of one-sentence requests with and without a SentencePool,
+    pausing briefly between requests (as a server usually does) so that the pool's
+    worker has time to refill it.
+    """
+    genny = trained_generator(markov_length=args.markov_length, num_words=args.words)
+    requests = max(args.tokens // 25, 100)
+
+    def latencies() -> typing.List[float]:
+        ret = list()
+        for _ in range(requests):
+            start = time.perf_counter()
+            genny.gen_text(sentences_desired=1)
+            ret.append(time.perf_counter() - start)
+            time.sleep(0.002)
+        return sorted(ret)
+
+    for label in ('Without a pool:', 'With a pool:'):
+        if label == 'With a pool:':
+            genny.enable_pool(size=64)
+            time.sleep(0.5)                 # Let it fill up.
+        times = latencies()
+        print("%-16s p50 %8.3f ms   p99 %8.3f ms   max %8.3f ms" % (label, 1000 * times[len(times) // 2],
+                                                                       1000 * times[int(len(times) * 0.99)], 1000 * times[-1]))
+    print("Pool hits: %d, misses: %d" % (genny.pool.hits, genny.pool.misses))
+    genny.disable_pool()
+
+
+def bench_parallel(args):
+    """Compare generating seeded text with gen_text() in a single process and with a
+    pool of worker processes, and check that both produce exactly the same text.
+    """
+    genny = trained_generator(markov_length=args.markov_length, num_words=args.words)
+    sentences = max(args.tokens // 20, 1)
+    texts = dict()
+    for workers in sorted({1, 2, os.cpu_count() or 1}):
+        start = time.perf_counter()
+        texts[workers] = genny.gen_text(sentences_desired=sentences, seed=1, workers=workers)
+        print("%2d worker(s): %10.1f sentences/second" % (workers, sentences / (time.perf_counter() - start)))
+    print("Identical text: %s" % (len(set(texts.values())) == 1))
+
+
+def bench_substitutions(args):
+    """Compare making the final substitutions on generated paragraphs with
+    text_handling.multi_replace() and with the compiled SubstitutionEngine.
+    """
+    import text_handling
+
+    genny = trained_generator(markov_length=args.markov_length, num_words=args.words)
+    paragraphs = [' '.join(genny._gen_sentence() for _ in range(4)) for _ in range(max(args.tokens // 80, 1))]
+    engine = genny._substitution_engine()
+    start = time.perf_counter()
+    for p in paragraphs:
+        text_handling.multi_replace(p, genny.final_substitutions)
+    before = time.perf_counter() - start
+    start = time.perf_counter()
+    for p in paragraphs:
+        engine.apply(p)
+    after = time.perf_counter() - start
+    print("%d substitutions, compiled into %d steps" % (len(genny.final_substitutions), len(engine.steps)))
+    print("multi_replace():     %12.1f paragraphs/second" % (len(paragraphs) / before))
+    print("SubstitutionEngine:  %12.1f paragraphs/second" % (len(paragraphs) / after))
+    print("Speedup:             %12.2fx" % (before / after))
+
+
+class _CountingArgument(object):
+    """Stands in for an argument passed to log_it(), and counts how many times it's
+    turned into a string.
+    """
+    formatted = 0
+
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+
+    def __str__(self) -> str:
+        _CountingArgument.formatted += 1
+        return str(self.wrapped)
+
+    def __repr__(self) -> str:
+        _CountingArgument.formatted += 1
+        return repr(self.wrapped)
+
+    def __format__(self, spec: str) -> str:
+        _CountingArgument.formatted += 1
+        return format(self.wrapped, spec)
+
+
+def bench_verbosity(args):
+    """Regression check: make sure that the cost of generating text does not depend on
+    the verbosity level when log output is suppressed, i.e. that debugging messages
+    are never formatted unless they're actually emitted.
+
+    The check itself is deterministic: text is generated at verbosity level 5 with
+    the text_generator logger silenced, while every argument passed to log_it() is
+    wrapped in an object that counts how often it's formatted, and every log record
+    that's turned into a message is counted, too; if either count isn't zero, this
+    exits with status 1. (Cythonized modules call their own log_it() directly, so
+    only the timings mean anything for them.) Then generation is timed at verbosity
+    levels 0 and 5, alternately, --repeat times each, and this also exits with
+    status 1 if the median of the second is more than --tolerance times the median
+    of the first.
+    """
+    genny = trained_generator(markov_length=args.markov_length, num_words=args.words)
+    sentences = max(args.tokens // 20, 1)
+    old_verbosity, old_level = tg.verbosity_level, tg.logger.level
+    original_log_it, original_get_message = tg.log_it, logging.LogRecord.getMessage
+    calls, messages = 0, 0
+
+    def counting_log_it(what: str, log_level: int=1, *log_args):
+        nonlocal calls
+        calls += 1
+        return original_log_it(what, log_level, *(_CountingArgument(a) for a in log_args))
+
+    def counting_get_message(record: logging.LogRecord) -> str:
+        nonlocal messages
+        messages += 1
+        return original_get_message(record)
+
+    def timed_run(verbosity: int) -> float:
+        tg.verbosity_level = verbosity
+        random.seed(1)
+        start = time.perf_counter()
+        genny.gen_text(sentences_desired=sentences)
+        return time.perf_counter() - start
+
+    try:
+        tg.logger.setLevel(logging.CRITICAL + 1)
+        tg.log_it, logging.LogRecord.getMessage = counting_log_it, counting_get_message
+        _CountingArgument.formatted = 0
+        try:
+            timed_run(5)
+        finally:
+            tg.log_it, logging.LogRecord.getMessage = original_log_it, original_get_message
+        quiet, verbose = list(), list()
+        for _ in range(args.repeat):
+            quiet.append(timed_run(0))
+            verbose.append(timed_run(5))
+    finally:
+        tg.verbosity_level = old_verbosity
+        tg.logger.setLevel(old_level)
+    quiet, verbose = statistics.median(quiet), statistics.median(verbose)
+    print("log_it() calls at verbosity 5:  %8d" % calls)
+    print("Arguments formatted:            %8d" % _CountingArgument.formatted)
+    print("Log records formatted:          %8d" % messages)
+    print("Verbosity 0:                    %8.4f seconds (median of %d) for %d sentences" % (quiet, args.repeat, sentences))
+    print("Verbosity 5, output suppressed: %8.4f seconds (median of %d) for %d sentences" % (verbose, args.repeat, sentences))
+    print("Ratio:                          %8.2f (tolerance: %.2f)" % (verbose / quiet, args.tolerance))
+    if _CountingArgument.formatted or messages:
+        print("FAILED: suppressed log messages are being formatted!")
+        sys.exit(1)
+    if verbose / quiet > args.tolerance:
+        print("FAILED: suppressed log messages are making generation slower!")
+        sys.exit(1)
+
+
+# Modules that importing gen_text.py (and so text_generator.py) must not import, because they're slow to import and
+# only needed for some things; see the docstring of text_generator.py.
+_deferred_imports = ('argparse', 'asyncio', 'pathlib', 'pickle', 'pprint', 'tempfile', 'text_handling', 'token_cache', 'typing')
+
+
+def import_times(module: str) -> typing.Dict[str, int]:
+    """Import MODULE in a fresh interpreter run with -X importtime, and return the
+    cumulative time (in microseconds) taken to import each module that was imported.
+    """
+    child = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                           cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.PIPE, check=True,
+                           universal_newlines=True)
+    ret = dict()
+    for line in child.stderr.splitlines():
+        match = re.match(r'import time:\s*(\d+)\s*\|\s*(\d+)\s*\|\s*(\S+)', line)
+        if match:
+            ret[match.group(3)] = int(match.group(2))
+    return ret
+
+
+def bench_startup(args):
+    """Regression check: import gen_text.py in a fresh interpreter a few times, and
+    exit with status 1 if the fastest import takes more than --budget milliseconds,
+    or if it imports any of the modules that are supposed to be imported only when
+    they're needed.
+    """
+    runs = [import_times('gen_text') for _ in range(5)]
+    best = min(runs, key=lambda r: r['gen_text'])
+    slowest = sorted((t, m) for m, t in best.items() if '.' not in m and m != 'gen_text')[-8:]
+    print("Importing gen_text: %8.1f ms (budget: %.1f ms)" % (best['gen_text'] / 1000, args.budget))
+    print("Slowest imports (including the modules they import):")
+    for t, m in reversed(slowest):
+        print("  %-20s %8.1f ms" % (m, t / 1000))
+    failed = False
+    imported = [m for m in _deferred_imports if m in best]
+    if imported:
+        print("FAILED: gen_text imports %s at startup!" % ', '.join(imported))
+        failed = True
+    if best['gen_text'] / 1000 > args.budget:
+        print("FAILED: importing gen_text takes longer than the budget!")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+def peak_rss() -> typing.Optional[int]:
+    """Return the peak resident set size of this process so far, in bytes, or None if
+    the platform can't tell us.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024        # Everyone else reports kilobytes.
+
+
+def load_chain_interpreter():
+    """Import chain-interpreter.py, whose name isn't a legal module name."""
+    spec = importlib.util.spec_from_file_location('chain_interpreter', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                                    'chain-interpreter.py'))
+    ret = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(ret)
+    return ret
+
+
+def count_tokens(genny: tg.TextGenerator,
+                 text: str) -> int:
+    return len(genny._token_list(text, character_tokens=genny.chains.character_tokens))
+
+
+def run_one(spec: dict) -> dict:
+    """Run the benchmarks for a single configuration, described by SPEC, and return
+    the results. This is run in a fresh process for each configuration (see
+    bench_suite()) so that the peak memory use it reports belongs to that
+    configuration alone.
+    """
+    ret = {'corpus': spec['corpus'], 'corpus_bytes': os.path.getsize(spec['path']),
+           'markov_length': spec['markov_length'], 'tokens': 'characters' if spec['character_tokens'] else 'words'}
+    baseline = peak_rss()
+    start = time.perf_counter()
+    genny = tg.TextGenerator()
+    genny.train(spec['path'], markov_length=spec['markov_length'], character_tokens=spec['character_tokens'])
+    ret['train_seconds'] = time.perf_counter() - start
+    ret['peak_rss_bytes'] = peak_rss()
+    ret['baseline_rss_bytes'] = baseline
+    ret['histories'] = len(genny.chains.mapping)
+
+    can_generate = genny.is_trained()      # Not if, say, no sentence starts survive the filtering of character tokens.
+    if can_generate:
+        sentences = spec['sentences']
+        random.seed(1)
+        start = time.perf_counter()
+        text = genny.gen_text(sentences_desired=sentences)
+        elapsed = time.perf_counter() - start
+        ret['generation'] = {'sentences_per_second': sentences / elapsed, 'tokens_per_second': count_tokens(genny, text) / elapsed}
+    else:
+        ret['generation'] = None
+
+    ret['formats'] = dict()
+    with tempfile.TemporaryDirectory() as tempdir:
+        for file_format, filename in (('binary', 'chains.chains'), ('pickle', 'chains.pkl')):
+            path, result = os.path.join(tempdir, filename), dict()
+            start = time.perf_counter()
+            genny.chains.store_chains(path)
+            result['store_seconds'] = time.perf_counter() - start
+            result['bytes'] = os.path.getsize(path)
+            start = time.perf_counter()
+            loaded = tg.TextGenerator()
+            loaded.chains.read_chains(path)
+            result['read_seconds'] = time.perf_counter() - start
+            if can_generate:
+                loaded.gen_text(sentences_desired=10)
+                result['first_ten_sentences_seconds'] = time.perf_counter() - start
+            if not spec['character_tokens']:            # chain-interpreter.py only understands word tokens.
+                interpreter = load_chain_interpreter()
+                start = time.perf_counter()
+                interpreted = interpreter.TextGenerator(chainsfile=path)
+                result['interpreter_load_seconds'] = time.perf_counter() - start
+                list(interpreted._produce_text(sentences_desired=10))
+                result['interpreter_first_ten_sentences_seconds'] = time.perf_counter() - start
+            ret['formats'][file_format] = result
+    return ret
+
+
+def environment() -> dict:
+    """Describe what's being benchmarked, so that results can be compared sensibly."""
+    return {'text_generator_version': tg.__version__.strip('$').strip(),
+            'cythonized': tg._is_cythonized(),
+            'python': '%s %s' % (platform.python_implementation(), platform.python_version()),
+            'platform': platform.platform(),
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')}
+
+
+def bench_suite(args):
+    """Run the full benchmark suite, one configuration at a time, each in its own
+    process; write the results as JSON.
+    """
+    results = list()
+    with tempfile.TemporaryDirectory() as tempdir:
+        corpora = list()
+        for size in args.sizes:
+            path = os.path.join(tempdir, 'synthetic-%d.txt' % size)
+            with open(path, 'w') as f:
+                f.write(synthetic_corpus(num_words=size))
+            corpora.append(('synthetic-%d' % size, path))
+        corpora.extend((os.path.basename(c), c) for c in (args.corpus or []))
+
+        for name, path in corpora:
+            for character_tokens in (False, True):
+                for markov_length in args.lengths:
+                    spec = {'corpus': name, 'path': path, 'markov_length': markov_length,
+                            'character_tokens': character_tokens, 'sentences': args.sentences}
+                    print("Benchmarking %s, Markov length %d, %s tokens ..." % (name, markov_length,
+                          'character' if character_tokens else 'word'), file=sys.stderr)
+                    child = subprocess.run([sys.executable, os.path.abspath(__file__), 'suite-worker', json.dumps(spec)],
+                                           stdout=subprocess.PIPE, check=True, universal_newlines=True)
+                    results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+
+    report = json.dumps({'environment': environment(), 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+def bench_suite_worker(args):
+    """Run a single configuration of the suite; invoked by bench_suite() in a child
+    process. Prints the results as a single line of JSON.
+    """
+    print(json.dumps(run_one(json.loads(args.spec))))
+
+
+def flatten(result: dict,
+            prefix: str='') -> typing.Dict[str, float]:
+    """Flatten the nested dictionaries in a single result into {'dotted.key': value}."""
+    ret = dict()
+    for k, v in result.items():
+        if isinstance(v, dict):
+            ret.update(flatten(v, prefix + k + '.'))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            ret[prefix + k] = v
+    return ret
+
+
+def bench_compare(args):
+    """Compare two sets of results written by the suite benchmark, printing the ratio
+    (new / old) for every measurement they have in common. For times and sizes,
+    smaller is better; for rates (anything "per second"), larger is better.
+    """
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    for label, data in (('Old', old), ('New', new)):
+        env = data['environment']
+        print("%s: version %s, %s, %s, %s" % (label, env['text_generator_version'], env['python'],
+                                             'Cython' if env['cythonized'] else 'pure Python', env['date']))
+
+    def key(r: dict) -> tuple:
+        return r['corpus'], r['markov_length'], r['tokens']
+
+    def measurements(r: dict) -> typing.Dict[str, float]:
+        return {k: v for k, v in flatten(r).items() if k not in ('corpus_bytes', 'markov_length')}
+
+    old_results = {key(r): measurements(r) for r in old['results']}
+    for r in new['results']:
+        if key(r) not in old_results:
+            continue
+        print("\n%s, Markov length %d, %s:" % key(r))
+        before = old_results[key(r)]
+        for name, value in measurements(r).items():
+            if before.get(name):
+                print("  %-56s %12.4g -> %12.4g  (%.2fx)" % (name, before[name], value, value / before[name]))
+
+
+def process_command_line() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run micro-benchmarks for text_generator.py.")
+    parser.add_argument('benchmark', choices=['sampling', 'memory', 'loading', 'compression', 'batch', 'automaton', 'characters', 'pool', 'parallel', 'substitutions', 'verbosity', 'startup',
+                                              'suite', 'suite-worker', 'compare'])
+    parser.add_argument('spec', nargs='?', help=argparse.SUPPRESS)         # Used only by suite-worker.
+    parser.add_argument('old', nargs='?', help="(compare only) the older JSON results")
+    parser.add_argument('new', nargs='?', help="(compare only) the newer JSON results")
+    parser.add_argument('-m', '--markov-length', type=int, default=1)
+    parser.add_argument('--words', type=int, default=300000, help="size of the synthetic training corpus, in words")
+    parser.add_argument('--tokens', type=int, default=50000, help="how many tokens to generate while timing")
+    parser.add_argument('--tolerance', type=float, default=1.25, help="largest acceptable slowdown for regression checks")
+    parser.add_argument('--repeat', type=int, default=15, help="(verbosity only) how many timed runs to make at each verbosity level")
+    parser.add_argument('--budget', type=float, default=50.0, help="(startup only) longest acceptable time to import gen_text.py, in ms")
+    parser.add_argument('--sizes', type=lambda s: [int(n) for n in s.split(',')], default=[20000, 200000],
+                        help="(suite only) comma-separated sizes, in words, of the synthetic corpora")
+    parser.add_argument('--lengths', type=lambda s: [int(n) for n in s.split(',')], default=[1, 2, 3, 4, 5],
+                        help="(suite only) comma-separated Markov lengths")
+    parser.add_argument('--corpus', action='append', help="(suite only) also benchmark this plain-text file; may be repeated")
+    parser.add_argument('--sentences', type=int, default=500, help="(suite only) how many sentences to generate while timing")
+    parser.add_argument('-o', '--output', help="(suite only) write the JSON results to this file")
+    args = parser.parse_args()
+    if args.benchmark == 'compare':         # The positional arguments after the benchmark name are the two files.
+        args.old, args.new = args.spec, args.old
+        if not (args.old and args.new):
+            parser.error("compare needs two JSON files")
+    return args
+
+
+if __name__ == "__main__":
+    args = process_command_line()
+    {'sampling': bench_sampling,
+     'memory': bench_memory,
+     'loading': bench_loading,
+     'compression': bench_compression,
+     'batch': bench_batch,
+     'automaton': bench_automaton,
+     'characters': bench_characters,
+     'pool': bench_pool,
+     'parallel': bench_parallel,
+     'substitutions': bench_substitutions,
+     'verbosity': bench_verbosity,
+     'startup': bench_startup,
+     'suite': bench_suite,
+     'suite-worker': bench_suite_worker,
+     'compare': bench_compare,
+     }[args.benchmark](args)
@@ -12,10 +12,15 @@ that the full-featured version is required to GENERATE files that this module
 can only INTERPRET. That is: this stripped-down version is a utility for
 projects that need to generate text based on pre-generated chains, but don't
 need the additional features provided by the larger model.
+
+Chains files in the legacy pickle format can be read with nothing more than the
+standard library; files in the newer binary format also require the
+chain_storage module from the full-featured version. Either kind of file may be
+compressed with gzip, bz2, or lzma.
 """
 
 
-import pickle, random, sys
+import bz2, gzip, lzma, pickle, random, sys
 
 
 punct_with_space_after = r'.,\:!?;'
@@ -42,10 +47,41 @@ def capitalize(w):
         return w[:f] + w[f].upper() + w[1 + f:]
 
 
+_compression_magic = ((b'\x1f\x8b', gzip), (b'BZh', bz2), (b'\xfd7zXZ\x00', lzma))
+
+
+def open_chains(filename):
+    """Open FILENAME for reading, decompressing it as it's read if it's compressed."""
+    with open(filename, 'rb') as the_file:
+        start = the_file.read(6)
+    for magic, module in _compression_magic:
+        if start.startswith(magic):
+            return module.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
 class MarkovChainTextModel(object):
     def __init__(self, filename):
         try:
-            with open(filename, 'rb') as the_chains_file:
+            with open_chains(filename) as the_chains_file:
+                is_binary = the_chains_file.read(8) == b'MRKVCHN\x00'
+        except IOError as e:
+            print("ERROR: Can't read chains from %s; the system said '%s'." % (filename, e))
+            sys.exit(1)
+        if is_binary:
+            import chain_storage
+            try:
+                self.the_mapping = chain_storage.open_chains_file(filename)
+            except (IOError, EOFError, ValueError) as e:
+                print("ERROR: Can't read chains from %s because the file is damaged; the system said '%s'." % (filename, e))
+                sys.exit(2)
+            self.markov_length = self.the_mapping.markov_length
+            self.the_starts = self.the_mapping.starts
+            self.character_tokens = self.the_mapping.character_tokens
+            assert not self.character_tokens, "ERROR: this script cannot interpret 'character token' Markov chain files."
+            return
+        try:
+            with open_chains(filename) as the_chains_file:
                 chains_dictionary = pickle.load(the_chains_file)
         except IOError as e:
             print("ERROR: Can't read chains from %s; the system said '%s'." % (filename, e))
@@ -54,7 +90,7 @@ class MarkovChainTextModel(object):
             print("ERROR: Can't read chains from %s because a pickling error occurred; the system said '%s'." % (filename, e))
             sys.exit(2)
         self.markov_length = chains_dictionary['markov_length']
-        self.the_starts = chains_dictionary['starts']
+        self.the_starts = chains_dictionary['the_starts']
         self.the_mapping = chains_dictionary['the_mapping']
         self.character_tokens = chains_dictionary['character_tokens']
         assert not self.character_tokens, "ERROR: this script cannot interpret 'character token' Markov chain files."
@@ -123,7 +159,7 @@ class TextGenerator(object):
             if random.random() <= paragraph_break_probability or which_sentence == sentences_desired - 1:
                 yield the_text.strip() + "\n"
                 the_text = ""
-        raise StopIteration
+        return
 
 if __name__ == "__main__":
     if len(sys.argv) < 2: fname = '/home/patrick/Documents/programming/python_projects/AutoLovecraft/corpora/previous/All Edited Texts.3.pkl'
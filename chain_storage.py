@@ -0,0 +1,1141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Alternative ways of storing the Markov chains used by text_generator.py. The
+basic representation of the chains is a dictionary mapping tuples of tokens
+("histories") to dictionaries that map each possible following token to its
+probability. That's simple and flexible, but it's also expensive: every history
+is a tuple, every set of followers is a dictionary, and every probability is a
+separate float object. The classes here store the same information more
+compactly, and all of them can stand in for that dictionary of dictionaries
+wherever the chains are used.
+
+Every class here also has a sample() method, which is what MarkovChainTextModel
+uses to pick tokens quickly; a sample_longest() method, which backs off to shorter
+histories until it finds one it knows, as TextGenerator.next() does; and an
+entry() method, which returns a history's followers along with the running totals
+of their probabilities.
+
+ChainAutomaton is different: rather than storing the chains, it compiles them (and
+the way TextGenerator.next() backs off to shorter histories) into a state machine
+that generates text without looking histories up at all.
+
+This module is licensed under the GNU GPL, either version 3, or (at your option)
+any later version. See the files README.md and LICENSE.md for more details.
+"""
+
+
+from __future__ import annotations
+
+import bisect
+import collections.abc
+import functools
+import importlib
+import itertools
+import mmap
+import os
+import stat
+import struct
+import sys
+
+from array import array
+
+
+TYPE_CHECKING = False
+if TYPE_CHECKING:                       # Importing these is comparatively slow, and only type checkers need them.
+    import typing
+
+    from pathlib import Path
+
+
+def _index_typecode(largest: int) -> str:
+    """Return the smallest unsigned array typecode that can hold LARGEST."""
+    return 'I' if largest < 2 ** 32 else 'Q'
+
+
+class _BackoffSampling(object):
+    """Provides sample_longest() for the classes below that can only look up whole
+    histories.
+    """
+    def sample_longest(self, history: tuple,
+                       index: float) -> typing.Tuple[typing.Optional[str], int]:
+        """Pick a follower for the longest suffix of HISTORY that occurs in the chains,
+        using INDEX, a random number in the range [0, 1). Returns (follower, length of
+        the suffix used), or (None, 0) if no suffix of HISTORY occurs in the chains.
+        """
+        for i in range(len(history)):
+            ret = self.sample(history[i:], index)
+            if ret is not None:
+                return ret, len(history) - i
+        return None, 0
+
+
+class SamplingIndex(_BackoffSampling, dict):
+    """The sampling index for a plain dictionary-of-dictionaries mapping. Maps each
+    history to a (followers, cumulative weights) tuple, where FOLLOWERS is a tuple
+    of the tokens that can follow that history and CUMULATIVE WEIGHTS is a parallel
+    array of running totals of their probabilities.
+
+    Entries are built from MAPPING when the index is created, unless LAZY is True;
+    either way, an entry that's missing (say, because it was removed with pop()
+    after the history's followers changed) is rebuilt the next time it's needed.
+    """
+    def __init__(self, mapping: typing.Mapping[tuple, typing.Mapping[str, float]],
+                 lazy: bool=False):
+        self.mapping = mapping
+        if not lazy:
+            dict.__init__(self, ((history, self._entry(followers)) for history, followers in mapping.items()))
+
+    @staticmethod
+    def _entry(followers: typing.Mapping[str, float]) -> tuple:
+        return tuple(followers), array('d', itertools.accumulate(followers.values()))
+
+    def __missing__(self, history: tuple) -> tuple:
+        ret = self[history] = self._entry(self.mapping[history])      # Raises KeyError if HISTORY isn't in the chains.
+        return ret
+
+    def entry(self, history: tuple) -> tuple:
+        """Return (followers, cumulative weights) for HISTORY; raises KeyError if HISTORY
+        isn't in the chains.
+        """
+        return self[history]
+
+    def sample(self, history: tuple,
+               index: float) -> typing.Optional[str]:
+        """Pick a follower for HISTORY, a tuple of tokens, using INDEX, a random number
+        in the range [0, 1). Returns None if HISTORY does not occur in the chains.
+        Picks the same token that walking through the followers in order and adding up
+        their probabilities until the running total reaches INDEX would pick.
+        """
+        try:
+            followers, cumulative = self[history]
+        except KeyError:
+            return None
+        return followers[min(bisect.bisect_left(cumulative, index), len(followers) - 1)]   # Guard against rounding errors in the total.
+
+
+class CompactMapping(_BackoffSampling, collections.abc.Mapping):
+    """A read-only, array-backed replacement for the dictionary-of-dictionaries
+    mapping. Every token is interned into a vocabulary and referred to by its
+    integer ID; each history is packed into a single integer; and the followers of
+    all histories are stored end to end in flat arrays, in the same way that a CSR
+    sparse matrix stores its rows:
+
+      * .rows maps each packed history to its row number;
+      * the followers of row R are .followers[.indptr[R] : .indptr[R + 1]], as
+        token IDs;
+      * .cumulative is parallel to .followers, and holds the running total of the
+        followers' probabilities within each row.
+
+    Looking up a history returns a new {token: probability} dictionary, so that code
+    written for the plain mapping keeps working; but sample() is what should be used
+    on any path where speed matters.
+    """
+    def __init__(self, mapping: typing.Mapping[tuple, typing.Mapping[str, float]]):
+        """Build a compact copy of MAPPING, which is a finalized (i.e., normalized)
+        dictionary-of-dictionaries mapping.
+        """
+        self.vocabulary = list()                # Token ID -> token.
+        self.token_ids = dict()                 # Token -> token ID.
+        for history, followers in mapping.items():
+            for token in itertools.chain(history, followers):
+                if token not in self.token_ids:
+                    self.token_ids[token] = len(self.vocabulary)
+                    self.vocabulary.append(token)
+
+        self.rows = dict()
+        self.indptr = [0]
+        self.followers = array(_index_typecode(len(self.vocabulary)))
+        self.cumulative = array('d')
+        for history, followers in mapping.items():
+            self.rows[self._pack(self.token_ids[t] for t in history)] = len(self.rows)
+            self.followers.extend(self.token_ids[t] for t in followers)
+            self.cumulative.extend(itertools.accumulate(followers.values()))
+            self.indptr.append(len(self.followers))
+        self.indptr = array(_index_typecode(len(self.followers)), self.indptr)
+
+    def __reduce__(self):
+        """Pickling a CompactMapping (say, by storing chains in the legacy pickle format)
+        produces an ordinary dictionary, so that the pickle can be read without this
+        module.
+        """
+        return dict, (list(self.items()),)
+
+    def _pack(self, ids: typing.Iterable[int]) -> int:
+        """Pack a sequence of token IDS into a single integer. Each ID is stored as a digit
+        in base (vocabulary size + 1), offset by one, so that no digit is zero and
+        histories of different lengths can never collide.
+        """
+        base, ret = len(self.vocabulary) + 1, 0
+        for i in ids:
+            ret = ret * base + i + 1
+        return ret
+
+    def _unpack(self, packed: int) -> tuple:
+        """Turn a packed history back into a tuple of tokens."""
+        base, ret = len(self.vocabulary) + 1, list()
+        while packed:
+            packed, digit = divmod(packed, base)
+            ret.append(self.vocabulary[digit - 1])
+        return tuple(reversed(ret))
+
+    def _row(self, history: tuple) -> typing.Optional[int]:
+        """Return the row number for HISTORY, or None if it's not in the chains."""
+        try:
+            return self.rows.get(self._pack(self.token_ids[t] for t in history))
+        except KeyError:            # A token we've never seen can't be part of any history we know about.
+            return None
+
+    def __getitem__(self, history: tuple) -> typing.Dict[str, float]:
+        row = self._row(history)
+        if row is None:
+            raise KeyError(history)
+        begin, end = self.indptr[row], self.indptr[row + 1]
+        ret, previous = dict(), 0.0
+        for token_id, total in zip(self.followers[begin:end], self.cumulative[begin:end]):
+            ret[self.vocabulary[token_id]] = total - previous
+            previous = total
+        return ret
+
+    def __contains__(self, history: tuple) -> bool:
+        return self._row(history) is not None
+
+    def __iter__(self) -> typing.Iterator[tuple]:
+        return (self._unpack(h) for h in self.rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def entry(self, history: tuple) -> tuple:
+        """Return (followers, cumulative weights) for HISTORY. See SamplingIndex.entry()."""
+        row = self._row(history)
+        if row is None:
+            raise KeyError(history)
+        begin, end = self.indptr[row], self.indptr[row + 1]
+        return tuple(self.vocabulary[t] for t in self.followers[begin:end]), self.cumulative[begin:end]
+
+    def sample(self, history: tuple,
+               index: float) -> typing.Optional[str]:
+        """Pick a follower for HISTORY using INDEX, a random number in the range [0, 1).
+        Returns None if HISTORY does not occur in the chains. See SamplingIndex.sample().
+        """
+        row = self._row(history)
+        if row is None:
+            return None
+        begin, end = self.indptr[row], self.indptr[row + 1]
+        return self.vocabulary[self.followers[min(bisect.bisect_left(self.cumulative, index, begin, end), end - 1)]]
+
+
+class CharacterMapping(_BackoffSampling, collections.abc.Mapping):
+    """A read-only store for chains whose tokens are all single characters, as they
+    are when a model is trained with character_tokens=True. Each history is packed
+    into a single integer, .bits_per_character bits per character (enough for any
+    Unicode code point), with the most recent character in the lowest bits and a
+    marker bit above the oldest one, so that histories of different lengths can't
+    collide. Because of that layout, the packed form of any suffix of a history can
+    be had from the packed history itself with a mask (see suffix()), and a
+    generator that keeps its own packed history up to date never needs to build
+    a tuple at all.
+
+    The followers of each history are stored, as code points, in flat arrays, in
+    the same way as in CompactMapping: .rows maps each packed history to its row
+    number R, and the followers of row R, and their running totals, are
+    .followers and .cumulative[.indptr[R] : .indptr[R + 1]].
+
+    Besides standing in for the mapping, this serves as the sampling index for
+    character chains kept in an ordinary dictionary; refresh() keeps it up to date
+    when some of the dictionary's histories change.
+    """
+    bits_per_character = 21         # Unicode code points are all less than 2 ** 21.
+
+    def __init__(self, mapping: typing.Mapping[tuple, typing.Mapping[str, float]]):
+        """Build a character mapping holding the same chains as MAPPING, which is a
+        finalized (i.e., normalized) mapping. Raises ValueError if any token in MAPPING
+        isn't a single character.
+        """
+        self.rows = dict()
+        indptr, followers = [0], list()
+        self.cumulative = array('d')
+        for history in mapping:
+            if hasattr(mapping, 'entry'):
+                tokens, cumulative = mapping.entry(history)
+            else:
+                tokens, cumulative = tuple(mapping[history]), itertools.accumulate(mapping[history].values())
+            try:
+                self.rows[self.pack(history)] = len(self.rows)
+                followers.extend(ord(t) for t in tokens)
+            except TypeError:
+                raise ValueError("ERROR: the chains contain tokens that aren't single characters!")
+            self.cumulative.extend(cumulative)
+            indptr.append(len(followers))
+        self.indptr = array('Q', indptr)           # Not the smallest typecode: refresh() may make the arrays longer.
+        self.followers = array('I', followers)
+
+    def refresh(self, history: tuple,
+                followers: typing.Mapping[str, float]) -> None:
+        """Replace the followers of HISTORY (which may be a new history) with FOLLOWERS,
+        a {character: probability} dictionary. The new row is added at the end of the
+        arrays, and the space taken by the old one isn't reclaimed, so this is meant
+        for keeping up with a few changes, not for rebuilding everything.
+        """
+        try:
+            packed = self.pack(history)
+            code_points = [ord(t) for t in followers]
+        except TypeError:
+            raise ValueError("ERROR: the chains contain tokens that aren't single characters!")
+        self.rows[packed] = len(self.indptr) - 1
+        self.followers.extend(code_points)
+        self.cumulative.extend(itertools.accumulate(followers.values()))
+        self.indptr.append(len(self.followers))
+
+    def __reduce__(self):
+        """Pickling a CharacterMapping (say, by storing chains in the legacy pickle
+        format) produces an ordinary dictionary, so that the pickle can be read without
+        this module.
+        """
+        return dict, (list(self.items()),)
+
+    @classmethod
+    def pack(cls, history: typing.Iterable[str]) -> int:
+        """Pack HISTORY, a sequence of single characters, into an integer."""
+        ret = 1
+        for c in history:
+            ret = (ret << cls.bits_per_character) | ord(c)
+        return ret
+
+    @classmethod
+    def unpack(cls, packed: int) -> tuple:
+        """Turn a packed history back into a tuple of characters."""
+        ret, mask = list(), (1 << cls.bits_per_character) - 1
+        while packed > 1:
+            ret.append(chr(packed & mask))
+            packed >>= cls.bits_per_character
+        return tuple(reversed(ret))
+
+    @classmethod
+    def suffix(cls, packed: int,
+               length: int) -> int:
+        """Return the packed form of the last LENGTH characters of the history PACKED,
+        which must be at least that long.
+        """
+        marker = 1 << (cls.bits_per_character * length)
+        return marker | (packed & (marker - 1))
+
+    def _row(self, history: tuple) -> typing.Optional[int]:
+        try:
+            return self.rows.get(self.pack(history))
+        except TypeError:               # Not a history of single characters, so it can't be in the chains.
+            return None
+
+    def __getitem__(self, history: tuple) -> typing.Dict[str, float]:
+        row = self._row(history)
+        if row is None:
+            raise KeyError(history)
+        begin, end = self.indptr[row], self.indptr[row + 1]
+        ret, previous = dict(), 0.0
+        for code_point, total in zip(self.followers[begin:end], self.cumulative[begin:end]):
+            ret[chr(code_point)] = total - previous
+            previous = total
+        return ret
+
+    def __contains__(self, history: tuple) -> bool:
+        return self._row(history) is not None
+
+    def __iter__(self) -> typing.Iterator[tuple]:
+        return (self.unpack(h) for h in self.rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def entry(self, history: tuple) -> tuple:
+        """Return (followers, cumulative weights) for HISTORY. See SamplingIndex.entry()."""
+        row = self._row(history)
+        if row is None:
+            raise KeyError(history)
+        begin, end = self.indptr[row], self.indptr[row + 1]
+        return tuple(chr(c) for c in self.followers[begin:end]), self.cumulative[begin:end]
+
+    def sample(self, history: tuple,
+               index: float) -> typing.Optional[str]:
+        """Pick a follower for HISTORY using INDEX, a random number in the range [0, 1).
+        Returns None if HISTORY does not occur in the chains. See SamplingIndex.sample().
+        """
+        row = self._row(history)
+        if row is None:
+            return None
+        begin, end = self.indptr[row], self.indptr[row + 1]
+        return chr(self.followers[min(bisect.bisect_left(self.cumulative, index, begin, end), end - 1)])
+
+    def sample_longest(self, history: tuple,
+                       index: float) -> typing.Tuple[typing.Optional[str], int]:
+        """Pick a follower for the longest suffix of HISTORY that occurs in the chains.
+        See _BackoffSampling.sample_longest(). HISTORY is packed once, and its suffixes
+        are found by masking the packed form.
+        """
+        try:
+            packed = self.pack(history)
+        except TypeError:
+            return _BackoffSampling.sample_longest(self, history, index)
+        for length in range(len(history), 0, -1):
+            row = self.rows.get(self.suffix(packed, length))
+            if row is not None:
+                begin, end = self.indptr[row], self.indptr[row + 1]
+                return chr(self.followers[min(bisect.bisect_left(self.cumulative, index, begin, end), end - 1)]), length
+        return None, 0
+
+
+class TrieMapping(collections.abc.Mapping):
+    """A read-only store for the chains that keeps the histories in a reversed suffix
+    trie, instead of as a separate tuple for each one. The root of the trie is the
+    empty history; following an edge labeled with a token from a node leads to the
+    history that has that token prepended. So ("the", "rain", "in"), ("rain", "in"),
+    and ("in",) are a single path of three nodes, rather than three unrelated keys,
+    and finding the longest known suffix of a history (which is what generating text
+    needs when it has to back off) takes a single walk down the trie.
+
+    Like CompactMapping, tokens are interned into a vocabulary, and everything is
+    stored in flat arrays. The nodes are numbered breadth-first, with each node's
+    children numbered consecutively and sorted by token ID, so the trie needs only
+    two numbers per node:
+
+      * the children of node N are nodes .first_child[N] to .first_child[N + 1] - 1;
+      * .edge_tokens[N] is the ID of the token on the edge leading to node N, so a
+        child is found with a binary search through its siblings' .edge_tokens.
+
+    The followers of node N, and their running totals, are .followers and
+    .cumulative[.indptr[N] : .indptr[N + 1]], as in CompactMapping. Nodes that are
+    only on the way to longer histories have no followers, and aren't in the chains.
+    """
+    def __init__(self, mapping: typing.Mapping[tuple, typing.Mapping[str, float]]):
+        """Build a trie holding the same chains as MAPPING, which is a finalized (i.e.,
+        normalized) mapping: a dictionary of dictionaries, or any of the other classes
+        in this module.
+        """
+        self.vocabulary = list()                # Token ID -> token.
+        self.token_ids = dict()                 # Token -> token ID.
+        width = 0
+        for history in mapping:
+            width = max(width, len(history))
+            for token in history:
+                if token not in self.token_ids:
+                    self.token_ids[token] = len(self.vocabulary)
+                    self.vocabulary.append(token)
+
+        # Number the nodes a level at a time: the nodes at depth D are the suffixes of length D, sorted by their parents'
+        # numbers and then by the tokens on their edges.
+        nodes, edge_tokens, child_counts = [()], [0], [0]
+        ids = {(): 0}
+        for depth in range(1, width + 1):
+            level = sorted({h[-depth:] for h in mapping if len(h) >= depth},
+                           key=lambda s: (ids[s[1:]], self.token_ids[s[0]]))
+            for s in level:
+                child_counts[ids[s[1:]]] += 1
+            ids = {s: len(nodes) + i for i, s in enumerate(level)}
+            nodes.extend(level)
+            edge_tokens.extend(self.token_ids[s[0]] for s in level)
+            child_counts.extend(0 for s in level)
+        self.first_child = array(_index_typecode(len(nodes)), itertools.accumulate(itertools.chain([1], child_counts)))
+        self.edge_tokens = array(_index_typecode(len(self.vocabulary)), edge_tokens)
+
+        indptr, self._length = [0], 0
+        followers = list()
+        self.cumulative = array('d')
+        for s in nodes:
+            if s in mapping:
+                if hasattr(mapping, 'entry'):
+                    tokens, cumulative = mapping.entry(s)
+                else:
+                    tokens, cumulative = tuple(mapping[s]), itertools.accumulate(mapping[s].values())
+                for token in tokens:
+                    if token not in self.token_ids:
+                        self.token_ids[token] = len(self.vocabulary)
+                        self.vocabulary.append(token)
+                followers.extend(self.token_ids[t] for t in tokens)
+                self.cumulative.extend(cumulative)
+                self._length += 1
+            indptr.append(len(followers))
+        self.indptr = array(_index_typecode(len(followers)), indptr)
+        self.followers = array(_index_typecode(len(self.vocabulary)), followers)
+
+    def __reduce__(self):
+        """Pickling a TrieMapping produces an ordinary dictionary, so that the pickle can
+        be read without this module.
+        """
+        return dict, (list(self.items()),)
+
+    def _child(self, node: int,
+               token_id: int) -> typing.Optional[int]:
+        """Return the child of NODE along the edge labeled TOKEN_ID, or None if there isn't one."""
+        begin, end = self.first_child[node], self.first_child[node + 1]
+        i = bisect.bisect_left(self.edge_tokens, token_id, begin, end)
+        if i < end and self.edge_tokens[i] == token_id:
+            return i
+        return None
+
+    def _parent(self, node: int) -> int:
+        """Return the number of NODE's parent."""
+        return bisect.bisect_right(self.first_child, node) - 1
+
+    def _node(self, history: tuple) -> typing.Optional[int]:
+        """Return the node for HISTORY, if it's in the chains; otherwise, None."""
+        node = 0
+        for token in reversed(history):
+            token_id = self.token_ids.get(token)
+            if token_id is None:
+                return None
+            node = self._child(node, token_id)
+            if node is None:
+                return None
+        if self.indptr[node] == self.indptr[node + 1]:
+            return None
+        return node
+
+    def __getitem__(self, history: tuple) -> typing.Dict[str, float]:
+        node = self._node(history)
+        if node is None:
+            raise KeyError(history)
+        begin, end = self.indptr[node], self.indptr[node + 1]
+        ret, previous = dict(), 0.0
+        for token_id, total in zip(self.followers[begin:end], self.cumulative[begin:end]):
+            ret[self.vocabulary[token_id]] = total - previous
+            previous = total
+        return ret
+
+    def __contains__(self, history: tuple) -> bool:
+        return self._node(history) is not None
+
+    def __iter__(self) -> typing.Iterator[tuple]:
+        histories = [()]                            # The history for each node, in order.
+        for node in range(len(self.edge_tokens)):
+            if node:
+                histories.append((self.vocabulary[self.edge_tokens[node]],) + histories[self._parent(node)])
+            if self.indptr[node] < self.indptr[node + 1]:
+                yield histories[-1]
+
+    def __len__(self) -> int:
+        return self._length
+
+    def entry(self, history: tuple) -> tuple:
+        """Return (followers, cumulative weights) for HISTORY. See SamplingIndex.entry()."""
+        node = self._node(history)
+        if node is None:
+            raise KeyError(history)
+        begin, end = self.indptr[node], self.indptr[node + 1]
+        return tuple(self.vocabulary[t] for t in self.followers[begin:end]), self.cumulative[begin:end]
+
+    def sample(self, history: tuple,
+               index: float) -> typing.Optional[str]:
+        """Pick a follower for HISTORY using INDEX, a random number in the range [0, 1).
+        Returns None if HISTORY does not occur in the chains. See SamplingIndex.sample().
+        """
+        node = self._node(history)
+        if node is None:
+            return None
+        begin, end = self.indptr[node], self.indptr[node + 1]
+        return self.vocabulary[self.followers[min(bisect.bisect_left(self.cumulative, index, begin, end), end - 1)]]
+
+    def sample_longest(self, history: tuple,
+                       index: float) -> typing.Tuple[typing.Optional[str], int]:
+        """Pick a follower for the longest suffix of HISTORY that occurs in the chains.
+        See _BackoffSampling.sample_longest(). This walks down the trie once, noting the
+        deepest node that has followers, instead of looking up each suffix in turn.
+        """
+        node, found, length = 0, None, 0
+        first_child, edge_tokens, indptr, token_ids = self.first_child, self.edge_tokens, self.indptr, self.token_ids
+        for depth, token in enumerate(reversed(history), start=1):
+            token_id = token_ids.get(token)
+            if token_id is None:
+                break
+            begin, end = first_child[node], first_child[node + 1]
+            node = bisect.bisect_left(edge_tokens, token_id, begin, end)
+            if node == end or edge_tokens[node] != token_id:
+                break
+            if indptr[node] < indptr[node + 1]:
+                found, length = node, depth
+        if found is None:
+            return None, 0
+        begin, end = indptr[found], indptr[found + 1]
+        return self.vocabulary[self.followers[min(bisect.bisect_left(self.cumulative, index, begin, end), end - 1)]], length
+
+
+class OverlayMapping(_BackoffSampling, collections.abc.MutableMapping):
+    """Makes one of the read-only mappings above (a CompactMapping or a MappedMapping)
+    updatable: histories assigned to it are kept in an ordinary dictionary that
+    overrides the read-only BASE, which is never modified. This is what lets a
+    model loaded from a binary chains file be trained further without reading the
+    whole file into memory; only the histories that actually change are copied.
+    Histories can be added and changed, but not deleted.
+    """
+    def __init__(self, base: typing.Mapping[tuple, typing.Mapping[str, float]]):
+        self.base = base
+        self.changes = dict()
+        self.index = SamplingIndex(self.changes, lazy=True)
+        self._added = 0                 # Number of histories in .changes that aren't in .base.
+
+    def __reduce__(self):
+        """Pickling an OverlayMapping produces an ordinary dictionary."""
+        return dict, (list(self.items()),)
+
+    def __getitem__(self, history: tuple) -> typing.Mapping[str, float]:
+        try:
+            return self.changes[history]
+        except KeyError:
+            return self.base[history]
+
+    def __setitem__(self, history: tuple,
+                    followers: typing.Dict[str, float]):
+        if (history not in self.changes) and (history not in self.base):
+            self._added += 1
+        self.changes[history] = followers
+        self.index.pop(history, None)
+
+    def __delitem__(self, history: tuple):
+        raise TypeError("ERROR: histories can't be deleted from an OverlayMapping!")
+
+    def __contains__(self, history: tuple) -> bool:
+        return (history in self.changes) or (history in self.base)
+
+    def __iter__(self) -> typing.Iterator[tuple]:
+        yield from self.base
+        yield from (h for h in self.changes if h not in self.base)
+
+    def __len__(self) -> int:
+        return len(self.base) + self._added
+
+    def entry(self, history: tuple) -> tuple:
+        """Return (followers, cumulative weights) for HISTORY. See SamplingIndex.entry()."""
+        if history in self.changes:
+            return self.index.entry(history)
+        return self.base.entry(history)
+
+    def sample(self, history: tuple,
+               index: float) -> typing.Optional[str]:
+        """Pick a follower for HISTORY using INDEX, a random number in the range [0, 1).
+        Returns None if HISTORY does not occur in the chains. See SamplingIndex.sample().
+        """
+        if history in self.changes:
+            return self.index.sample(history, index)
+        return self.base.sample(history, index)
+
+
+class ChainAutomaton(object):
+    """The chains, compiled into a state machine for generating text. Generating a
+    token normally means building a tuple of the last few tokens, looking it up, and
+    (if it's not there) dropping tokens from the front and looking again until
+    some known history turns up. Here, each state stands for a history (or a prefix
+    of one), and for every token that can be generated in each state, the state
+    that follows it is worked out in advance. Generating a token is then a binary
+    search in the current state's running totals, which yields both the token and
+    the next state.
+
+    The states are numbered, and stored CSR-style, like CompactMapping's rows: the
+    tokens that can be generated in state S are .followers[.indptr[S] : .indptr[S + 1]]
+    (as IDs in .vocabulary); .cumulative holds their running totals; and .successors
+    holds the state that each one leads to. State 0 is the empty history, which
+    has no followers: ending up there means that no history is known, and the
+    sentence has reached a dead end. .history_lengths holds the length of the
+    history each state actually samples from, which is shorter than the state's own
+    history when that history was never followed by anything in training.
+
+    Because every prefix of every history is a state, the longest suffix of the
+    tokens generated so far that is a state always determines the next state, and
+    the history that next() would end up sampling from; so, given the same random
+    numbers, this produces exactly the tokens that next() would. It takes
+    roughly as much memory again as a CompactMapping of the same chains.
+    """
+    def __init__(self, mapping: typing.Mapping[tuple, typing.Mapping[str, float]],
+                 index,
+                 markov_length: int,
+                 comparison_form: typing.Optional[typing.Callable[[str], str]]=None):
+        """Compile the chains in MAPPING, which has INDEX as its sampling index (for the
+        storage classes in this module, that's MAPPING itself), and which is used to
+        generate text by looking at the last MARKOV_LENGTH tokens. COMPARISON_FORM, if
+        given, is applied to each token before it becomes part of a history, as
+        TextGenerator.comparison_form() is.
+        """
+        histories = {h for h in mapping if len(h) <= markov_length}    # Longer ones are never used for generating.
+        states = {(): 0}
+        for h in histories:
+            for i in range(1, len(h) + 1):
+                if h[:i] not in states:
+                    states[h[:i]] = len(states)
+
+        def state_for(context: tuple) -> int:
+            """Return the state for the longest suffix of CONTEXT that is a state."""
+            for i in range(len(context)):
+                if context[i:] in states:
+                    return states[context[i:]]
+            return 0
+
+        self.vocabulary = list()            # Token ID -> token.
+        token_ids = dict()                  # Token -> token ID.
+        next_history = list()               # Token ID -> its comparison form, as a one-token history.
+        indptr, followers, successors = [0], list(), list()
+        self.cumulative = array('d')
+        self.history_lengths = array('B', bytes(len(states)))
+        for state, s in enumerate(states):              # Dictionaries remember the order in which keys were added.
+            for i in range(len(s)):
+                if s[i:] in histories:
+                    tokens, cumulative = index.entry(s[i:])
+                    self.history_lengths[state] = len(s) - i
+                    break
+            else:
+                tokens, cumulative = (), ()
+            for t in tokens:
+                if t not in token_ids:
+                    token_ids[t] = len(self.vocabulary)
+                    self.vocabulary.append(t)
+                    next_history.append((comparison_form(t) if comparison_form else t,))
+                followers.append(token_ids[t])
+                successors.append(state_for((s + next_history[token_ids[t]])[-markov_length:]))
+            self.cumulative.extend(cumulative)
+            indptr.append(len(followers))
+        self.indptr = array(_index_typecode(len(followers)), indptr)
+        self.followers = array(_index_typecode(len(self.vocabulary)), followers)
+        self.successors = array(_index_typecode(len(states)), successors)
+        self.start_states = {h[0]: state for h, state in states.items() if len(h) == 1}
+
+    def __len__(self) -> int:
+        """The number of states."""
+        return len(self.indptr) - 1
+
+    def start_state(self, token: str) -> int:
+        """Return the state to be in after a sentence that begins with TOKEN (in its
+        comparison form).
+        """
+        return self.start_states.get(token, 0)
+
+
+# The binary chains-file format. All numbers are little-endian. The file starts with a header:
+#
+#   magic (8 bytes), format version, markov length, flags, history width (all uint16);
+#   vocabulary size, number of histories, number of followers, number of starts (all uint64).
+#
+# ... and is followed by these sections, each padded to a multiple of eight bytes:
+#
+#   vocabulary offsets: uint64[vocabulary size + 1], offsets into ...
+#   vocabulary: the UTF-8 encoding of each token, end to end, sorted by their encoded bytes, so that token IDs can be
+#               found by binary search;
+#   histories:  one row of (history width) big-endian uint32 token IDs per history, padded at the end with
+#               _NO_TOKEN, and sorted (so that comparing the raw bytes of two rows compares the histories);
+#   indptr:     uint64[number of histories + 1]: the followers of history R are followers[indptr[R] : indptr[R + 1]];
+#   followers:  uint32 token IDs;
+#   cumulative: float64[number of followers], the running total of the probabilities in each history's row; or, if
+#               the _FLAG_WEIGHTS_8 or _FLAG_WEIGHTS_16 flag is set (which requires format version 2), uint8 or uint16
+#               [number of followers], each follower's weight, quantized by quantize_weights(), from which the running
+#               totals are worked out when the file is opened;
+#   starts:     uint32 token IDs of the tokens that can start a sentence;
+#   start weights (only if the _FLAG_START_WEIGHTS flag is set): float64[number of starts], the running total of
+#               how often each start occurred in training;
+#   history totals (only if the _FLAG_HISTORY_TOTALS flag is set): float64[number of histories], the number of
+#               times each history occurred in training, so that the chains can be trained further.
+CHAINS_FILE_MAGIC = b'MRKVCHN\x00'
+CHAINS_FILE_VERSION = 2             # Files without quantized weights are still written as version 1.
+_header = struct.Struct('<8sHHHHQQQQ')
+_FLAG_CHARACTER_TOKENS = 1
+_FLAG_START_WEIGHTS = 2
+_FLAG_HISTORY_TOTALS = 4
+_FLAG_WEIGHTS_8 = 8
+_FLAG_WEIGHTS_16 = 16
+_weight_typecodes = {8: 'B', 16: 'H'}
+_NO_TOKEN = 2 ** 32 - 1
+
+
+def _padding(length: int) -> bytes:
+    return b'\x00' * (-length % 8)
+
+
+def quantize_weights(probabilities: typing.Iterable[float],
+                     bits: int) -> typing.List[int]:
+    """Convert PROBABILITIES, those of a single history's followers, to BITS-bit fixed-point
+    weights: the most likely follower gets the largest weight that fits in BITS bits,
+    and the others get weights in proportion to it, rounded, but never less than one,
+    so that no follower becomes impossible. Dividing each weight by their sum gives
+    the probabilities back, approximately; quantizing those probabilities again
+    gives exactly the same weights.
+    """
+    probabilities = list(probabilities)
+    scale = (2 ** bits - 1) / max(probabilities)
+    return [max(1, round(p * scale)) for p in probabilities]
+
+
+# Chains files (in either format) may be compressed with any of these standard-library modules, each of which has
+# an open() function that streams data through the compressor. Files are compressed as a whole, so a compressed
+# binary file has to be decompressed into memory rather than memory-mapped.
+COMPRESSION_FORMATS = ('gzip', 'bz2', 'lzma')
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'lzma', '.lzma': 'lzma'}
+_compression_magic = {'gzip': b'\x1f\x8b', 'bz2': b'BZh', 'lzma': b'\xfd7zXZ\x00'}
+_compression_options = {'gzip': {'compresslevel': 6}}      # The gzip module's default of 9 is several times slower for ~1% smaller files.
+
+
+def compression_for(filename: typing.Union[str, Path],
+                    compression: typing.Optional[str]=None) -> typing.Optional[str]:
+    """Return the compression format (one of COMPRESSION_FORMATS, or None for no
+    compression) to use when writing FILENAME: COMPRESSION, if it's specified ('none'
+    means no compression), or else whatever FILENAME's extension implies.
+    """
+    if compression is None:
+        return COMPRESSION_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+    if compression == 'none':
+        return None
+    assert compression in COMPRESSION_FORMATS, "ERROR: unknown compression format %s!" % compression
+    return compression
+
+
+def uncompressed_name(filename: typing.Union[str, Path]) -> str:
+    """Return FILENAME without its compression extension, if it has one: chains.pkl.gz
+    becomes chains.pkl.
+    """
+    root, extension = os.path.splitext(filename)
+    return root if extension.lower() in COMPRESSION_EXTENSIONS else os.fspath(filename)
+
+
+def detect_compression(filename: typing.Union[str, Path]) -> typing.Optional[str]:
+    """Return the compression format of FILENAME, judging by its first few bytes, or
+    None if it's not compressed in any of COMPRESSION_FORMATS.
+    """
+    with open(filename, 'rb') as f:
+        start = f.read(max(len(m) for m in _compression_magic.values()))
+    return next((c for c, magic in _compression_magic.items() if start.startswith(magic)), None)
+
+
+def open_compressed(the_file: typing.Union[str, Path, typing.BinaryIO],
+                    mode: str,
+                    compression: typing.Optional[str]) -> typing.BinaryIO:
+    """Open THE_FILE, a filename or an open binary file, so that everything read from
+    it (if MODE is 'rb') or written to it (if MODE is 'wb') passes through the
+    COMPRESSION format's (de)compressor a block at a time. If COMPRESSION is None,
+    filenames are simply opened, and open files are returned as they are. Closing
+    what's returned doesn't close an open file passed in as THE_FILE.
+    """
+    if compression is None:
+        return open(the_file, mode) if isinstance(the_file, (str, os.PathLike)) else the_file
+    assert compression in COMPRESSION_FORMATS, "ERROR: unknown compression format %s!" % compression
+    return importlib.import_module(compression).open(the_file, mode, **_compression_options.get(compression, {}))
+
+
+def replace_file(temp_name: typing.Union[str, Path],
+                 filename: typing.Union[str, Path]) -> None:
+    """Move TEMP_NAME, a temporary file that has just been written, into place as
+    FILENAME. The tempfile module creates files that only their owner can read, so
+    TEMP_NAME is first given FILENAME's permissions, if FILENAME already exists, or
+    else the permissions that the umask allows a newly created file.
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)                 # The only way to read the umask is to set it ...
+        os.umask(umask)                     # ... and then put it back.
+        mode = 0o666 & ~umask
+    os.chmod(temp_name, mode)
+    os.replace(temp_name, filename)
+
+
+def is_chains_file(filename: typing.Union[str, Path],
+                   compression: typing.Optional[str]=None) -> bool:
+    """Return True if FILENAME is a chains file in the binary format, rather than (say)
+    a pickled chains dictionary. If COMPRESSION is None, compressed files are
+    recognized automatically.
+    """
+    if compression is None:
+        compression = detect_compression(filename)
+    with open_compressed(filename, 'rb', compression) as f:
+        return f.read(len(CHAINS_FILE_MAGIC)) == CHAINS_FILE_MAGIC
+
+
+def write_chains_file(the_file: typing.BinaryIO,
+                      mapping: typing.Mapping[tuple, typing.Mapping[str, float]],
+                      starts: typing.Sequence[str],
+                      markov_length: int,
+                      character_tokens: bool=False,
+                      start_weights: typing.Optional[typing.Sequence[float]]=None,
+                      history_totals: typing.Optional[typing.Mapping[tuple, float]]=None,
+                      weight_bits: typing.Optional[int]=None) -> None:
+    """Write MAPPING and STARTS to THE_FILE, an open binary file, in the binary chains
+    format described above, along with START_WEIGHTS (the running totals of how often
+    each start occurred) and HISTORY_TOTALS (how often each history occurred), if
+    they're known. THE_FILE is written strictly from beginning to end, so it
+    doesn't need to be seekable. The followers of each history keep the order they
+    have in MAPPING, so a model read back from the file generates exactly the same
+    text as the original for the same random numbers.
+
+    If WEIGHT_BITS is 8 or 16, each follower's probability is stored as a weight of
+    that many bits (see quantize_weights()) rather than as a running total in a
+    64-bit float, which makes the file much smaller; the text generated from it is
+    then only approximately the same.
+    """
+    assert weight_bits in (None, 8, 16), "ERROR: weights can only be quantized to 8 or 16 bits, not %s!" % weight_bits
+    encoded = {t.encode('utf-8') for history, followers in mapping.items() for t in itertools.chain(history, followers)}
+    encoded.update(t.encode('utf-8') for t in starts)
+    vocabulary = sorted(encoded)
+    del encoded
+    token_ids = {t.decode('utf-8'): i for i, t in enumerate(vocabulary)}
+    width = max((len(h) for h in mapping), default=markov_length)
+
+    def row(history: tuple) -> bytes:
+        ids = [token_ids[t] for t in history] + [_NO_TOKEN] * (width - len(history))
+        return struct.pack('>%dI' % width, *ids)
+
+    histories = sorted(mapping, key=row)
+    indptr, followers = array('Q', [0]), array('I')
+    cumulative = array(_weight_typecodes[weight_bits]) if weight_bits else array('d')
+    for h in histories:
+        f = mapping[h]
+        followers.extend(token_ids[t] for t in f)
+        if weight_bits:
+            cumulative.extend(quantize_weights(f.values(), weight_bits))
+        else:
+            cumulative.extend(itertools.accumulate(f.values()))
+        indptr.append(len(followers))
+    start_ids = array('I', [token_ids[t] for t in starts])
+    weights = array('d', start_weights if (start_weights and len(start_weights) == len(starts)) else [])
+    totals = array('d', (history_totals[h] for h in histories) if history_totals is not None else [])
+    offsets = array('Q', [0])
+    for t in vocabulary:
+        offsets.append(offsets[-1] + len(t))
+
+    if sys.byteorder != 'little':
+        for a in (indptr, followers, cumulative, start_ids, weights, totals, offsets):
+            a.byteswap()
+    the_file.write(_header.pack(CHAINS_FILE_MAGIC, 2 if weight_bits else 1, markov_length,
+                                (_FLAG_CHARACTER_TOKENS if character_tokens else 0) | (_FLAG_START_WEIGHTS if weights else 0)
+                                | (_FLAG_HISTORY_TOTALS if totals else 0) | {None: 0, 8: _FLAG_WEIGHTS_8, 16: _FLAG_WEIGHTS_16}[weight_bits],
+                                width,
+                                len(vocabulary), len(histories), len(followers), len(start_ids)))
+    for section in (offsets.tobytes(), b''.join(vocabulary), b''.join(row(h) for h in histories),
+                    indptr.tobytes(), followers.tobytes(), cumulative.tobytes(), start_ids.tobytes(), weights.tobytes(),
+                    totals.tobytes()):
+        the_file.write(section)
+        the_file.write(_padding(len(section)))
+
+
+class _TokenSequence(collections.abc.Sequence):
+    """A read-only sequence of tokens, stored as token IDs in a MappedMapping, that
+    decodes each token only when it's asked for.
+    """
+    def __init__(self, owner: 'MappedMapping',
+                 ids: typing.Sequence[int]):
+        self.owner, self.ids = owner, ids
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.owner.token(t) for t in self.ids[i]]
+        return self.owner.token(self.ids[i])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+class _HistoryTotals(collections.abc.Mapping):
+    """A read-only view of the number of times each history in a MappedMapping
+    occurred in training.
+    """
+    def __init__(self, owner: 'MappedMapping',
+                 totals: typing.Sequence[float]):
+        self.owner, self.totals = owner, totals
+
+    def __getitem__(self, history: tuple) -> float:
+        row = self.owner._row(history)
+        if row is None:
+            raise KeyError(history)
+        return self.totals[row]
+
+    def __contains__(self, history: tuple) -> bool:
+        return history in self.owner
+
+    def __iter__(self) -> typing.Iterator[tuple]:
+        return iter(self.owner)
+
+    def __len__(self) -> int:
+        return len(self.owner)
+
+
+class MappedMapping(_BackoffSampling, collections.abc.Mapping):
+    """A read-only view onto a binary chains file, usually memory-mapped by
+    open_chains_file(). Nothing is read from the file until it's needed: looking up a
+    history is a binary search through the sorted history table, and tokens are
+    decoded only when they're sampled. Because the pages of a memory-mapped file are
+    shared through the operating system's page cache, many processes can use the
+    same model without each keeping a private copy.
+
+    Like CompactMapping, this can stand in for the dictionary-of-dictionaries
+    mapping, and can serve as its own sampling index.
+
+    If the file stores quantized weights rather than running totals (see
+    write_chains_file()), the running totals are worked out when it's opened, and
+    kept in memory; .weight_bits is then 8 or 16, rather than None.
+    """
+    def __init__(self, buffer):
+        """BUFFER is anything that supports the buffer protocol and contains a complete
+        chains file: usually an mmap.mmap object, but a bytes object works, too.
+
+        Raises ValueError if BUFFER isn't a chains file, or if it's truncated or
+        otherwise inconsistent with its own header.
+        """
+        self.buffer = buffer
+        view = memoryview(buffer)
+        if len(view) < _header.size:
+            raise ValueError("ERROR: the chains file is truncated: it's only %d bytes long, which is too short for its header!" % len(view))
+        magic, version, self.markov_length, flags, self.width, vocab_size, num_histories, num_followers, num_starts \
+            = _header.unpack_from(buffer, 0)
+        if magic != CHAINS_FILE_MAGIC:
+            raise ValueError("ERROR: this is not a chains file!")
+        if version > CHAINS_FILE_VERSION:
+            raise ValueError("ERROR: chains file format version %d is newer than this code understands!" % version)
+        self.character_tokens = bool(flags & _FLAG_CHARACTER_TOKENS)
+        self._row_size = 4 * self.width
+        self._num_histories = num_histories
+
+        pos = _header.size
+
+        def section(length: int, typecode: typing.Optional[str]=None):
+            nonlocal pos
+            if pos + length > len(view):
+                raise ValueError("ERROR: the chains file is truncated: a section needs bytes %d to %d, but the file is only %d bytes long!"
+                                 % (pos, pos + length, len(view)))
+            ret = view[pos:pos + length]
+            pos += length + (-length % 8)
+            if typecode is None:
+                return ret
+            if sys.byteorder != 'little':          # The file is little-endian; we need a private, byte-swapped copy.
+                ret = array(typecode, ret.tobytes())
+                ret.byteswap()
+                return ret
+            return ret.cast(typecode)
+
+        self.offsets = section(8 * (vocab_size + 1), 'Q')
+        if any(a > b for a, b in zip(self.offsets, self.offsets[1:])) or (self.offsets[0] != 0):
+            raise ValueError("ERROR: the vocabulary offsets in the chains file are corrupt!")
+        self.vocabulary = section(self.offsets[-1])
+        self.histories = section(self._row_size * num_histories)
+        self.indptr = section(8 * (num_histories + 1), 'Q')
+        if any(a > b for a, b in zip(self.indptr, self.indptr[1:])) or (self.indptr[0] != 0) or (self.indptr[-1] != num_followers):
+            raise ValueError("ERROR: the history table in the chains file doesn't match its %d followers!" % num_followers)
+        self.followers = section(4 * num_followers, 'I')
+        self.weight_bits = 8 if (flags & _FLAG_WEIGHTS_8) else 16 if (flags & _FLAG_WEIGHTS_16) else None
+        if self.weight_bits:
+            weights = section(num_followers * self.weight_bits // 8, _weight_typecodes[self.weight_bits])
+            self.cumulative = array('d')
+            for begin, end in zip(self.indptr, self.indptr[1:]):        # Renormalize each history's weights.
+                total = sum(weights[begin:end])
+                self.cumulative.extend(w / total for w in itertools.accumulate(weights[begin:end]))
+        else:
+            self.cumulative = section(8 * num_followers, 'd')
+        self.starts = _TokenSequence(self, section(4 * num_starts, 'I'))
+        self.start_weights = section(8 * num_starts, 'd') if (flags & _FLAG_START_WEIGHTS) else None
+        self.totals = _HistoryTotals(self, section(8 * num_histories, 'd')) if (flags & _FLAG_HISTORY_TOTALS) else None
+
+        self.token = functools.lru_cache(maxsize=65536)(self._decode_token)
+        self.token_id = functools.lru_cache(maxsize=65536)(self._find_token_id)
+
+    def __reduce__(self):
+        """Pickling a MappedMapping (say, by storing chains in the legacy pickle format
+        after loading them from a binary file) produces an ordinary dictionary.
+        """
+        return dict, (list(self.items()),)
+
+    def _decode_token(self, token_id: int) -> str:
+        return bytes(self.vocabulary[self.offsets[token_id]:self.offsets[token_id + 1]]).decode('utf-8')
+
+    def _find_token_id(self, token: str) -> typing.Optional[int]:
+        """Binary-search the vocabulary for TOKEN. Returns None if it's not there."""
+        target, lo, hi = token.encode('utf-8'), 0, len(self.offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(self.vocabulary[self.offsets[mid]:self.offsets[mid + 1]]) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.offsets) - 1 and self.vocabulary[self.offsets[lo]:self.offsets[lo + 1]] == target:
+            return lo
+        return None
+
+    def _row_key(self, history: tuple) -> typing.Optional[bytes]:
+        if len(history) > self.width:
+            return None
+        ids = [self.token_id(t) for t in history]
+        if None in ids:
+            return None
+        return struct.pack('>%dI' % self.width, *(ids + [_NO_TOKEN] * (self.width - len(ids))))
+
+    def _history_row(self, r: int) -> bytes:
+        return bytes(self.histories[r * self._row_size:(r + 1) * self._row_size])
+
+    def _row(self, history: tuple) -> typing.Optional[int]:
+        """Binary-search the history table for HISTORY; return its row number, or None if
+        it's not in the chains.
+        """
+        key = self._row_key(history)
+        if key is None:
+            return None
+        lo, hi = 0, self._num_histories
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._history_row(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._num_histories and self._history_row(lo) == key:
+            return lo
+        return None
+
+    def __getitem__(self, history: tuple) -> typing.Dict[str, float]:
+        row = self._row(history)
+        if row is None:
+            raise KeyError(history)
+        begin, end = self.indptr[row], self.indptr[row + 1]
+        ret, previous = dict(), 0.0
+        for token_id, total in zip(self.followers[begin:end], self.cumulative[begin:end]):
+            ret[self.token(token_id)] = total - previous
+            previous = total
+        return ret
+
+    def __contains__(self, history: tuple) -> bool:
+        return self._row(history) is not None
+
+    def __iter__(self) -> typing.Iterator[tuple]:
+        for r in range(self._num_histories):
+            ids = struct.unpack('>%dI' % self.width, self._history_row(r))
+            yield tuple(self.token(i) for i in ids if i != _NO_TOKEN)
+
+    def __len__(self) -> int:
+        return self._num_histories
+
+    def entry(self, history: tuple) -> tuple:
+        """Return (followers, cumulative weights) for HISTORY. See SamplingIndex.entry()."""
+        row = self._row(history)
+        if row is None:
+            raise KeyError(history)
+        begin, end = self.indptr[row], self.indptr[row + 1]
+        return tuple(self.token(t) for t in self.followers[begin:end]), self.cumulative[begin:end]
+
+    def sample(self, history: tuple,
+               index: float) -> typing.Optional[str]:
+        """Pick a follower for HISTORY using INDEX, a random number in the range [0, 1).
+        Returns None if HISTORY does not occur in the chains. See SamplingIndex.sample().
+        """
+        row = self._row(history)
+        if row is None:
+            return None
+        begin, end = self.indptr[row], self.indptr[row + 1]
+        return self.token(self.followers[min(bisect.bisect_left(self.cumulative, index, begin, end), end - 1)])
+
+
+def open_chains_file(filename: typing.Union[str, Path],
+                     compression: typing.Optional[str]=None) -> MappedMapping:
+    """Memory-map FILENAME, a chains file in the binary format, and return a
+    MappedMapping that reads from it.
+
+    Compressed files (in COMPRESSION, or in whatever format they turn out to be in,
+    if COMPRESSION is None) can't be memory-mapped: they're decompressed, a block at
+    a time, into a private buffer in memory instead.
+    """
+    if compression is None:
+        compression = detect_compression(filename)
+    if compression is None:
+        with open(filename, 'rb') as f:
+            return MappedMapping(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    buffer = bytearray()
+    with open_compressed(filename, 'rb', compression) as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            buffer += block
+    return MappedMapping(buffer)
@@ -1,4 +1,4 @@
-#!/usr/bin/env python3.5
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 import sys
@@ -37,11 +37,12 @@ might be something like:
 
 
 
-import argparse, pprint, sys
+import os, sys
 
 import patrick_logger               # https://github.com/patrick-brian-mooney/personal-library
 from patrick_logger import log_it
 
+import chain_storage
 import text_generator as tg
 
 
@@ -73,6 +74,8 @@ def process_command_line():
     for defaults.
     """
 
+    import argparse             # Imported here, rather than at the top, to keep startup quick when called via main(**kwargs).
+
     help_epilogue = """OPTIONS
 
 -m N, --markov-length N
@@ -100,19 +103,63 @@ def process_command_line():
     saving the data with -o and then re-loading it with the -l option is faster
     than re-generating the data on every run by specifying the same input files
     with -i. However, the generated chains saved with -o are notably larger than
-    the source files.
+    the source files (though see --prune-top-k and --quantize, below).
+
+    Chains are saved in a compact binary format that -l can memory-map, so that
+    even very large models load almost instantly. If FILE ends in .pkl or
+    .pickle, the chains are instead saved in the legacy pickle format used by
+    older versions of this program.
+
+--prune-top-k K, --prune-min-count N, --prune-unreachable, --quantize BITS
+    Make the chains saved with -o smaller, at the cost of changing the text
+    generated from them a little. --prune-top-k keeps only the K most likely
+    words (or characters) that can follow each sequence; --prune-min-count
+    drops those that followed it fewer than N times in the training texts
+    (always keeping the most likely one); --prune-unreachable drops sequences
+    that can never actually come up while generating text; and --quantize
+    stores probabilities as BITS-bit (8 or 16) numbers instead of 64-bit ones.
+    After saving the chains, a report compares their size (on disk and in
+    memory) with what it would have been, and says how much the probabilities
+    changed. These options are also applied to chains loaded with -l.
+
+--compression {gzip,bz2,lzma,none}
+    Compress the chains saved with -o as they're written, in any of these
+    formats. If FILE ends in .gz, .bz2, or .xz (as in chains.pkl.gz), it's
+    compressed in the matching format without this option; 'none' turns that
+    off. Compressed files are typically a third or a quarter of the size, but
+    -l has to decompress them into memory rather than memory-mapping them, so
+    they take longer to load: gzip is fastest to load, lzma usually smallest.
+    Compression is detected automatically when loading with -l, but this
+    option can also be used to say which format a file is in.
 
 -l FILE, --load FILE
     Load probability data ("chains") that was generated a previous run and
     saved with -o or --output.  Loading the data this way is faster than
     re-generating it, so if you're going to be using the same data a lot, you
     can save time by generating the data only once, then re-loading it this way
-    on subsequent runs.
+    on subsequent runs. Both the binary and the legacy pickle formats can be
+    loaded; the format is detected automatically.
+
+-j N, --jobs N
+    Train the model using N processes at once. Large input files are split into
+    pieces so that they can be shared among the processes. The resulting chains
+    are exactly the same as those produced by training in a single process
+    (which is the default). Cannot be used with -l/--load.
+
+--token-cache DIR
+    Keep the words (or characters) that the input files are split into in the
+    directory DIR, and reuse them the next time the same files are used for
+    training, even with a different -m/--markov-length, instead of splitting the
+    files up all over again. Cannot be used with -j/--jobs.
 
 -c N, --count N
     Specify how many sentences the script should generate. (If unspecified, the
     default number of sentences to generate is one.)
 
+--seed N
+    Make the generated text reproducible: running the script again with the
+    same chains and the same N produces exactly the same text.
+
 -r, --chars
     By default, the individual tokens in the chains generated by this program
     are whole words; chances are that this is what most people using a Markov
@@ -135,6 +182,13 @@ def process_command_line():
     pause may not be quite exactly NUM seconds, though the program tries to get
     this right to the greatest extent possible.
 
+--weighted-starts
+    Begin sentences with words (or characters) in proportion to how often they
+    began sentences in the training texts, instead of giving every word that
+    ever began a sentence the same chance of beginning one. Chains saved by
+    versions of this program before 2.5 don't record this information; if they
+    are loaded with -l, this option has no effect.
+
 --html
     Wrap paragraphs of text output by the program with HTML paragraph tags. This
     does NOT generate a complete, formally valid HTML document (which would
@@ -142,6 +196,51 @@ def process_command_line():
     generates an HTML fragment that you can insert into another HTML document,
     as you wish.
 
+--stats [FORMAT]
+    After generating text, print some statistics about how it was generated:
+    how many tokens were produced, how often the generator had to "back off" to
+    shorter chains because it didn't recognize the words it had just produced,
+    how often it threw a sentence away and started again, and how long it spent
+    building sentences, cleaning them up, and printing them. FORMAT is either
+    "text" (the default) or "prometheus", which prints the same numbers in the
+    text format understood by the Prometheus monitoring system.
+
+--serve
+    Instead of generating text and quitting, load (or train) the chains once and
+    then keep running as a server that generates text whenever it's asked to,
+    answering HTTP requests like
+
+        curl 'http://127.0.0.1:8000/generate?count=5&seed=42'
+
+    See generation_server.py for the details. With --serve, -l/--load and
+    -i/--input are optional if at least one --model is given; the chains they
+    specify are served as the model named "default".
+
+--host HOST, --port PORT
+    The address and port on which --serve listens. The defaults are 127.0.0.1
+    (i.e., only programs on the same computer can connect) and 8000.
+
+--socket PATH
+    Make --serve listen on a Unix-domain socket at PATH, instead of on a port.
+
+--model NAME=FILE
+    Make --serve load the chains saved in FILE and serve them as the model
+    called NAME. Can be specified more than once.
+
+--pool SIZE
+    Make --serve keep up to SIZE sentences from each model ready ahead of time,
+    made by background threads, so that most requests can be answered without
+    waiting for sentences to be built. Requests that specify a seed don't use
+    the pool.
+
+--pool-workers N
+    The number of background threads that fill each model's pool. The default
+    is 1.
+
+--pool-max-age SECONDS
+    Throw away sentences that have been waiting in a pool for more than SECONDS
+    seconds, instead of handing them out. By default, they never get too old.
+
 -v, --verbose
     Increase the verbosity of the script, i.e. get more output. Can be specified
     multiple times to make the script more and more verbose. Current verbosity
@@ -169,6 +268,7 @@ apply to the short versions of the same options.
 
             -m/--markov-length
             -i/--input
+            -j/--jobs
             -r/--chars (nor can you turn it off if the previously generated
                         chains were generated with it)
 
@@ -196,11 +296,29 @@ See the file LICENSE.md for details.
     parser.add_argument('-i', '--input', action="append")
     parser.add_argument('-o', '--output')
     parser.add_argument('-l', '--load')
+    parser.add_argument('--prune-top-k', type=int)
+    parser.add_argument('--prune-min-count', type=float)
+    parser.add_argument('--prune-unreachable', action='store_true')
+    parser.add_argument('--quantize', type=int, choices=[8, 16])
+    parser.add_argument('--compression', choices=['gzip', 'bz2', 'lzma', 'none'])
+    parser.add_argument('-j', '--jobs', type=int, default="1")
+    parser.add_argument('--token-cache')
     parser.add_argument('-c', '--count', type=int, default="1")
+    parser.add_argument('--seed', type=int)
     parser.add_argument('-r', '--chars', action='store_true')
     parser.add_argument('-w', '--columns', type=int, default="-1")
     parser.add_argument('-p', '--pause', type=int, default="0")
+    parser.add_argument('--weighted-starts', action='store_true')
     parser.add_argument('--html', action='store_true')
+    parser.add_argument('--stats', nargs='?', const='text', choices=['text', 'prometheus'])
+    parser.add_argument('--serve', action='store_true')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default="8000")
+    parser.add_argument('--socket')
+    parser.add_argument('--model', action='append', default=[])
+    parser.add_argument('--pool', type=int, default="0")
+    parser.add_argument('--pool-workers', type=int, default="1")
+    parser.add_argument('--pool-max-age', type=float)
     parser.add_argument('-v', '--verbose', action='count', default=0)
     parser.add_argument('-q', '--quiet', action='count', default=0)
     parser.add_argument('--version', action='version', version='text_generator.py %s' % tg.__version__.strip('$').strip())
@@ -209,15 +327,93 @@ See the file LICENSE.md for details.
 
 default_args = {'chars': False,
                 'columns': -1,
+                'compression': None,
                 'count': 1,
+                'host': '127.0.0.1',
                 'html': False,
                 'input': [],
+                'jobs': 1,
                 'load': None,
                 'markov_length': 1,
+                'model': [],
                 'output': None,
                 'pause': 0,
+                'pool': 0,
+                'pool_max_age': None,
+                'pool_workers': 1,
+                'port': 8000,
+                'prune_min_count': None,
+                'prune_top_k': None,
+                'prune_unreachable': False,
+                'quantize': None,
                 'quiet': 0,
-                'verbose': 0}
+                'seed': None,
+                'serve': False,
+                'socket': None,
+                'stats': None,
+                'token_cache': None,
+                'verbose': 0,
+                'weighted_starts': False}
+
+def save_chains(genny: tg.TextGenerator, opts: dict) -> None:
+    """Save GENNY's chains to the file specified by the -o option in OPTS, pruning and
+    quantizing them first if other options in OPTS ask for that, and then reporting
+    what doing that bought, and what it cost.
+    """
+    compacting = opts['prune_top_k'] or opts['prune_min_count'] or opts['prune_unreachable'] or opts['quantize']
+    if compacting:
+        import model_registry       # For estimated_size().
+
+        file_format = genny.chains.file_format_for(opts['output'])
+        compression = chain_storage.compression_for(opts['output'], opts['compression'])
+        size_before = genny.chains.stored_size(file_format, compression)
+        memory_before = model_registry.estimated_size(genny.chains)
+        reports = list()
+        if opts['prune_top_k'] or opts['prune_min_count'] or opts['prune_unreachable']:
+            reports.append(('Pruning', genny.prune(min_count=opts['prune_min_count'], top_k=opts['prune_top_k'],
+                                                   drop_unreachable=opts['prune_unreachable'])))
+        if opts['quantize']:
+            reports.append(('Quantizing', genny.chains.quantize(opts['quantize'])))
+    saved = genny.chains.store_chains(filename=opts['output'], compression=opts['compression'])
+    if compacting and saved:                # If it wasn't saved, store_chains() has already said why.
+        size_after, memory_after = os.path.getsize(opts['output']), model_registry.estimated_size(genny.chains)
+        print("Chains saved to %s." % opts['output'])
+        for what, report in reports:
+            print('%s:\n  %s' % (what, str(report).replace('\n', '\n  ')))
+        print("File size: %d -> %d bytes (%+.1f%%)" % (size_before, size_after, 100 * (size_after / size_before - 1)))
+        print("Memory: %d -> %d bytes (%+.1f%%, estimated)" % (memory_before, memory_after, 100 * (memory_after / memory_before - 1)))
+
+
+def serve(generator_class, opts):
+    """Load (or train) the models specified in OPTS, then serve text generated from
+    them until interrupted. See generation_server.py.
+    """
+    import generation_server
+
+    models = dict()
+    if opts['load'] or opts['input']:
+        genny = generator_class()
+        if opts['load']:
+            genny.chains.read_chains(filename=opts['load'], compression=opts['compression'])
+        else:
+            genny.train(the_files=opts['input'], markov_length=opts['markov_length'], character_tokens=opts['chars'], workers=opts['jobs'],
+                        token_cache=opts['token_cache'])
+        if opts['output']:
+            save_chains(genny, opts)
+        models['default'] = genny
+    for m in opts['model']:
+        name, filename = m.split('=', 1)
+        models[name] = generator_class(name=name)
+        models[name].chains.read_chains(filename=filename)
+    for genny in models.values():
+        genny.chains.weighted_starts = opts['weighted_starts']
+        if not genny.is_trained():
+            log_it('ERROR: a model could not be loaded or trained; not starting the server.')
+            sys.exit(1)
+        if opts['pool']:
+            genny.enable_pool(size=opts['pool'], workers=opts['pool_workers'], max_age=opts['pool_max_age'])
+    generation_server.run(models, host=opts['host'], port=opts['port'], socket_path=opts['socket'])
+
 
 def main(generator_class=tg.TextGenerator, **kwargs):
     """Handle the main program loop and generate some text.
@@ -236,16 +432,18 @@ def main(generator_class=tg.TextGenerator, **kwargs):
     TextGenerator class, but see poetry_generator for a sample of how this can be
     overridden.
     """
-    if (not sys.stdout.isatty()) and (patrick_logger.verbosity_level < 1):  # Assume we're running on a web server. ...
-        print_html_docs()
-
     if len(kwargs):     # If keyword arguments are passed in, trust them to be the options.
         opts = tg.apply_defaults(defaultargs=default_args, args=kwargs)
     else:               # Otherwise, parse the command line.
         opts = process_command_line()
 
+    if (not opts['serve']) and (not sys.stdout.isatty()) and (patrick_logger.verbosity_level < 1):  # Assume we're running on a web server. ...
+        print_html_docs()
+
     # OK, check the parameters for inconsistencies.
-    if not opts['load'] and not opts['input']:
+    if opts['serve'] and opts['model'] and not (opts['load'] or opts['input']):
+        pass                    # The server has models to serve, even without a default one.
+    elif not opts['load'] and not opts['input']:
         log_it('ERROR: You must specify input data using either -i/--input or -l/--load.')
         sys.exit(2)
     if opts['load']:
@@ -255,35 +453,77 @@ def main(generator_class=tg.TextGenerator, **kwargs):
         if opts['markov_length'] > 1:
             log_it('ERROR: You cannot specify a Markov chain length if you load previously compiled chains with -l/--load.')
             sys.exit(2)
+        if opts['jobs'] > 1:
+            log_it('ERROR: You cannot specify a number of training processes if you load previously compiled chains with -l/--load.')
+            sys.exit(2)
+    if opts['jobs'] < 1:
+        log_it('ERROR: -j/--jobs must be at least 1.')
+        sys.exit(2)
+    if (opts['prune_top_k'] or opts['prune_min_count'] or opts['prune_unreachable'] or opts['quantize']) and not opts['output']:
+        log_it('ERROR: --prune-top-k, --prune-min-count, --prune-unreachable, and --quantize only make sense with -o/--output.')
+        sys.exit(2)
+    if (opts['prune_top_k'] is not None) and (opts['prune_top_k'] < 1):
+        log_it('ERROR: --prune-top-k must be at least 1.')
+        sys.exit(2)
+    if opts['token_cache'] and (opts['jobs'] > 1):
+        log_it('ERROR: --token-cache cannot be used with -j/--jobs.')
+        sys.exit(2)
+    if opts['model'] and not opts['serve']:
+        log_it('ERROR: --model only makes sense with --serve; use -l/--load to load a single set of chains.')
+        sys.exit(2)
+    if opts['pool'] and not opts['serve']:
+        log_it('ERROR: --pool only makes sense with --serve.')
+        sys.exit(2)
+    if (opts['pool'] < 0) or (opts['pool_workers'] < 1):
+        log_it('ERROR: --pool must not be negative, and --pool-workers must be at least 1.')
+        sys.exit(2)
+    for m in opts['model']:
+        if '=' not in m:
+            log_it('ERROR: --model must be given as NAME=FILE, not %s.', 0, m)
+            sys.exit(2)
     if opts['html']:
         if opts['pause'] or opts['columns'] > 0:
             log_it('ERROR: Specifying --html is not compatible with using a --pause/-p value or specifying a column width.')
             sys.exit(2)
 
     # Now set up logging parameters
-    log_it('INFO: Command-line options parsed; parameters are: %s' % pprint.pformat(opts), 2)
+    if patrick_logger.log_enabled(2):
+        import pprint
+        log_it('INFO: Command-line options parsed; parameters are: %s', 2, pprint.pformat(opts))
     patrick_logger.verbosity_level = opts['verbose'] - opts['quiet']
-    log_it('DEBUGGING: verbosity_level after parsing command line is %d.' % patrick_logger.verbosity_level, 2)
+    log_it('DEBUGGING: verbosity_level after parsing command line is %d.', 2, patrick_logger.verbosity_level)
+
+    if opts['serve']:
+        serve(generator_class, opts)
+        return
 
     # Now instantiate and train the model, and save the compiled chains, if that's what the user wants
     print()                     # Cough up a blank line at the beginning.
     genny = generator_class()
     if opts['load']:
-        genny.chains.read_chains(filename=opts['load'])
+        genny.chains.read_chains(filename=opts['load'], compression=opts['compression'])
     else:
-        genny.train(the_files=opts['input'], markov_length=opts['markov_length'], character_tokens=opts['chars'])
+        genny.train(the_files=opts['input'], markov_length=opts['markov_length'], character_tokens=opts['chars'], workers=opts['jobs'],
+                    token_cache=opts['token_cache'])
     if opts['output']:
-        genny.chains.store_chains(filename=opts['output'])
+        save_chains(genny, opts)
+    genny.chains.weighted_starts = opts['weighted_starts']
 
     # And generate some text.
+    if opts['stats']:
+        genny.enable_stats()
     if opts['html']:
-        the_text = genny.gen_html_frag(sentences_desired=opts['count'])
+        the_text = genny.gen_html_frag(sentences_desired=opts['count'], seed=opts['seed'])
         print(the_text)
     else:
-        genny.print_text(sentences_desired=opts['count'], pause=opts['pause'], columns=opts['columns'])
+        genny.print_text(sentences_desired=opts['count'], pause=opts['pause'], columns=opts['columns'], seed=opts['seed'])
+    if opts['stats'] == 'prometheus':
+        print(genny.stats.prometheus(), end='')
+    elif opts['stats']:
+        print('\n' + str(genny.stats))
 
     if force_test:
-        if tg._is_cythonized:
+        if tg._is_cythonized():
             print("\n\nWe're running under Cython!")
         else:
             print("\n\nWe're running under CPython!")
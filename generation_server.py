@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A long-running server that keeps one or more trained text generators in memory
+and generates text on request, so that programs that need a few sentences at a
+time don't have to start a new process (and re-read or re-train the chains) for
+every one of them. It speaks just enough HTTP/1.1 to be used with curl, a browser,
+or any HTTP library, over either a TCP port or a Unix-domain socket. It's usually
+started with
+
+    ./gen_text.py --serve -l /path/to/chains.chains
+
+and then queried with, for instance,
+
+    curl 'http://127.0.0.1:8000/generate?count=5&seed=42'
+
+Endpoints:
+
+  GET /health       Reports the server's status and load, and the models loaded.
+  GET /generate     Generates text. Parameters may be given in the query string
+  POST /generate    or (for POST) as a JSON object in the body:
+                      model       name of the model to use (default: 'default', or
+                                  the only model, if there's only one);
+                      count       number of sentences (default: 1);
+                      paragraph_break_probability (default: 0.25);
+                      seed        if given, the same request always produces the
+                                  same text, the text gen_text(seed=SEED) produces
+                                  (and isn't taken from the model's sentence pool,
+                                  if it has one);
+                      format      'text' (the default) or 'html'.
+                    Responds with a JSON object: {"model": ..., "text": ...}.
+
+Generating text is CPU-bound, so requests are served concurrently but generation
+itself happens one paragraph at a time, in turn. No more than MAX_CONCURRENT
+requests generate text at once; up to MAX_PENDING more wait their turn; and any
+beyond that are turned away immediately with 503 Service Unavailable, so that a
+client sending too many requests finds out right away instead of waiting forever.
+
+This module is licensed under the GNU GPL, either version 3, or (at your option)
+any later version. See the files README.md and LICENSE.md for more details.
+"""
+
+
+import asyncio
+import json
+import typing
+import urllib.parse
+
+import text_generator as tg
+from text_generator import log_it
+
+
+class RequestError(Exception):
+    """An error in a client's request, reported back to the client with STATUS."""
+    def __init__(self, status: int,
+                 message: str):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            413: 'Payload Too Large', 431: 'Request Header Fields Too Large', 503: 'Service Unavailable'}
+
+
+class GenerationServer(object):
+    """Serves text generated by the TextGenerators in MODELS, a dictionary mapping
+    names to trained generators. MAX_CONCURRENT and MAX_PENDING control how many
+    requests can be generating text at once, and how many more can wait for their
+    turn (see the module docstring); MAX_SENTENCES is the largest number of sentences
+    that can be requested at once.
+    """
+    max_header_bytes = 16 * 1024
+    max_body_bytes = 64 * 1024
+    idle_timeout = 30           # Seconds to wait for the next request on a kept-alive connection.
+
+    def __init__(self, models: typing.Dict[str, tg.TextGenerator],
+                 max_concurrent: int=4,
+                 max_pending: int=64,
+                 max_sentences: int=1000):
+        assert models, "ERROR: the server needs at least one model to serve!"
+        for name, genny in models.items():
+            assert genny.is_trained(), "ERROR: model %s is not trained!" % name
+        self.models = models
+        self.max_concurrent, self.max_pending, self.max_sentences = max_concurrent, max_pending, max_sentences
+        self.in_flight, self.pending, self.served, self.rejected = 0, 0, 0, 0
+        self._slots = None      # An asyncio.Semaphore, created in serve() so that it belongs to the right event loop.
+
+    def health(self) -> dict:
+        return {'status': 'ok',
+                'in_flight': self.in_flight,
+                'pending': self.pending,
+                'served': self.served,
+                'rejected': self.rejected,
+                'models': {name: {'markov_length': genny.chains.markov_length,
+                                  'character_tokens': genny.chains.character_tokens,
+                                  'pooled_sentences': None if (genny.pool is None) else len(genny.pool),
+                                  'pool_dead': None if (genny.pool is None) else genny.pool.dead}
+                           for name, genny in self.models.items()}}
+
+    def _parameters(self, params: dict) -> tuple:
+        """Check and unpack the parameters of a /generate request. Returns (model name,
+        generator, count, paragraph-break probability, seed, format).
+        """
+        if 'model' in params:
+            name = str(params['model'])
+        elif len(self.models) == 1:
+            name = next(iter(self.models))
+        else:
+            name = 'default'
+        if name not in self.models:
+            raise RequestError(404, "no model named %r" % name)
+        try:
+            count = int(params.get('count', 1))
+            probability = float(params.get('paragraph_break_probability', 0.25))
+            seed = params.get('seed')
+            seed = None if (seed is None) else int(seed)
+        except (TypeError, ValueError) as e:
+            raise RequestError(400, "bad parameter: %s" % e)
+        if not (1 <= count <= self.max_sentences):
+            raise RequestError(400, "count must be between 1 and %d" % self.max_sentences)
+        if not (0 <= probability <= 1):
+            raise RequestError(400, "paragraph_break_probability must be between 0 and 1")
+        text_format = params.get('format', 'text')
+        if text_format not in ('text', 'html'):
+            raise RequestError(400, "format must be 'text' or 'html'")
+        return name, self.models[name], count, probability, seed, text_format
+
+    async def generate(self, params: dict) -> dict:
+        """Generate the text requested by PARAMS, waiting for a free slot first. Yields to
+        the event loop every few milliseconds (see TextGenerator.async_time_slice), so
+        that other requests (including health checks) keep being answered while long
+        texts are being generated.
+        """
+        name, genny, count, probability, seed, text_format = self._parameters(params)
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise RequestError(503, "too many requests are waiting; try again later")
+        self.pending += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.pending -= 1
+        self.in_flight += 1
+        try:
+            # A seeded request gets its paragraphs' seeds from the same plan that gen_text(seed=SEED) uses, and so
+            # produces the same text, which the requests it's interleaved with don't change (or vice versa).
+            ret = [paragraph async for paragraph in genny._aparagraphs(count, probability, seed, 1)]
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+        self.served += 1
+        if text_format == 'html':
+            text = '\n\n'.join(['<p>%s</p>' % p.strip() for p in ret])        # Just as gen_html_frag() does it.
+        else:
+            text = '\n'.join(ret)                                               # Just as gen_text() does it.
+        return {'model': name, 'text': text}
+
+    async def _respond(self, method: str,
+                       target: str,
+                       body: bytes) -> typing.Tuple[int, dict]:
+        """Work out the response to a single request. Returns (HTTP status, JSON object)."""
+        url = urllib.parse.urlsplit(target)
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        if url.path == '/health':
+            if method not in ('GET', 'HEAD'):
+                raise RequestError(405, "use GET for /health")
+            return 200, self.health()
+        if url.path == '/generate':
+            if method == 'POST' and body:
+                try:
+                    posted = json.loads(body.decode('utf-8'))
+                except (UnicodeDecodeError, ValueError) as e:
+                    raise RequestError(400, "the request body is not valid JSON: %s" % e)
+                if not isinstance(posted, dict):
+                    raise RequestError(400, "the request body must be a JSON object")
+                params.update(posted)
+            elif method not in ('GET', 'POST'):
+                raise RequestError(405, "use GET or POST for /generate")
+            return 200, await self.generate(params)
+        raise RequestError(404, "no such endpoint: %s" % url.path)
+
+    async def handle_connection(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter) -> None:
+        """Answer HTTP requests on one connection until the client closes it, asks for it to
+        be closed, or goes quiet for .idle_timeout seconds.
+        """
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+                except asyncio.LimitOverrunError:
+                    await self._send(writer, 431, {'error': "request headers are too large"}, keep_alive=False)
+                    return
+                lines = head.decode('latin-1').split('\r\n')
+                try:
+                    method, target, version = lines[0].split()
+                except ValueError:
+                    await self._send(writer, 400, {'error': "malformed request line"}, keep_alive=False)
+                    return
+                headers = dict()
+                for line in lines[1:]:
+                    if ':' in line:
+                        k, v = line.split(':', 1)
+                        headers[k.strip().lower()] = v.strip()
+                keep_alive = (headers.get('connection', '').lower() != 'close') and (version == 'HTTP/1.1')
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                if not (0 <= length <= self.max_body_bytes):
+                    await self._send(writer, 413, {'error': "request body is missing or too large"}, keep_alive=False)
+                    return
+                try:
+                    body = await reader.readexactly(length) if length else b''
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+
+                try:
+                    status, response = await self._respond(method.upper(), target, body)
+                except RequestError as e:
+                    status, response = e.status, {'error': str(e)}
+                log_it("INFO: %s %s -> %d", 2, method, target, status)
+                await self._send(writer, status, response, keep_alive=keep_alive, head_only=(method.upper() == 'HEAD'))
+                if not keep_alive:
+                    return
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _send(writer: asyncio.StreamWriter,
+                    status: int,
+                    response: dict,
+                    keep_alive: bool=True,
+                    head_only: bool=False) -> None:
+        body = (json.dumps(response, ensure_ascii=False) + '\n').encode('utf-8')
+        head = ['HTTP/1.1 %d %s' % (status, _reasons.get(status, '')),
+                'Content-Type: application/json; charset=utf-8',
+                'Content-Length: %d' % len(body),
+                'Connection: %s' % ('keep-alive' if keep_alive else 'close')]
+        if status == 503:
+            head.append('Retry-After: 1')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        if not head_only:
+            writer.write(body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def serve(self, host: str='127.0.0.1',
+                    port: int=8000,
+                    socket_path: typing.Optional[str]=None) -> None:
+        """Serve requests forever, on SOCKET_PATH (a Unix-domain socket) if it's given, or
+        else on PORT at HOST.
+        """
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle_connection, path=socket_path, limit=self.max_header_bytes)
+            where = socket_path
+        else:
+            server = await asyncio.start_server(self.handle_connection, host=host, port=port, limit=self.max_header_bytes)
+            where = ', '.join('%s:%d' % s.getsockname()[:2] for s in server.sockets)
+        log_it("INFO: serving %d model(s) (%s) on %s", 1, len(self.models), ', '.join(self.models), where)
+        async with server:
+            await server.serve_forever()
+
+
+def run(models: typing.Dict[str, tg.TextGenerator],
+        host: str='127.0.0.1',
+        port: int=8000,
+        socket_path: typing.Optional[str]=None,
+        **kwargs) -> None:
+    """Serve MODELS until interrupted. KWARGS are passed to GenerationServer()."""
+    try:
+        asyncio.run(GenerationServer(models, **kwargs).serve(host=host, port=port, socket_path=socket_path))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A registry of trained models, for programs that generate text from many saved
+sets of chains. Rather than having every caller create a TextGenerator and call
+read_chains() itself (so that popular models are read over and over, and models
+that are no longer wanted are never freed), callers ask a ModelRegistry for the
+chains in a file:
+
+    registry = model_registry.ModelRegistry(memory_budget=2 * 1024 ** 3)
+    genny = registry.generator('/path/to/chains.pkl')
+    print(genny.gen_text(sentences_desired=5))
+
+The chains are read the first time they're asked for, and the same
+MarkovChainTextModel is handed out to every generator that asks for them
+afterwards, as long as the file hasn't changed. When the models loaded take up
+more than MEMORY_BUDGET bytes, the ones used least recently are dropped from the
+registry.
+
+Models handed out by a registry are shared, so they're marked read-only: trying to
+train them further, compact them, or load other chains into them fails. The
+registry is safe to use from several threads at once.
+
+This module is licensed under the GNU GPL, either version 3, or (at your option)
+any later version. See the files README.md and LICENSE.md for more details.
+"""
+
+
+import collections
+import hashlib
+import mmap
+import os
+import sys
+import threading
+import time
+import typing
+
+from pathlib import Path
+
+import text_generator as tg
+from text_generator import log_it
+
+
+def estimated_size(what) -> int:
+    """Estimate the memory used by WHAT, which is usually a MarkovChainTextModel, by
+    adding up the sizes of the objects it refers to, directly or indirectly, and
+    counting each object only once. Memory-mapped files are counted at their full
+    size, even though the operating system may not have read all of them in, and can
+    share their pages between processes.
+    """
+    seen, total, pending = set(), 0, [what]
+    while pending:
+        o = pending.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        if isinstance(o, mmap.mmap):
+            total += len(o)
+            continue
+        if callable(o) or isinstance(o, type):     # Functions and classes are shared with everything else.
+            continue
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            pending.extend(o.keys())
+            pending.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset, collections.deque)):
+            pending.extend(o)
+        elif isinstance(o, memoryview):
+            pending.append(o.obj)
+        elif hasattr(o, '__dict__'):
+            pending.append(o.__dict__)
+    return total
+
+
+class RegistryStats(object):
+    """Counters describing what a ModelRegistry has been doing:
+
+      .hits         requests for a model that was already loaded (or that another
+                    thread was loading);
+      .misses       requests that had to load a model;
+      .reloads      misses that happened because a loaded model's file had changed;
+      .evictions    models dropped to stay within the memory budget (or model limit);
+      .seconds      total time spent loading models.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        """Set all of the counters back to zero."""
+        self.hits, self.misses, self.reloads, self.evictions = 0, 0, 0, 0
+        self.seconds = 0.0
+
+    def as_dict(self) -> dict:
+        """Return all of the counters as a dictionary (suitable for, say, JSON)."""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'evictions': self.evictions,
+                'seconds': self.seconds}
+
+    def __str__(self) -> str:
+        return '\n'.join(["Hits: %d" % self.hits,
+                          "Misses: %d (%d because the file changed)" % (self.misses, self.reloads),
+                          "Evictions: %d" % self.evictions,
+                          "Time spent loading: %.4f seconds" % self.seconds])
+
+
+class ModelRegistry(object):
+    """Loads saved chains on demand, shares them among everything that asks for them,
+    and forgets the least recently used ones when they take up too much memory.
+
+    MEMORY_BUDGET is the number of bytes that the loaded models may take up (as
+    worked out by SIZER, a function that takes a MarkovChainTextModel and returns a
+    number of bytes; by default, estimated_size()); MAX_MODELS is the number of
+    models that may be loaded at once. Either (or both) may be None, meaning no
+    limit. The model that was most recently asked for is never evicted, even if it's
+    bigger than the whole budget by itself.
+
+    Files are identified by their path, modification time, and size, unless KEY is
+    'hash', in which case they're identified by a hash of their contents: files that
+    are copies of each other then share a single model, and a file whose
+    modification time changes without its contents changing isn't reloaded. (Each
+    file is still only hashed when its modification time or size changes.)
+
+    Evicting a model only drops the registry's reference to it; generators that are
+    still using it keep it alive until they're done with it.
+
+    Files are hashed and loaded without holding the registry's lock, so loading one
+    model doesn't hold up requests for models that are already loaded. If several
+    threads ask for the same model while it's being loaded, only one of them loads
+    it; the others wait for it to finish.
+    """
+    def __init__(self, memory_budget: typing.Optional[int]=None,
+                 max_models: typing.Optional[int]=None,
+                 key: str='mtime',
+                 sizer: typing.Callable[[tg.MarkovChainTextModel], int]=estimated_size):
+        assert key in ('mtime', 'hash'), "ERROR: KEY must be 'mtime' or 'hash', not %r!" % key
+        assert (max_models is None) or (max_models >= 1), "ERROR: MAX_MODELS must be at least one!"
+        self.memory_budget, self.max_models, self.key, self.sizer = memory_budget, max_models, key, sizer
+        self.stats = RegistryStats()
+        self._models = collections.OrderedDict()    # Key -> (model, size), least recently used first.
+        self._keys = dict()                         # Path -> (file signature, key) for the last version of it loaded.
+        self._loading = dict()                      # Key -> threading.Event, set when the model stops being loaded.
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _signature(path: str) -> tuple:
+        """Return a signature for the file at PATH that changes whenever the file does."""
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+
+    @staticmethod
+    def _content_hash(path: str) -> str:
+        h = hashlib.sha256()
+        with open(path, 'rb') as the_file:
+            for block in iter(lambda: the_file.read(1024 * 1024), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def _key(self, path: str) -> typing.Tuple[typing.Hashable, tuple]:
+        """Return (the cache key, the signature) for the current version of the file at
+        PATH. The file is hashed, if it needs to be, without holding the lock.
+        """
+        signature = self._signature(path)
+        if self.key == 'mtime':
+            return (path, signature), signature
+        with self._lock:
+            known = self._keys.get(path)
+        if known and (known[0] == signature):
+            return known[1], signature
+        return self._content_hash(path), signature
+
+    def _load(self, path: str) -> tg.MarkovChainTextModel:
+        model = tg.MarkovChainTextModel()
+        model.read_chains(path)
+        if not model.finalized:
+            raise IOError("Unable to read chains from %s" % path)
+        model.read_only = True
+        return model
+
+    def get(self, path: typing.Union[str, Path]) -> tg.MarkovChainTextModel:
+        """Return the (read-only) MarkovChainTextModel holding the chains saved in the
+        file at PATH, loading it if it hasn't been loaded yet, or if the file has
+        changed since it was.
+        """
+        path = os.path.realpath(path)
+        key, signature = self._key(path)
+        while True:
+            with self._lock:
+                if key in self._models:
+                    self.stats.hits += 1
+                    self._models.move_to_end(key)
+                    self._keys[path] = (signature, key)
+                    return self._models[key][0]
+                loading = self._loading.get(key)
+                if loading is None:         # Nobody else is loading it, so it's up to us.
+                    loading = self._loading[key] = threading.Event()
+                    self.stats.misses += 1
+                    if path in self._keys:          # We've loaded this file before, but it's changed since.
+                        self.stats.reloads += 1
+                        old_key = self._keys.pop(path)[1]
+                        if old_key not in (k for s, k in self._keys.values()):     # Unless another file has the same contents ...
+                            self._models.pop(old_key, None)                         # ... the old version is no use to anyone.
+                    break
+            loading.wait()                  # Then try again: it's loaded now, unless loading it failed (or it's been evicted).
+
+        try:
+            start = time.perf_counter()
+            model = self._load(path)
+            seconds = time.perf_counter() - start
+            size = self.sizer(model)
+            with self._lock:
+                self.stats.seconds += seconds
+                self._models[key] = (model, size)
+                self._keys[path] = (signature, key)
+                log_it("INFO: loaded chains from %s", 2, path)
+                self._evict()
+            return model
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+
+    def generator(self, path: typing.Union[str, Path],
+                  generator_class: type=tg.TextGenerator,
+                  **kwargs) -> tg.TextGenerator:
+        """Return a new generator of class GENERATOR_CLASS (passing KWARGS to it when
+        it's created) that uses the shared chains saved in the file at PATH.
+        """
+        genny = generator_class(**kwargs)
+        genny.chains = self.get(path)
+        return genny
+
+    def _over_limits(self) -> bool:
+        if (self.max_models is not None) and (len(self._models) > self.max_models):
+            return True
+        return (self.memory_budget is not None) and (self.memory_in_use() > self.memory_budget)
+
+    def _drop(self, key: typing.Hashable) -> None:
+        """Forget the model stored under KEY, and every file that was loaded as it."""
+        self._models.pop(key, None)
+        self._keys = {p: known for p, known in self._keys.items() if known[1] != key}
+
+    def _evict(self) -> None:
+        """Drop the least recently used models until the rest fit within the limits."""
+        while (len(self._models) > 1) and self._over_limits():
+            key = next(iter(self._models))
+            self._drop(key)
+            self.stats.evictions += 1
+            log_it("INFO: evicted model %s from the registry", 2, key)
+
+    def evict(self, path: typing.Union[str, Path]) -> bool:
+        """Drop the model loaded from PATH (and any files with the same contents, if
+        they're identified by hash), if there is one. Returns True if there was.
+        """
+        path = os.path.realpath(path)
+        with self._lock:
+            known = self._keys.get(path)
+            if (known is None) or (known[1] not in self._models):
+                return False
+            self._drop(known[1])
+            return True
+
+    def clear(self) -> None:
+        """Drop all of the loaded models."""
+        with self._lock:
+            self._models.clear()
+            self._keys.clear()
+
+    def memory_in_use(self) -> int:
+        """Return the estimated number of bytes taken up by the loaded models."""
+        with self._lock:
+            return sum(size for model, size in self._models.values())
+
+    def __contains__(self, path: typing.Union[str, Path]) -> bool:
+        """Is the current version of the file at PATH loaded?"""
+        path = os.path.realpath(path)
+        try:
+            key = self._key(path)[0]
+        except FileNotFoundError:
+            return False
+        with self._lock:
+            return key in self._models
+
+    def __len__(self) -> int:
+        return len(self._models)
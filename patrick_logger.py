@@ -3,6 +3,12 @@
 the standard library module is way more than needed. Several of my
 scripts depend on this module.
 
+It is now a thin layer over the standard library's logging module:
+messages go to a logger named 'patrick_logger', which prints them to
+standard output unless it's been reconfigured. Messages can be passed
+as %-style format strings with separate arguments, in which case they
+are only formatted if they're actually going to be emitted.
+
 GPL v3+ at your option. No guarantees or representations of fitness
 or warranties apply. This is free software; you're getting more than
 what you paid for. Nevertheless, I'd love to hear suggestions or
@@ -11,17 +17,53 @@ feedback if anything occurs to you.
 http://patrickbrianmooney.nfshost.com/~patrick/
 
 v1, 7 October 2015. 
+v2, deferred formatting on top of the logging module.
 """ 
 
+import logging
+
+
 # Can set the starting level above zero explicitly when debugging, esp. when debugging command-line options
 verbosity_level = 0
 
-def log_it(message,minimum_level=1):
+
+class _PrintHandler(logging.Handler):
+    """Emit log records with print(), so that they follow sys.stdout even if it's
+    replaced after this module is imported.
+    """
+    def emit(self, record):
+        try:
+            print(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+logger = logging.getLogger('patrick_logger')
+logger.setLevel(1)
+logger.addHandler(_PrintHandler())
+logger.propagate = False
+
+
+def _logging_level(minimum_level):
+    """Translate a verbosity-based MINIMUM_LEVEL into a level for the logging module."""
+    return max(logging.INFO - minimum_level, 1)
+
+
+def log_enabled(minimum_level=1):
+    """Return True if a message at MINIMUM_LEVEL would actually be emitted. Use this to
+    guard logging that's expensive to prepare.
+    """
+    return verbosity_level >= minimum_level and logger.isEnabledFor(_logging_level(minimum_level))
+
+
+def log_it(message, minimum_level=1, *args):
     """Add a message to the log if verbosity_level is at least minimum_level.
-    Currently, the log goes to standard output.
+    Currently, the log goes to standard output. If ARGS are supplied, MESSAGE is
+    a %-style format string that is only formatted if it's actually emitted.
     """
     if verbosity_level >= 4: # set verbosity to at least 4 to get this message output in the debug log
-        print("\nDEBUGGING: function log_it() called")
+        logger.log(_logging_level(4), "\nDEBUGGING: function log_it() called")
     if verbosity_level >= minimum_level:
-        print(message)
-
+        level = _logging_level(minimum_level)
+        if logger.isEnabledFor(level):
+            logger.log(level, message, *args)
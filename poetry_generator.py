@@ -24,9 +24,9 @@ class PoemGenerator(tg.TextGenerator):
     example of one.
     """
 
-    def train(self, the_files, markov_length=3, character_tokens=True):
+    def train(self, the_files, markov_length=3, character_tokens=True, **kwargs):
         """For now, we're just altering some defaults here"""
-        tg.TextGenerator.train(self, the_files=the_files, markov_length=markov_length, character_tokens=character_tokens)
+        tg.TextGenerator.train(self, the_files=the_files, markov_length=markov_length, character_tokens=character_tokens, **kwargs)
 
     def _printer(self, what, *pargs, **kwargs):
         """Override TextGenerator's printer method by just using standard built-in
@@ -1,4 +1,4 @@
-#!/usr/bin/python3.5
+#!/usr/bin/python3
 """A setup.py-style script to Cythonize poetry_generator.py. This is not necessary
 to use the module in the first place, but may result in performance benefits if
 it is done.
@@ -1,5 +1,6 @@
-#!/usr/bin/python3.5
-"""A setup.py-style script to Cythonize text_generator.py. This is not necessary
+#!/usr/bin/python3
+"""A setup.py-style script to Cythonize text_generator.py (and the chain_storage
+module that it uses). This is not necessary
 to use the module in the first place, but may result in performance benefits if
 it is done.
 
@@ -15,6 +16,6 @@ from Cython.Build import cythonize
 
 setup(
     name='text generator',
-    ext_modules=cythonize("text_generator.py"),
+    ext_modules=cythonize(["text_generator.py", "chain_storage.py"]),
     zip_safe=False,
 )
@@ -1,4 +1,4 @@
-#!/usr/bin/env python3.5
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """This is the actual code implementing Patrick Mooney's Markov chain-based
 text generator, separated into a separate module so that it can easily be
@@ -6,26 +6,49 @@ compiled with Cython.
 
 This module is licensed under the GNU GPL,either version 3, or (at your option)
 any later version. See the files README.md and LICENSE.md for more details.
+
+Importing this module is kept cheap, because gen_text.py is often run once per
+request (from cron, or as a CGI script), and starting up can take longer than
+generating the text. Modules that are only needed for some things (pickle and
+tempfile, for saving chains; token_cache, for caching tokens; text_handling, for
+capitalizing and printing what's generated) are imported in the functions that
+use them; and annotations aren't evaluated at run time, so typing and pathlib
+aren't imported at all, except by type checkers. benchmark.py's "startup" benchmark checks that
+this stays true.
 """
 
 
-import pickle
+from __future__ import annotations
+
+import bisect
+import codecs
+import collections
+import functools
+import io
+import itertools
+import locale
+import logging
+import operator
+import os
 import re
 import random
+import struct
+import threading
 import time
-import typing
+import types
 
-from pathlib import Path
+from array import array
 
-import text_handling as th          # https://github.com/patrick-brian-mooney/personal-library
+import chain_storage
 
 
-cython = None
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    import typing
 
-try:
-    import cython
-except Exception as errrr:
-    print("Unable to import cython! The system said: {}".format(errrr))
+    from pathlib import Path
+
+    from token_cache import TokenCache
 
 
 __author__ = "Patrick Mooney, http://patrickbrianmooney.nfshost.com/~patrick/"
@@ -35,14 +58,54 @@ __copyright__ = "Copyright (c) 2015-20 Patrick Mooney"
 __license__ = "GPL v3, or, at your option, any later version"
 
 
-# logging-related stubs
+# Logging. Messages go through the stdlib logging module, to a logger named 'text_generator' that (by default) prints
+# them to stdout, as this module always has; but anything that wants to route them elsewhere, or silence them, can
+# reconfigure that logger in the usual ways.
 verbosity_level = 1  # Bump above zero to get more verbose messages about processing and to skip the "are we running on a webserver?" check.
 
-def log_it(what, log_level=1):
-    """Handles logging to console, based on current verbosity_level. #FIXME: just use the stdlib logging module.
+
+class _PrintHandler(logging.Handler):
+    """Emit log records with print(), so that they follow sys.stdout even if it's
+    replaced after this module is imported.
+    """
+    def emit(self, record: logging.LogRecord):
+        try:
+            print(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+logger = logging.getLogger('text_generator')
+logger.setLevel(1)
+logger.addHandler(_PrintHandler())
+logger.propagate = False
+
+
+def _logging_level(log_level: int) -> int:
+    """Translate one of our verbosity-based LOG_LEVELs (0 is always shown; higher numbers
+    are more verbose) into a level for the stdlib logging module.
+    """
+    return max(logging.INFO - log_level, 1)
+
+
+def log_enabled(log_level: int=1) -> bool:
+    """Return True if a message at LOG_LEVEL would actually be emitted. Use this to
+    guard any logging that's expensive to prepare, beyond just formatting the message.
+    """
+    return log_level <= verbosity_level and logger.isEnabledFor(_logging_level(log_level))
+
+
+def log_it(what: str, log_level: int=1, *args):
+    """Log WHAT, if the current verbosity_level is at least LOG_LEVEL. If ARGS are
+    supplied, WHAT is a %-style format string and ARGS are its arguments; formatting
+    is put off until the message is actually emitted, and never happens at all if
+    it's not, so that (say) logging the whole mapping costs nothing unless someone's
+    going to see it.
     """
     if log_level <= verbosity_level:
-        print(what)
+        level = _logging_level(log_level)
+        if logger.isEnabledFor(level):
+            logger.log(level, what, *args)
 
 
 # Basic declarations about English-language text.
@@ -52,14 +115,26 @@ punct_with_no_space_before = r'.,!?;—․-:/'
 punct_with_no_space_after = r'—-/․'             # Note: that last character is U+2024, "one-dot leader".
 word_punct = r"'’❲❳%°#․$"                       # Punctuation marks to be considered part of a word.
 token_punct = r".,:\-!?;—/&…⸻"              # These punctuation marks also count as tokens.
+_partial_word_at_end = re.compile(r"[\w%s]*\Z" % word_punct)     # Used to find words split across chunks of text.
 
 
 # First, some utility functions.
 def _is_cythonized() -> bool:
-    if cython:
-        return cython.compiled
-    else:
-        return False
+    return not isinstance(_is_cythonized, types.FunctionType)      # Compiled functions aren't Python functions.
+
+
+_acronym_ending_sentence = re.compile(r'([A-Z]\.){2,}\s[A-Z]', re.UNICODE)     # Acronym-whitespace-capital letter.
+_acronym = re.compile(r'(?:(?<=\.|\s)[A-Z]\.)+', re.UNICODE)
+_acronym_safe_split = re.compile(r'.*\s(?=[^A-Z])', re.DOTALL)      # Finds the last whitespace not followed by a capital.
+
+
+def _end_acronym_sentence(match: typing.Match) -> str:
+    """Replace the periods in the sentence-ending acronym matched by MATCH with one-dot
+    leaders, and add a sentence-ending period after it.
+    """
+    text = match.group()
+    last_period = text.rfind('.')
+    return text[:1 + last_period].replace('.', '․') + '.' + text[1 + last_period:]
 
 
 def process_acronyms(text: str) -> str:
@@ -67,44 +142,152 @@ def process_acronyms(text: str) -> str:
     and converts their periods to one-dot leaders to make the Markov parser treat
     the acronym as a single word. Returns the modified string.
 
-    This function is NEVER called directly by any other routine in this file;
-    it's a convenience function for code that uses this module. This may change
-    in the future, if extensive testing shows there are very very few incorrect
+    This function is never called automatically; pass process_acronyms_in_chunks to
+    TextGenerator.train() (or _train_from_text()) as one of its PREPROCESSORS to
+    have it applied to the training texts as they're read. This may change in the
+    future, if extensive testing shows there are very very few incorrect
     corrections made.
     """
-    remaining_to_process = text[:]
-    ret = ""
-
-    # First, search for and deal with sentence-ending acronyms. Doing this requires replacing their dots with a
-    # one-dot leader, and then adding a sentence-ending period so the chain parser knows that there's sentence-ending
-    # punctuation in the text.
-    while remaining_to_process:
-        match = re.search(r'([A-Z]\.){2,}\s[A-Z]', remaining_to_process, re.UNICODE) # Find acronym-whitespace-capital letter
-        if match:
-            ret += remaining_to_process[:match.start()]
-            last_period = remaining_to_process[match.start() : match.end()].rfind('.')
-            ret += remaining_to_process[match.start() : 1 + match.start() + last_period].replace('.', '․')
-            ret += '.'
-            ret += remaining_to_process[1 + match.start()+last_period : match.end()]
-            remaining_to_process = remaining_to_process[match.end():]
-        else:
-            ret += remaining_to_process
-            remaining_to_process = ""
-
-    # Now, deal with any remaining unprocessed acronyms.
-    remaining_to_process, ret = ret, ""
-    while remaining_to_process:
-        match = re.search(r'(?:(?<=\.|\s)[A-Z]\.)+', remaining_to_process, re.UNICODE)
-        if match:
-            ret += remaining_to_process[:match.start()]
-            ret += remaining_to_process[match.start():match.end()].replace('.', '․')        # Replace periods with one-dot leaders
-            remaining_to_process = remaining_to_process[match.end():]   # Lop off the part we've processed.
-        else:
-            ret += remaining_to_process
-            remaining_to_process = ""
+    # First, deal with sentence-ending acronyms. Doing this requires replacing their dots with a one-dot leader, and
+    # then adding a sentence-ending period so the chain parser knows that there's sentence-ending punctuation in the
+    # text. Then deal with any remaining unprocessed acronyms.
+    text = _acronym_ending_sentence.sub(_end_acronym_sentence, text)
+    return _acronym.sub(lambda m: m.group().replace('.', '․'), text)
+
+
+def process_acronyms_in_chunks(chunks: typing.Iterable[str]) -> typing.Iterator[str]:
+    """Do what process_acronyms() does to a text that arrives as a series of CHUNKS,
+    yielding the processed text a piece at a time. The result, joined together, is
+    exactly what process_acronyms() would produce from all of CHUNKS joined together:
+    each piece ends just before a whitespace character that isn't followed by a
+    capital letter, and no acronym can span a point like that, so the rest of the
+    text is carried over to be processed along with the next chunk.
+    """
+    carry = ""
+    for chunk in chunks:
+        carry += chunk
+        split = _acronym_safe_split.match(carry)
+        if split:
+            yield process_acronyms(carry[:split.end() - 1])
+            carry = carry[split.end() - 1:]
+    if carry:
+        yield process_acronyms(carry)
+
+
+def _split_for_workers(the_files: typing.Iterable[typing.Union[str, bytes, Path]],
+                       pieces: int) -> typing.List[typing.List[tuple]]:
+    """Divide THE_FILES into about PIECES shards of roughly equal size, for training in
+    parallel. Large files are split into byte ranges, always just after a newline so
+    that no word (and no multi-byte character) is split. Returns a list of shards,
+    in order; each shard is a list of (file, start, end, is_beginning_of_file)
+    segments.
+    """
+    sizes = [os.path.getsize(f) for f in the_files]
+    target = max(sum(sizes) // max(pieces, 1), 1)
+    ret = list()
+    for which_file, size in zip(the_files, sizes):
+        start = 0
+        with open(which_file, 'rb') as the_file:
+            while True:
+                the_file.seek(min(start + target, size))
+                the_file.readline()                     # Move to the beginning of the next line.
+                end = min(the_file.tell(), size)
+                if size - end < target // 2:            # Don't leave a tiny shard at the end of the file.
+                    end = size
+                ret.append([(which_file, start, end, start == 0)])
+                if end >= size:
+                    break
+                start = end
     return ret
 
 
+def _read_segments(segments: typing.Iterable[tuple],
+                   chunk_size: int=1024 * 1024) -> typing.Iterator[str]:
+    """Read the byte ranges in SEGMENTS, as produced by _split_for_workers(), and yield
+    their text in chunks, decoded and with newlines translated just as open() would do
+    in text mode. A newline is yielded before the beginning of each file, just as
+    TextGenerator._read_chunks() does.
+    """
+    for which_file, start, end, is_beginning in segments:
+        if is_beginning:
+            yield '\n'
+        decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(locale.getpreferredencoding(False))(), translate=True)
+        with open(which_file, 'rb') as the_file:
+            the_file.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                data = the_file.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield decoder.decode(data)
+            yield decoder.decode(b'', final=True)
+
+
+def _train_shard(generator_class: type,
+                 segments: typing.List[tuple],
+                 markov_length: int,
+                 character_tokens: bool,
+                 first_shard: bool) -> tuple:
+    """Train a partial model on one shard of the training text, in a worker process.
+    Returns (temporary mapping, start counts, first tokens, last tokens, token count); the
+    first and last MARKOV_LENGTH tokens are what the parent process needs to add the
+    histories that span the boundaries between shards. The first shard is trained
+    exactly as the beginning of the whole text would be; the others are trained as
+    continuations of the text before them.
+    """
+    genny = generator_class()
+    head, tail, count = list(), collections.deque(maxlen=markov_length), 0
+
+    def watched(tokens):
+        nonlocal count
+        for t in tokens:
+            if count < markov_length:
+                head.append(t)
+            tail.append(t)
+            count += 1
+            yield t
+
+    tokens = watched(genny._token_stream(_read_segments(segments), character_tokens=character_tokens))
+    if first_shard:
+        genny._build_mapping(tokens, markov_length=markov_length, character_tokens=character_tokens)
+    else:
+        genny._add_history_pairs(genny._history_pairs(tokens, markov_length, continuation=True))
+    return genny.the_temp_mapping, genny.the_start_counts, head, list(tail), count
+
+
+_worker_generator = None        # In a worker process for parallel generation, the generator it uses; see TextGenerator._gen_in_parallel().
+
+
+def _inherit_generation_worker(generator: TextGenerator) -> None:
+    """Set up a worker process for parallel generation that was forked from the process
+    that's generating the text, so that it can simply use GENERATOR, that process's
+    generator, which it inherits rather than receiving a pickled copy.
+    """
+    global _worker_generator
+    _worker_generator = generator
+
+
+def _init_generation_worker(generator_class: type,
+                            chains_file: str,
+                            attributes: dict) -> None:
+    """Set up a worker process for parallel generation that wasn't forked, and so
+    can't inherit the parent's generator: create a new GENERATOR_CLASS, memory-map
+    the chains saved in CHAINS_FILE, and copy the parent's other ATTRIBUTES.
+    """
+    global _worker_generator
+    _worker_generator = generator_class()
+    _worker_generator.chains.read_chains(chains_file)
+    vars(_worker_generator).update(attributes)
+
+
+def _gen_paragraphs(plan: typing.List[typing.Tuple[int, int]]) -> typing.List[str]:
+    """Generate, in a worker process, a paragraph for each (number of sentences, seed)
+    in PLAN. See TextGenerator._paragraph_plan().
+    """
+    return [_worker_generator._gen_paragraph(sentences, random.Random(seed)) for sentences, seed in plan]
+
+
 def to_hash_key(lst: list) -> tuple:
     """Tuples can be hashed; lists can't.  We need hashable values for dict keys.
     This looks like a hack (and it is, a little) but in practice it doesn't
@@ -145,6 +328,7 @@ def fix_caps(word: str) -> str:
         word = word.lower()                 # isupper() looks at whether the WHOLE STRING IS CAPITALIZED, not whether it HAS CAPS IN IT.
         # Ex: "LaTeX" => "Latex"            # So this example doesn't actually describe what's going on.
     elif word[0].isupper():
+        import text_handling as th      # https://github.com/patrick-brian-mooney/personal-library
         word = th.capitalize(word.lower())  # I keep meaning to report this as a bug. #FIXME
         # Ex: "wOOt" -> "woot"
     else:
@@ -152,6 +336,422 @@ def fix_caps(word: str) -> str:
     return word
 
 
+class SubstitutionEngine(object):
+    """A compiled form of a list of substitutions, in the format of a TextGenerator's
+    .final_substitutions list (i.e., [regex to search for, replacement] pairs). apply()
+    produces the same result as text_handling.multi_replace(): the substitutions are
+    made in order, and the whole list is run over and over until the text stops
+    changing. But it's faster, because
+
+      * each regex is compiled only once, when the engine is built, and is skipped
+        without being run at all if the text doesn't contain a literal string that
+        every match must contain;
+      * a substitution whose search pattern is really just a literal string is made
+        with str.replace(), which is far cheaper than a regex search;
+      * long runs of consecutive literal substitutions are fused into a single pass
+        over the text (with str.translate() if they're all single characters, or a
+        single regex alternation otherwise), but only when that provably produces the
+        same text as making them one after another: see _fusable().
+
+    On paragraph-length text, a str.replace() that finds nothing is so cheap that
+    a fused pass only pays for itself once it replaces dozens of them; that's what
+    .fusion_threshold is for.
+    """
+    fusion_threshold = 64       # Only runs of at least this many fusable literal substitutions are fused.
+
+    def __init__(self, substitutions: typing.Iterable[typing.Sequence[str]]):
+        self.source = [(search, replace) for search, replace in substitutions]
+        self.steps = list()             # Each step is a function taking and returning a string.
+        run = list()                    # Consecutive literal substitutions that can be fused into a single step.
+        for search, replace in self.source:
+            literal = self._literal(search)
+            if literal and isinstance(replace, str) and ('\\' not in replace):
+                if not self._fusable(run, literal):
+                    self._add_literal_step(run)
+                    run = list()
+                run.append((literal, replace))
+            else:
+                self._add_literal_step(run)
+                run = list()
+                self.steps.append(self._regex_step(re.compile(search).sub, replace, self._required_literal(search)))
+        self._add_literal_step(run)
+
+    @staticmethod
+    def _literal(pattern: str) -> typing.Optional[str]:
+        """If PATTERN, a regex, only ever matches one literal string, return that string;
+        otherwise, return None. Errs on the side of returning None.
+        """
+        if not isinstance(pattern, str):
+            return None
+        ret, chars = list(), iter(pattern)
+        for c in chars:
+            if c == '\\':
+                c = next(chars, '')
+                if (not c) or c.isalnum() or c == '_':      # \d, \1, \A, etc., or a trailing backslash.
+                    return None
+            elif c in '.^$*+?{}[]|()':
+                return None
+            ret.append(c)
+        return ''.join(ret)
+
+    @staticmethod
+    def _required_literal(pattern: str) -> typing.Optional[str]:
+        """Return the longest literal string that every match for PATTERN, a regex, must
+        contain, or None if there isn't one (or if PATTERN is too complicated to tell).
+        Only looks at the top level of PATTERN, outside of groups and character sets.
+        """
+        if (not isinstance(pattern, str)) or ('(?' in pattern):     # Inline flags could change what matches.
+            return None
+        runs, current, depth, i = list(), list(), 0, 0
+        while i < len(pattern):
+            c, literal = pattern[i], None
+            if c == '\\':
+                i += 1
+                if (i < len(pattern)) and not (pattern[i].isalnum() or pattern[i] == '_'):
+                    literal = pattern[i]
+            elif c == '[':                                          # Skip the whole character set.
+                i += 1
+                if pattern[i:i + 1] == '^':
+                    i += 1
+                if pattern[i:i + 1] == ']':
+                    i += 1
+                while (i < len(pattern)) and (pattern[i] != ']'):
+                    i += 2 if (pattern[i] == '\\') else 1
+            elif c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+            elif (c == '|') and (depth == 0):
+                return None
+            elif c not in '.^$*+?{}':
+                literal = c
+            i += 1
+            if (literal is not None) and (depth == 0) and (pattern[i:i + 1] not in ('*', '+', '?', '{')):
+                current.append(literal)
+            else:
+                runs.append(''.join(current))
+                current = list()
+        runs.append(''.join(current))
+        return max(runs, key=len) or None
+
+    @staticmethod
+    def _regex_step(sub: typing.Callable[[str, str], str],
+                    replace: str,
+                    required: typing.Optional[str]) -> typing.Callable[[str], str]:
+        """Return a step that calls SUB, the .sub method of a compiled regex, with REPLACE,
+        but only if REQUIRED (if it's not None) occurs in the text.
+        """
+        if required is None:
+            return functools.partial(sub, replace)
+        return lambda text: sub(replace, text) if (required in text) else text
+
+    @staticmethod
+    def _fusable(run: typing.List[typing.Tuple[str, str]],
+                 search: str) -> bool:
+        """Return True if a literal substitution for SEARCH can be made in the same pass as
+        the literal substitutions in RUN, which come before it. This is so if no
+        replacement in RUN can create a new occurrence of SEARCH (i.e., none is empty,
+        which could join text on either side of it, and none shares any characters with
+        SEARCH); and if no occurrence of SEARCH can overlap any occurrence of one of the
+        earlier search strings, so that making one substitution can't prevent another.
+        """
+        for earlier, replacement in run:
+            if (not replacement) or (set(replacement) & set(search)):
+                return False
+            if (earlier in search) or (search in earlier):
+                return False
+            if any(earlier.endswith(search[:i]) or search.endswith(earlier[:i]) for i in range(1, min(len(earlier), len(search)))):
+                return False
+        return True
+
+    def _add_literal_step(self, run: typing.List[typing.Tuple[str, str]]) -> None:
+        """Add a step that makes all of the literal substitutions in RUN at once, or (if
+        there aren't enough of them to be worth fusing) a step for each.
+        """
+        if len(run) < self.fusion_threshold:
+            for search, replace in run:
+                self.steps.append(operator.methodcaller('replace', search, replace))
+        elif all(len(search) == 1 for search, replace in run):
+            self.steps.append(operator.methodcaller('translate', str.maketrans(dict(run))))
+        else:
+            replacements = dict(run)
+            self.steps.append(functools.partial(re.compile('|'.join(re.escape(search) for search, replace in run)).sub,
+                                                lambda m: replacements[m.group()]))
+
+    def compiled_from(self, substitutions: typing.Sequence[typing.Sequence[str]]) -> bool:
+        """Return True if this engine was compiled from a list equal to SUBSTITUTIONS."""
+        return (len(substitutions) == len(self.source)) and all((s[0] == search) and (s[1] == replace)
+                                                                for s, (search, replace) in zip(substitutions, self.source))
+
+    def apply(self, text: str) -> str:
+        """Make all of the substitutions in TEXT, repeatedly, until it stops changing."""
+        while True:
+            previous = text
+            for step in self.steps:
+                text = step(text)
+            if text == previous:
+                return text
+
+
+class GenerationStats(object):
+    """Counters describing what a TextGenerator has been doing while generating text.
+    Collecting them is opt-in: see TextGenerator.enable_stats(). The counters are:
+
+      .sentences    sentences produced;
+      .tokens       tokens in those sentences;
+      .samples      tokens picked from the chains (including those in sentences
+                    that were thrown away), i.e. every token but the first in each
+                    attempted sentence;
+      .retries      sentences thrown away and begun again because they were
+                    unacceptable (see TextGenerator._acceptable_sentence());
+      .dead_ends    times no history at all was found for the tokens so far, so that
+                    the sentence was ended with a period;
+      .backoffs     a Counter mapping "backoff depth" (how many tokens had to be
+                    dropped from the beginning of the history before it was found in
+                    the chains) to how many times that happened. Only depths of one
+                    or more are counted as they happen, so that the common case costs
+                    nothing; backoff_histogram() fills in depth zero;
+      .seconds      a dictionary of the time spent in each stage of producing text:
+                    'sampling' (building sentences), 'substitutions' (making the
+                    final substitutions), and 'printing'.
+
+    Several threads (say, the workers of a SentencePool) may generate text at once,
+    so the counters are only ever changed while holding .lock.
+    """
+    stages = ('sampling', 'substitutions', 'printing')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Set all of the counters back to zero."""
+        with self.lock:
+            self.sentences, self.tokens, self.samples, self.retries, self.dead_ends = 0, 0, 0, 0, 0
+            self.backoffs = collections.Counter()
+            self.seconds = dict.fromkeys(self.stages, 0.0)
+
+    def backoff_histogram(self) -> typing.Dict[int, int]:
+        """Return a dictionary mapping each backoff depth to the number of tokens that were
+        picked at that depth. Dead ends aren't included. Depth zero is worked out from
+        .samples, which is counted a sentence at a time, so it doesn't include tokens
+        picked by calling next() directly.
+        """
+        ret = {0: max(self.samples - sum(self.backoffs.values()) - self.dead_ends, 0)}
+        ret.update(sorted(self.backoffs.items()))
+        return ret
+
+    def as_dict(self) -> dict:
+        """Return all of the counters as a dictionary (suitable for, say, JSON)."""
+        with self.lock:
+            return {'sentences': self.sentences,
+                    'tokens': self.tokens,
+                    'samples': self.samples,
+                    'retries': self.retries,
+                    'dead_ends': self.dead_ends,
+                    'backoffs': self.backoff_histogram(),
+                    'seconds': dict(self.seconds)}
+
+    def __str__(self) -> str:
+        ret = ["Sentences: %d" % self.sentences,
+               "Tokens: %d (%d picked from the chains)" % (self.tokens, self.samples),
+               "Retries: %d" % self.retries,
+               "Dead ends: %d" % self.dead_ends,
+               "Backoff depths: %s" % ', '.join('%d: %d' % i for i in self.backoff_histogram().items())]
+        ret.extend("Time spent in %s: %.4f seconds" % i for i in self.seconds.items())
+        return '\n'.join(ret)
+
+    def prometheus(self, prefix: str='text_generator') -> str:
+        """Return the counters in the Prometheus text exposition format, with metric names
+        beginning with PREFIX.
+        """
+        ret = list()
+
+        def metric(name: str, help_text: str, values: typing.Iterable[typing.Tuple[str, typing.Union[int, float]]]):
+            ret.append('# HELP %s_%s %s' % (prefix, name, help_text))
+            ret.append('# TYPE %s_%s counter' % (prefix, name))
+            ret.extend('%s_%s%s %s' % (prefix, name, labels, value) for labels, value in values)
+
+        metric('sentences_total', 'Sentences produced.', [('', self.sentences)])
+        metric('tokens_total', 'Tokens in the sentences produced.', [('', self.tokens)])
+        metric('samples_total', 'Tokens picked from the chains.', [('', self.samples)])
+        metric('retries_total', 'Unacceptable sentences that were thrown away.', [('', self.retries)])
+        metric('dead_ends_total', 'Sentences ended because no history matched.', [('', self.dead_ends)])
+        metric('backoffs_total', 'Tokens picked, by how many tokens of history had to be dropped.',
+               [('{depth="%d"}' % depth, count) for depth, count in self.backoff_histogram().items()])
+        metric('stage_seconds_total', 'Time spent in each stage of producing text.',
+               [('{stage="%s"}' % stage, seconds) for stage, seconds in self.seconds.items()])
+        return '\n'.join(ret) + '\n'
+
+
+class CompactionReport(object):
+    """What pruning or quantizing a set of chains (see MarkovChainTextModel.prune() and
+    .quantize()) did to them:
+
+      .histories    (before, after): the number of histories in the chains;
+      .followers    (before, after): the number of (history, follower) pairs;
+      .mean_drift   the total variation distance between each history's followers'
+                    probabilities before and after (that is, the share of the
+                    probability that moved to different followers), averaged over the
+                    histories that are left, weighted by how often each occurred in
+                    training (if the chains know that; otherwise, all count the same);
+      .max_drift    the largest total variation distance for any single history.
+    """
+    def __init__(self, mapping: typing.Mapping[tuple, typing.Mapping[str, float]]):
+        self.histories = (len(mapping), None)
+        self.followers = (sum(len(f) for f in mapping.values()), None)
+        self.max_drift, self._drift, self._weight = 0.0, 0.0, 0.0
+
+    def add(self, drift: float,
+            weight: typing.Union[float, int]=1) -> None:
+        """Note that the followers of one history drifted by DRIFT. WEIGHT is how often the
+        history occurred.
+        """
+        self._drift += drift * weight
+        self._weight += weight
+        self.max_drift = max(self.max_drift, drift)
+
+    def finish(self, mapping: typing.Mapping[tuple, typing.Mapping[str, float]]) -> None:
+        """Note the size of MAPPING, the chains as they are afterwards."""
+        self.histories = (self.histories[0], len(mapping))
+        self.followers = (self.followers[0], sum(len(f) for f in mapping.values()))
+
+    @property
+    def mean_drift(self) -> float:
+        return (self._drift / self._weight) if self._weight else 0.0
+
+    def as_dict(self) -> dict:
+        """Return the report as a dictionary (suitable for, say, JSON)."""
+        return {'histories': self.histories,
+                'followers': self.followers,
+                'mean_drift': self.mean_drift,
+                'max_drift': self.max_drift}
+
+    def __str__(self) -> str:
+        return '\n'.join(["Histories: %d -> %d" % self.histories,
+                          "Followers: %d -> %d" % self.followers,
+                          "Drift: %.6f on average, %.6f at most" % (self.mean_drift, self.max_drift)])
+
+
+class SentencePool(object):
+    """A bounded buffer of sentences made ahead of time by background threads, so that
+    whoever needs a sentence usually just takes one that's already finished instead
+    of waiting while it's built. See TextGenerator.enable_pool().
+
+    PRODUCE is a function taking no arguments that returns one finished sentence.
+    WORKERS threads call it until SIZE sentences are waiting, then stop until no
+    more than LOW_WATER (by default, a quarter of SIZE) are left, then fill the
+    buffer up again. If MAX_AGE is not None, sentences that have been waiting for
+    more than MAX_AGE seconds are thrown away rather than handed out. If the buffer
+    is empty when a sentence is wanted, one is made on the spot, just as if there
+    were no buffer at all.
+
+    The counters .hits, .misses, and .expired record how many sentences were taken
+    from the buffer, made on the spot because it was empty, and thrown away because
+    they were too old.
+
+    A worker that runs into an error while making a sentence logs it and stops. Once
+    every worker has stopped this way, the pool is dead (.dead is True, and .error is
+    the exception that stopped the last worker): it holds no sentences, and get()
+    raises RuntimeError instead of quietly making every sentence on the spot.
+    """
+    def __init__(self, produce: typing.Callable[[], str],
+                 size: int=256,
+                 workers: int=1,
+                 low_water: typing.Optional[int]=None,
+                 max_age: typing.Optional[float]=None):
+        assert size >= 1, "ERROR: the pool must be able to hold at least one sentence!"
+        assert workers >= 1, "ERROR: the pool needs at least one worker thread!"
+        self.produce, self.size, self.max_age = produce, size, max_age
+        self.low_water = (size // 4) if (low_water is None) else min(low_water, size - 1)
+        self.hits, self.misses, self.expired = 0, 0, 0
+        self.error = None                       # The exception that stopped the most recent worker to fail.
+        self._alive = workers                   # Number of workers that haven't failed.
+        self._ready = collections.deque()       # (time made, sentence) pairs, oldest first.
+        self._filling = True                    # Are the workers filling the buffer (as opposed to waiting for it to drain)?
+        self._closed = False
+        self._changed = threading.Condition()
+        self._workers = [threading.Thread(target=self._fill, name='SentencePool-%d' % i, daemon=True) for i in range(workers)]
+        for w in self._workers:
+            w.start()
+
+    def _fill(self) -> None:
+        """Keep the buffer topped up until the pool is closed. Runs in each worker thread."""
+        while True:
+            with self._changed:
+                while not (self._filling or self._closed):
+                    self._changed.wait()
+                if self._closed:
+                    return
+            try:
+                sent = self.produce()
+            except Exception as errrr:
+                log_it("ERROR: a sentence pool worker stopped because of an error: %s", 1, errrr)
+                with self._changed:
+                    self.error = errrr
+                    self._alive -= 1
+                    if self.dead:
+                        self._ready.clear()
+                        log_it("ERROR: every sentence pool worker has stopped; the pool is dead.", 1)
+                return
+            with self._changed:
+                self._ready.append((time.monotonic(), sent))
+                if len(self._ready) >= self.size:
+                    self._filling = False
+
+    def _discard_expired(self) -> None:
+        if self.max_age is not None:
+            oldest = time.monotonic() - self.max_age
+            while self._ready and self._ready[0][0] < oldest:
+                self._ready.popleft()
+                self.expired += 1
+
+    @property
+    def dead(self) -> bool:
+        """True if every worker has stopped because of an error."""
+        return self._alive <= 0
+
+    def get(self) -> str:
+        """Return a finished sentence: from the buffer, if there's one there, or else a new
+        one made right now. Raises RuntimeError if the pool is dead.
+        """
+        with self._changed:
+            if self.dead:
+                raise RuntimeError("ERROR: every worker in the sentence pool has stopped because of an error!") from self.error
+            self._discard_expired()
+            sent = self._ready.popleft()[1] if self._ready else None
+            if (not self._filling) and (len(self._ready) <= self.low_water):
+                self._filling = True
+                self._changed.notify_all()
+            if sent is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return self.produce() if (sent is None) else sent
+
+    def clear(self) -> None:
+        """Throw away all of the waiting sentences (say, because the chains have changed)
+        and start filling the buffer again.
+        """
+        with self._changed:
+            self._ready.clear()
+            self._filling = True
+            self._changed.notify_all()
+
+    def close(self) -> None:
+        """Stop the worker threads and throw away the waiting sentences."""
+        with self._changed:
+            self._closed = True
+            self._ready.clear()
+            self._changed.notify_all()
+        for w in self._workers:
+            if w is not threading.current_thread():
+                w.join()
+
+    def __len__(self) -> int:
+        return len(self._ready)
+
+
 class MarkovChainTextModel(object):
     """Chains representing a model of a text."""
     def __init__(self):
@@ -161,41 +761,438 @@ class MarkovChainTextModel(object):
         self.mapping = None         # Dictionary representing the Markov chains.
         self.character_tokens = False   # True if the chains are characters, False if they are words.
         self.finalized = False
-
-    def store_chains(self, filename: typing.Union[str, Path]):
-        """Shove the relevant chain-based data into a dictionary, then pickle it and
-        store it in the designated file.
+        self.sampling_index = None      # Derived from .mapping; see build_sampling_index().
+        self.start_weights = None       # Running totals of how often each of .starts began a sentence in training.
+        self.weighted_starts = False    # If True, choose_start() favors the starts that were most common in training.
+        self.totals = None              # How many times each history occurred in training; lets update() add more text.
+        self.automaton = None           # A chain_storage.ChainAutomaton, if compile_automaton() has been called.
+        self.read_only = False          # True if these chains are shared (say, by a model_registry.ModelRegistry).
+        self.weight_bits = None         # 8 or 16, if quantize() has been called; binary files then store quantized weights.
+
+    legacy_extensions = ('.pkl', '.pickle')     # store_chains() writes files with these extensions as pickles.
+
+    @classmethod
+    def file_format_for(cls, filename: typing.Union[str, Path]) -> str:
+        """Return the format ('binary' or 'pickle') that store_chains() uses for FILENAME
+        unless told otherwise: 'pickle' if its extension (ignoring any compression
+        extension after it) is one of .legacy_extensions, and 'binary' otherwise.
+        """
+        extension = os.path.splitext(chain_storage.uncompressed_name(filename))[1]
+        return 'pickle' if extension.lower() in cls.legacy_extensions else 'binary'
+
+    def store_chains(self, filename: typing.Union[str, Path],
+                     file_format: typing.Optional[str]=None,
+                     compression: typing.Optional[str]=None) -> bool:
+        """Store the chains in FILENAME. FILE_FORMAT is either 'binary' or 'pickle'; if it
+        is None (the default), files whose names end in one of the extensions in
+        .legacy_extensions are pickled, and everything else is written in the binary
+        format described in chain_storage.
+
+        The binary format is what you want for large models: read_chains() memory-maps
+        it instead of reading the whole thing into memory, so models become usable
+        almost immediately and processes using the same file share a single copy of it.
+        Pickle files are a legacy option, kept so that older versions of this module
+        (and other code that unpickles chains files) can still read them.
+
+        Either format can be compressed with gzip, bz2, or lzma: pass one of those as
+        COMPRESSION, or leave it None and give FILENAME an extension of .gz, .bz2, or
+        .xz (after the usual one, as in chains.pkl.gz). 'none' means don't compress,
+        whatever the extension. The chains are compressed as they're written, rather
+        than being built up in memory first. Compressed files are much smaller, but
+        binary ones can't be memory-mapped when they're read back in.
+
+        Returns True if the chains were stored, or False (after logging the reason) if
+        they couldn't be.
         """
-        chains_dictionary = { 'the_starts': self.starts,
+        if file_format is None:
+            file_format = self.file_format_for(filename)
+        assert file_format in ('binary', 'pickle'), "ERROR: unknown chains file format %s!" % file_format
+        compression = chain_storage.compression_for(filename, compression)
+        import pickle, tempfile
+
+        if file_format == 'binary':
+            # Write to a temporary file first, then move it into place: FILENAME may be the
+            # very file that these chains are memory-mapped from.
+            temp_name = None
+            try:
+                with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(filename)), delete=False) as the_chains_file:
+                    temp_name = the_chains_file.name
+                    with chain_storage.open_compressed(the_chains_file, 'wb', compression) as the_stream:
+                        self._write_binary(the_stream)
+                chain_storage.replace_file(temp_name, filename)
+            except IOError as e:
+                log_it("ERROR: Can't write chains to %s; the system said '%s'.", 0, filename, e)
+                if temp_name and os.path.exists(temp_name):
+                    os.remove(temp_name)
+                return False
+            return True
+
+        try:
+            with chain_storage.open_compressed(filename, 'wb', compression) as the_chains_file:
+                self._write_pickle(the_chains_file)
+        except IOError as e:
+            log_it("ERROR: Can't write chains to %s; the system said '%s'.", 0, filename, e)
+            return False
+        except pickle.PickleError as e:
+            log_it("ERROR: Can't write chains to %s because a pickling error occurred; the system said '%s'.", 0, filename, e)
+            return False
+        return True
+
+    def _write_binary(self, the_file: typing.BinaryIO) -> None:
+        chain_storage.write_chains_file(the_file, mapping=self.mapping, starts=self.starts,
+                                        markov_length=self.markov_length, character_tokens=self.character_tokens,
+                                        start_weights=self.start_weights, history_totals=self.totals,
+                                        weight_bits=self.weight_bits)
+
+    def _write_pickle(self, the_file: typing.BinaryIO) -> None:
+        chains_dictionary = { 'the_starts': list(self.starts),     # Copies, in case they're views onto a binary file.
                               'markov_length': self.markov_length,
                               'the_mapping': self.mapping,
-                              'character_tokens': self.character_tokens }
+                              'character_tokens': self.character_tokens,
+                              'start_weights': None if self.start_weights is None else array('d', self.start_weights),
+                              'history_totals': None if self.totals is None else dict(self.totals),
+                              'weight_bits': self.weight_bits }
+        import pickle
+
+        the_pickler = pickle.Pickler(the_file, protocol=-1)    # Use the most efficient protocol possible
+        the_pickler.dump(chains_dictionary)
+
+    def stored_size(self, file_format: str='binary',
+                    compression: typing.Optional[str]=None) -> int:
+        """Return the number of bytes that store_chains() would write in FILE_FORMAT
+        ('binary' or 'pickle'), compressed with COMPRESSION (if it's not None), without
+        writing anything.
+        """
+        class Counter(object):
+            size = 0
+
+            def write(self, data: bytes) -> None:
+                self.size += len(data)
+
+            def flush(self) -> None:
+                pass
+
+        counter = Counter()
+        assert file_format in ('binary', 'pickle'), "ERROR: unknown chains file format %s!" % file_format
+        the_stream = chain_storage.open_compressed(counter, 'wb', None if compression == 'none' else compression)
+        (self._write_binary if file_format == 'binary' else self._write_pickle)(the_stream)
+        if the_stream is not counter:
+            the_stream.close()          # Flushes what's left in the compressor.
+        return counter.size
+
+    def read_chains(self, filename: typing.Union[str, Path],
+                    compression: typing.Optional[str]=None):
+        """Read the chain-based data from FILENAME, which may be either a binary chains
+        file (which is memory-mapped, rather than read into memory) or a legacy pickle
+        file; which it is is detected automatically. So is whether it's compressed
+        (see store_chains()), unless COMPRESSION says how it is ('none' if it isn't).
+        Compressed files are decompressed as they're read.
+        """
+        assert not self.read_only, "ERROR: these chains are shared, and can't be replaced!"
+        import pickle
+
         try:
-            with open(filename, 'wb') as the_chains_file:
-                the_pickler = pickle.Pickler(the_chains_file, protocol=-1)    # Use the most efficient protocol possible
-                the_pickler.dump(chains_dictionary)
+            if compression is None:
+                compression = chain_storage.detect_compression(filename)
+            else:
+                compression = chain_storage.compression_for(filename, compression)
+            is_binary = chain_storage.is_chains_file(filename, compression)
+            if is_binary:
+                mapping = chain_storage.open_chains_file(filename, compression)
         except IOError as e:
-            log_it("ERROR: Can't write chains to %s; the system said '%s'." % (filename, str(e)), 0)
-        except pickle.PickleError as e:
-            log_it("ERROR: Can't write chains to %s because a pickling error occurred; the system said '%s'." % (filename, str(e)), 0)
+            log_it("ERROR: Can't read chains from %s; the system said '%s'.", 0, filename, e)
+            return
+        except (struct.error, ValueError, TypeError, EOFError) as e:      # A truncated or corrupt binary file.
+            log_it("ERROR: Can't read chains from %s because the file is damaged; the system said '%s'.", 0, filename, e)
+            return
+        if is_binary:
+            self.mapping = mapping
+            self.markov_length = self.mapping.markov_length
+            self.starts = self.mapping.starts
+            self.character_tokens = self.mapping.character_tokens
+            self.start_weights = self.mapping.start_weights
+            self.totals = None if (self.mapping.totals is None) else collections.ChainMap(dict(), self.mapping.totals)
+            self.weight_bits = self.mapping.weight_bits
+            self.finalized = True
+            self.build_sampling_index()
+            return
 
-    def read_chains(self, filename: typing.Union[str, Path]):
-        """Read the pickled chain-based data from FILENAME."""
         default_chains = { 'character_tokens': False,       # We need only assign defaults for keys added in v2.0 and later.
+                           'start_weights': None,           # Added in v2.5.
+                           'history_totals': None,          # Added in v2.5.
+                           'weight_bits': None,             # Added in v2.5.
                           }                                 # the_starts, the_mapping, and markov_length have been around since 1.0.
         try:
-            with open(filename, 'rb') as the_chains_file:
+            with chain_storage.open_compressed(filename, 'rb', compression) as the_chains_file:
                 chains_dictionary = pickle.load(the_chains_file)
         except IOError as e:
-            log_it("ERROR: Can't read chains from %s; the system said '%s'." % (filename, str(e)), 0)
-        except pickle.PickleError as e:
-            log_it("ERROR: Can't read chains from %s because a pickling error occurred; the system said '%s'." % (filename, str(e)), 0)
+            log_it("ERROR: Can't read chains from %s; the system said '%s'.", 0, filename, e)
+            return
+        except (pickle.PickleError, EOFError) as e:        # A truncated pickle raises EOFError.
+            log_it("ERROR: Can't read chains from %s because a pickling error occurred; the system said '%s'.", 0, filename, e)
+            return
         chains_dictionary = apply_defaults(defaultargs=default_chains, args=chains_dictionary)
         self.markov_length = chains_dictionary['markov_length']
         self.starts = chains_dictionary['the_starts']
         self.mapping = chains_dictionary['the_mapping']
         self.character_tokens = chains_dictionary['character_tokens']
+        self.start_weights = chains_dictionary['start_weights']
+        self.totals = chains_dictionary['history_totals']
+        self.weight_bits = chains_dictionary['weight_bits']
         self.finalized = True
+        self.build_sampling_index()
+
+    def build_sampling_index(self):
+        """Build the "sampling index" for the chains: a structure that stores each
+        history's followers alongside the running totals of their probabilities, so
+        that sample() can pick a follower with a binary search, instead of walking the
+        whole set of followers for every token generated. This matters a great deal
+        for common histories with thousands of followers.
+
+        A plain dictionary mapping gets a chain_storage.SamplingIndex built from it,
+        or, if its tokens are single characters, a chain_storage.CharacterMapping,
+        which is smaller and lets TextGenerator generate characters without building
+        tuples (see TextGenerator._character_tokens()). The other storage backends in
+        chain_storage serve as their own sampling index. The index is not stored with
+        the chains, and needs to be rebuilt if .mapping is changed by hand after it's
+        been built. Rebuilding it throws away the compiled automaton, if there is one.
+        """
+        self.automaton = None
+        if hasattr(self.mapping, 'sample'):
+            self.sampling_index = self.mapping
+            return
+        if self.character_tokens:
+            try:
+                self.sampling_index = chain_storage.CharacterMapping(self.mapping)
+                return
+            except ValueError:          # Some tokens aren't single characters after all (e.g., comparison_form() made
+                pass                    # them longer); fall back to the general-purpose index.
+        self.sampling_index = chain_storage.SamplingIndex(self.mapping)
+
+    def sample(self, history: tuple,
+               index: float) -> typing.Optional[str]:
+        """Pick a follower for HISTORY, a tuple of tokens, using INDEX, a random number
+        in the range [0, 1). Returns None if HISTORY does not occur in the chains.
+        Picks the same token that walking through the followers in order and adding up
+        their probabilities until the running total reaches INDEX would pick.
+        """
+        return self.sampling_index.sample(history, index)
+
+    def sample_longest(self, history: tuple,
+                       index: float) -> typing.Tuple[typing.Optional[str], int]:
+        """Pick a follower for the longest suffix of HISTORY that occurs in the chains,
+        using INDEX, as sample() does. Returns (follower, length of the suffix used), or
+        (None, 0) if no suffix of HISTORY occurs in the chains at all.
+        """
+        return self.sampling_index.sample_longest(history, index)
+
+    def compile_automaton(self, comparison_form: typing.Optional[typing.Callable[[str], str]]=None) -> chain_storage.ChainAutomaton:
+        """Compile the chains into a chain_storage.ChainAutomaton, which is stored as
+        .automaton (and also returned). COMPARISON_FORM is the comparison_form() of the
+        generator that will use it. The automaton is thrown away whenever the chains
+        change, and has to be compiled again if it's still wanted.
+        """
+        assert self.finalized, "ERROR: only finalized chains can be compiled!"
+        assert not self.read_only, "ERROR: these chains are shared, and can't be compiled!"
+        self.automaton = chain_storage.ChainAutomaton(self.mapping, self.sampling_index, self.markov_length, comparison_form)
+        return self.automaton
+
+    def choose_start(self, index: float) -> str:
+        """Pick a token to begin a sentence, using INDEX, a random number in the range
+        [0, 1). Normally, every token in .starts is equally likely, just as with
+        random.choice(). If .weighted_starts is True, and the chains know how often each
+        start occurred in training (chains trained or saved before v2.5 don't), tokens
+        are picked in proportion to how often they began a sentence in the training
+        texts instead.
+        """
+        if self.weighted_starts and self.start_weights:
+            return self.starts[min(bisect.bisect_left(self.start_weights, index * self.start_weights[-1]), len(self.starts) - 1)]
+        return self.starts[int(index * len(self.starts))]
+
+    def update(self, counts: typing.Dict[tuple, typing.Dict[str, typing.Union[float, int]]]) -> None:
+        """Add COUNTS, a set of unnormalized follower counts (in the same format as a
+        TextGenerator's temporary mapping) to these finalized chains, without
+        rebuilding them: only the histories in COUNTS are renormalized, and only their
+        entries in the sampling index are thrown away, to be rebuilt when they're next
+        needed. This relies on .totals, which records how many times each history has
+        occurred; chains saved by versions of this module before 2.5 don't have it.
+
+        If the chains are stored in one of chain_storage's read-only mappings (because
+        they've been compacted, or loaded from a binary chains file), the changed
+        histories are kept in a chain_storage.OverlayMapping on top of it.
+        """
+        assert self.finalized, "ERROR: only finalized chains can be updated!"
+        assert not self.read_only, "ERROR: these chains are shared, and can't be updated!"
+        assert self.totals is not None, "ERROR: these chains don't record how often each history occurred, and can't be updated!"
+        if not isinstance(self.mapping, (dict, chain_storage.OverlayMapping)):
+            self.mapping = chain_storage.OverlayMapping(self.mapping)
+            self.build_sampling_index()
+        for history, followers in counts.items():
+            old_total = self.totals.get(history, 0)
+            if old_total:
+                merged = {t: p * old_total for t, p in self.mapping[history].items()}
+            else:
+                merged = dict()
+            for t, count in followers.items():
+                merged[t] = merged.get(t, 0) + count
+            total = old_total + sum(followers.values())
+            self.mapping[history] = {t: c / total for t, c in merged.items()}
+            self.totals[history] = total
+            if isinstance(self.sampling_index, chain_storage.SamplingIndex):
+                self.sampling_index.pop(history, None)
+            elif isinstance(self.sampling_index, chain_storage.CharacterMapping):
+                self.sampling_index.refresh(history, self.mapping[history])
+        self.automaton = None
+
+    def _reachable_histories(self, mapping: typing.Mapping[tuple, typing.Mapping[str, float]],
+                             comparison_form: typing.Optional[typing.Callable[[str], str]]=None) -> typing.Set[tuple]:
+        """Return the set of histories in MAPPING that generating text can ever sample
+        from, starting from .starts and backing off to shorter histories just as
+        TextGenerator.next() does. COMPARISON_FORM is as for compile_automaton().
+
+        As in chain_storage.ChainAutomaton, the state of a sentence being generated is
+        the longest suffix of the tokens generated so far that is a prefix of some
+        history; the states reachable from the starts are explored one at a time, and
+        a sentence ends (so its state leads nowhere) when a sentence-ending token is
+        generated.
+        """
+        histories = {h for h in mapping if len(h) <= self.markov_length}   # Longer ones are never used for generating.
+        prefixes = {h[:i] for h in histories for i in range(1, len(h) + 1)}
+
+        def longest_suffix(context: tuple, within: typing.Set[tuple]) -> typing.Optional[tuple]:
+            for i in range(len(context)):
+                if context[i:] in within:
+                    return context[i:]
+            return None
+
+        pending = {longest_suffix(((comparison_form(t) if comparison_form else t),), prefixes) for t in self.starts}
+        pending.discard(None)
+        seen, ret = set(pending), set()
+        pending = list(pending)
+        while pending:
+            state = pending.pop()
+            history = longest_suffix(state, histories)
+            if history is None:             # A dead end.
+                continue
+            ret.add(history)
+            for t in mapping[history]:
+                if t in sentence_ending_punct:
+                    continue
+                following = longest_suffix((state + ((comparison_form(t) if comparison_form else t),))[-self.markov_length:], prefixes)
+                if (following is not None) and (following not in seen):
+                    seen.add(following)
+                    pending.append(following)
+        return ret
+
+    def prune(self, min_count: typing.Optional[float]=None,
+              top_k: typing.Optional[int]=None,
+              drop_unreachable: bool=False,
+              comparison_form: typing.Optional[typing.Callable[[str], str]]=None) -> CompactionReport:
+        """Make the chains smaller by throwing away the information that matters least to
+        the text generated from them, and return a CompactionReport describing what
+        changed. If TOP_K is not None, only the TOP_K most likely followers of each
+        history are kept. If MIN_COUNT is not None, followers that followed their
+        history fewer than MIN_COUNT times in training are dropped (though the most
+        likely follower of each history is always kept); this needs the counts that
+        chains saved before v2.5 don't have. The probabilities of the followers that
+        are left are scaled up to add up to one again. If DROP_UNREACHABLE is True,
+        histories that generating text can never use (see _reachable_histories())
+        are dropped, too; COMPARISON_FORM is the comparison_form() of the generator
+        that will use the chains (see TextGenerator.prune()).
+
+        The chains are left in a plain dictionary (which can be compacted again); the
+        counts kept in .totals are reduced to match, so that the chains can still be
+        trained further.
+        """
+        assert self.finalized, "ERROR: only finalized chains can be pruned!"
+        assert not self.read_only, "ERROR: these chains are shared, and can't be pruned!"
+        assert (min_count is None) or (self.totals is not None), "ERROR: these chains don't record how often each history occurred, and can't be pruned by count!"
+        assert (top_k is None) or (top_k >= 1), "ERROR: TOP_K must be at least one!"
+        report = CompactionReport(self.mapping)
+        mapping, totals, drifts = dict(), (None if (self.totals is None) else dict()), dict()
+        for history, followers in self.mapping.items():
+            followers = dict(followers)
+            total = None if (self.totals is None) else self.totals[history]
+            kept = followers
+            if (top_k is not None) and (len(kept) > top_k):
+                keep = set(sorted(kept, key=kept.get, reverse=True)[:top_k])      # Ties go to the earlier follower.
+                kept = {t: p for t, p in kept.items() if t in keep}
+            if min_count is not None:
+                best = max(kept, key=kept.get)
+                kept = {t: p for t, p in kept.items() if (round(p * total, 6) >= min_count) or (t == best)}
+            mass = 1.0
+            if len(kept) < len(followers):
+                mass = sum(kept.values())
+                kept = {t: p / mass for t, p in kept.items()}
+            drifts[history] = (1 - mass, 1 if (total is None) else total)     # The total variation distance is the mass lost.
+            mapping[history] = kept
+            if totals is not None:
+                totals[history] = total * mass
+        if drop_unreachable:
+            reachable = self._reachable_histories(mapping, comparison_form)
+            mapping = {h: f for h, f in mapping.items() if h in reachable}
+            if totals is not None:
+                totals = {h: t for h, t in totals.items() if h in reachable}
+        for history in mapping:
+            report.add(*drifts[history])
+        self.mapping, self.totals = mapping, totals
+        self.build_sampling_index()
+        report.finish(self.mapping)
+        return report
+
+    def quantize(self, bits: int=8) -> CompactionReport:
+        """Round each history's follower probabilities to BITS-bit (8 or 16) fixed-point
+        weights (see chain_storage.quantize_weights()), and return a CompactionReport
+        describing how far the probabilities moved. The chains are changed to use the
+        rounded probabilities, so that they generate the same text before they're saved
+        as they will after they've been loaded again; binary files written by
+        store_chains() afterwards store the weights, rather than 64-bit running totals,
+        which makes them much smaller. The weights are turned back into probabilities
+        when the file is read.
+
+        Like prune(), this leaves the chains in a plain dictionary.
+        """
+        assert self.finalized, "ERROR: only finalized chains can be quantized!"
+        assert not self.read_only, "ERROR: these chains are shared, and can't be quantized!"
+        assert bits in (8, 16), "ERROR: weights can only be quantized to 8 or 16 bits, not %s!" % bits
+        report = CompactionReport(self.mapping)
+        mapping = dict()
+        for history, followers in self.mapping.items():
+            weights = chain_storage.quantize_weights(followers.values(), bits)
+            total = sum(weights)
+            mapping[history] = {t: w / total for t, w in zip(followers, weights)}
+            report.add(sum(abs(p - q) for p, q in zip(followers.values(), mapping[history].values())) / 2,
+                       1 if (self.totals is None) else self.totals[history])
+        self.mapping, self.weight_bits = mapping, bits
+        self.build_sampling_index()
+        report.finish(self.mapping)
+        return report
+
+    def compact(self, storage: str='compact'):
+        """Replace the dictionary-of-dictionaries mapping with a more compact one, which
+        stores the same information in a fraction of the memory: a
+        chain_storage.CompactMapping if STORAGE is 'compact' (the default), a
+        chain_storage.CharacterMapping if it's 'character' (which only works for
+        chains of single characters), or a chain_storage.TrieMapping if it's 'trie'.
+        The trie takes even less memory
+        (especially for long chains, whose histories share most of their tokens), and
+        finds the longest known suffix of a history in a single pass, so backing off
+        to shorter histories is faster; but looking up a history that's known
+        outright can take slightly longer.
+
+        Generation, store_chains(), and read_chains() all work the same way afterwards;
+        but the compact mappings are read-only, so this should only be done after the
+        chains have been finalized.
+        """
+        assert self.finalized, "ERROR: only finalized chains can be compacted!"
+        assert not self.read_only, "ERROR: these chains are shared, and can't be compacted!"
+        storage_class = {'compact': chain_storage.CompactMapping,
+                         'character': chain_storage.CharacterMapping,
+                         'trie': chain_storage.TrieMapping}.get(storage)
+        assert storage_class, "ERROR: unknown storage %s!" % storage
+        if not isinstance(self.mapping, storage_class):
+            self.mapping = storage_class(self.mapping)
+        self.build_sampling_index()
 
 
 class TextGenerator(object):
@@ -218,6 +1215,9 @@ class TextGenerator(object):
         self.name = name                                # NAME is totally optional and entirely for your benefit.
         self.chains = MarkovChainTextModel()            # Markov chain-based representation of the text(s) used to train this generator.
         self.allow_single_character_sentences = False   # Is this model allowed to produce one-character sentences?
+        self._compiled_substitutions = None             # See _substitution_engine().
+        self.stats = None                               # A GenerationStats, if enable_stats() has been called.
+        self.pool = None                                # A SentencePool, if enable_pool() has been called.
 
         # This next is the default list of substitutions that happen after text is produced.
         # List of lists. each sublist:[search_regex, replace_regex]. Subs performed in order specified.
@@ -245,6 +1245,73 @@ class TextGenerator(object):
         ['…—', '… —'],  # put space in between ellipsis-em dash, if they occur together.
     ]
 
+    def enable_stats(self) -> GenerationStats:
+        """Start keeping track of what happens during text generation, in a GenerationStats
+        object that's stored as .stats (and also returned). Keeping track costs a little
+        time; not keeping track (the default) costs essentially nothing.
+        """
+        if self.stats is None:
+            self.stats = GenerationStats()
+        return self.stats
+
+    def disable_stats(self) -> None:
+        """Stop keeping track of what happens during text generation."""
+        self.stats = None
+
+    def enable_pool(self, size: int=256,
+                    workers: int=1,
+                    low_water: typing.Optional[int]=None,
+                    max_age: typing.Optional[float]=None) -> SentencePool:
+        """Start making sentences ahead of time, in background threads, and keeping up to
+        SIZE of them waiting in a SentencePool (stored as .pool, and also returned) from
+        which _produce_text() (and so gen_text(), gen_html_frag(), and print_text())
+        takes them. This is meant for long-running programs (such as the generation
+        server) that want each request answered quickly: most of the time, a sentence
+        is just taken from the pool. See SentencePool for what WORKERS, LOW_WATER, and
+        MAX_AGE mean.
+
+        Sentences in the pool have already had the final substitutions made, one
+        sentence at a time rather than a paragraph at a time, so substitutions that
+        would have matched across the boundary between two sentences don't happen. The
+        workers use the global random number generator, so seeding it doesn't make
+        pooled text reproducible; and sentences already in the pool don't notice
+        changes to the chains, so call .pool.clear() after retraining.
+        """
+        assert self.is_trained(), "ERROR: the model %s needs to be trained before it can generate text!" % self
+        self.disable_pool()
+        self.pool = SentencePool(lambda: self._substitution_engine().apply(self._gen_sentence()),
+                                 size=size, workers=workers, low_water=low_water, max_age=max_age)
+        return self.pool
+
+    def disable_pool(self) -> None:
+        """Stop making sentences ahead of time, and throw away any that were made."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def compile(self) -> chain_storage.ChainAutomaton:
+        """Compile the chains into a state machine (see chain_storage.ChainAutomaton) that
+        _gen_sentence() then uses to generate tokens, instead of calling next() for each
+        of them. The text generated is exactly the same, but generating it takes less
+        time, at the cost of some extra memory. Retraining the model, loading other
+        chains, or changing them in any other way throws the automaton away; call this
+        again afterwards to get a new one. Subclasses that override next() don't use
+        the automaton. Shared chains (say, those handed out by a
+        model_registry.ModelRegistry) can't be compiled.
+        """
+        assert self.is_trained(), "ERROR: the model %s needs to be trained before it can be compiled!" % self
+        return self.chains.compile_automaton(self.comparison_form)
+
+    def prune(self, min_count: typing.Optional[float]=None,
+              top_k: typing.Optional[int]=None,
+              drop_unreachable: bool=False) -> CompactionReport:
+        """Prune the chains; see MarkovChainTextModel.prune(). This passes along the
+        generator's comparison_form(), which finding unreachable histories needs.
+        """
+        assert self.is_trained(), "ERROR: the model %s needs to be trained before it can be pruned!" % self
+        return self.chains.prune(min_count=min_count, top_k=top_k, drop_unreachable=drop_unreachable,
+                                 comparison_form=self.comparison_form)
+
     def __str__(self):
         if self.is_trained():
             if self.name:
@@ -279,6 +1346,7 @@ class TextGenerator(object):
         assert len(substitution) == 2, "ERROR: the substitution you pass in must be two items long."
         if position == -1: position = len(self.final_substitutions)
         self.final_substitutions.insert(position, substitution)
+        self._compiled_substitutions = None
 
     def remove_final_substitution(self, substitution: str):
         """Remove SUBSTITUTION from the list of final substitutions performed after text
@@ -290,6 +1358,7 @@ class TextGenerator(object):
         assert isinstance(substitution, (list, tuple)), "ERROR: the substitution you pass in must be a list or tuple."
         assert len(substitution) == 2, "ERROR: the substitution you pass in must be two items long."
         self.final_substitutions.remove(substitution)
+        self._compiled_substitutions = None
 
     def get_final_substitutions(self) -> typing.List[str]:          #FIXME: check annotation
         """Returns the list of final substitutions that are performed by the text generator
@@ -308,6 +1377,18 @@ class TextGenerator(object):
             assert isinstance(sublist, (list, tuple)), "ERROR: substitution %s is not a list or tuple." % sublist
             assert len(sublist) == 2, "ERROR: substitution %s is not two items long." % sublist
         self.final_substitutions = substitutions
+        self._compiled_substitutions = None
+
+    def _substitution_engine(self) -> SubstitutionEngine:
+        """Return a SubstitutionEngine that makes the final substitutions. It's compiled
+        when it's first needed, and cached; the methods above throw the cached copy away
+        when they change the list, and it's also recompiled if the list turns out to
+        have been changed some other way (e.g., by another instance that shares it).
+        """
+        engine = getattr(self, '_compiled_substitutions', None)
+        if (engine is None) or not engine.compiled_from(self.final_substitutions):
+            engine = self._compiled_substitutions = SubstitutionEngine(self.final_substitutions)
+        return engine
 
     def addItemToTempMapping(self, history: typing.List[str],             #FIXME: check annotations
                              word: str,
@@ -336,21 +1417,43 @@ class TextGenerator(object):
             history = history[1:]
 
     def next(self, prevList: typing.List,                           #FIXME: check annotations
-             the_mapping: typing.Dict) -> str:
+             the_mapping: typing.Dict,
+             rng: typing.Optional[random.Random]=None) -> str:
         """Returns the next word in the sentence (chosen randomly),
-        given the previous ones.
+        given the previous ones. The choice is made with RNG, a random.Random instance
+        (or anything else with random() and choice() methods), or with the global
+        random number generator if RNG is None.
         """
         prevList = [ self.comparison_form(p) for p in prevList ]        # Use the canonical comparison form
         total = 0.0
         ret = ""
-        index = random.random()
+        index = random.random() if (rng is None) else rng.random()
+        if (the_mapping is self.chains.mapping) and self.chains.sampling_index:    # Use the sampling index, if we have one.
+            ret, length = self.chains.sample_longest(tuple(prevList), index)
+            if ret is not None:
+                if (length < len(prevList)) and (self.stats is not None):
+                    with self.stats.lock:
+                        self.stats.backoffs[len(prevList) - length] += 1
+                return ret
+            if self.stats is not None:
+                with self.stats.lock:
+                    self.stats.dead_ends += 1
+            return "."
         # Shorten prevList until it's in the_mapping
+        depth = 0
         try:
             while tuple(prevList) not in the_mapping:
                 prevList.pop(0)         # Just drop the earliest list element & try again if the list isn't in the_mapping
+                depth += 1
         except IndexError:  # If we somehow wind up with an empty list (shouldn't happen), then just end the sentence;
             ret = "."    # this will force the generator to start a new one.
+            if self.stats is not None:
+                with self.stats.lock:
+                    self.stats.dead_ends += 1
         else:               # Otherwise, get a random word from the_mapping, given prevList, if prevList isn't empty
+            if depth and (self.stats is not None):
+                with self.stats.lock:
+                    self.stats.backoffs[depth] += 1
             for k, v in the_mapping[tuple(prevList)].items():
                 total += v
                 if total >= index and ret == "":
@@ -358,13 +1461,16 @@ class TextGenerator(object):
                     break
         return ret
 
-    def _build_mapping(self, token_list: typing.List[str],          #FIXME: check annotations
+    def _build_mapping(self, token_list: typing.Iterable[str],
                        markov_length: int,
                        character_tokens: bool=False,
                        learn_starts: bool=True,
                        weight: typing.Union[float, int]=1.0) -> None:
         """Add the data in TOKEN_LIST to the temporary mapping data that is being built
-        as the model is trained. If CHARACTER_TOKENS is True, sets the corresponding
+        as the model is trained. TOKEN_LIST may be a list, or it may be any other
+        iterable -- including a generator that produces tokens as it reads a text, in
+        which case only the last few tokens are ever kept in memory at once. If
+        CHARACTER_TOKENS is True, sets the corresponding
         flag on the chains (and the chains that are passed in should also be letters,
         not words: this is not checked, but getting it wrong may result in weird
         behavior later on). MARKOV_LENGTH is of course the length of the Markov chains
@@ -382,30 +1488,117 @@ class TextGenerator(object):
         This function does not finalize the mappings by normalizing the frequency
         counts; _finalize_mapping needs to be called for that.
         """
+        self._start_training()
+        self.chains.markov_length = markov_length
+        self.chains.character_tokens = character_tokens
+        tokens = iter(token_list)
+        first = next(tokens, None)
+        if first is None:
+            return
+        self._count_start(first, weight)
+        self._add_history_pairs(self._history_pairs(itertools.chain([first], tokens), markov_length),
+                                learn_starts=learn_starts, weight=weight)
+
+    def _start_training(self) -> None:
+        """Make sure that the temporary mapping and the list of sentence starts that
+        training adds to both exist.
+        """
+        assert not self.chains.read_only, "ERROR: the chains of %s are shared, and can't be trained!" % self
         try:
             _ = self.the_temp_mapping
         except AttributeError:
             self.the_temp_mapping = dict()
         if (not hasattr(self.chains, 'starts')) or not (self.chains.starts):
             self.chains.starts = list()
+        try:
+            _ = self.the_start_counts
+        except AttributeError:          # How often each start has occurred. Keeps membership tests fast, too.
+            if self.chains.start_weights and (len(self.chains.start_weights) == len(self.chains.starts)):
+                counts = (b - a for a, b in zip(itertools.chain([0], self.chains.start_weights), self.chains.start_weights))
+            else:
+                counts = itertools.repeat(1)
+            self.the_start_counts = dict(zip(self.chains.starts, counts))
+            self.chains.starts = list(self.chains.starts)
+
+    def _count_start(self, start: str,
+                     weight: typing.Union[float, int]=1.0) -> None:
+        """Note that START began a sentence (WEIGHT times), adding it to the chains' list of
+        sentence starts if it's not already there.
+        """
+        if start in self.the_start_counts:
+            self.the_start_counts[start] += weight
+        else:
+            self.the_start_counts[start] = weight
+            self.chains.starts.append(start)
 
-        self.chains.markov_length = markov_length
-        self.chains.character_tokens = character_tokens
-        if token_list[0] not in self.chains.starts:
-            self.chains.starts.append(token_list[0])
-        for i in range(1, len(token_list) - 1):
+    @staticmethod
+    def _history_pairs(tokens: typing.Iterator[str],
+                       markov_length: int,
+                       continuation: bool=False) -> typing.Iterator[typing.Tuple[typing.List[str], str]]:
+        """Yield the (history, following token) pairs that TOKENS contributes to the
+        mapping, keeping only the last few tokens in memory. Note that the very first
+        token is never yielded as a following token, and that the first histories
+        produced may be up to one token longer than MARKOV_LENGTH; this has always
+        been the case, and changing it would change every model.
+
+        If CONTINUATION is True, TOKENS is assumed to pick up in the middle of a longer
+        stream of tokens (as happens when training is split across several processes):
+        nothing is yielded until a full MARKOV_LENGTH tokens of history are available,
+        and every history is exactly MARKOV_LENGTH tokens long.
+        """
+        if continuation:
+            window = list(itertools.islice(tokens, markov_length))
+            if len(window) < markov_length:
+                return
+            for follow in tokens:
+                yield window[:], follow
+                window.append(follow)
+                del window[0]
+            return
+
+        window = list(itertools.islice(tokens, 2))      # The last (up to) MARKOV_LENGTH + 1 tokens seen.
+        for i, follow in enumerate(tokens, start=1):    # i is the position of the last token in WINDOW.
             if i <= markov_length:
-                history = token_list[: i + 1]
+                yield window[:], follow
             else:
-                history = token_list[i - markov_length + 1 : i + 1]
-            follow = token_list[i + 1]
+                yield window[len(window) - markov_length:], follow
+            window.append(follow)
+            if len(window) > markov_length + 1:
+                del window[0]
+
+    def _add_history_pairs(self, pairs: typing.Iterable[typing.Tuple[typing.List[str], str]],
+                           learn_starts: bool=True,
+                           weight: typing.Union[float, int]=1.0) -> None:
+        """Add each of the (history, following token) PAIRS to the temporary mapping, and
+        (if LEARN_STARTS is True) add tokens following sentence-ending punctuation to
+        the chains' list of sentence starts. See _build_mapping() for more details.
+        """
+        self._start_training()
+        for history, follow in pairs:
             # if the last elt was a sentence-ending punctuation, add the next word to the start list
             if learn_starts:
                 if history[-1] in sentence_ending_punct and follow not in punct_with_space_after:
-                    if follow not in self.chains.starts:
-                        self.chains.starts.append(follow)
+                    self._count_start(follow, weight)
             self.addItemToTempMapping(history, follow, weight=weight)
 
+    def _merge_temp_mapping(self, the_temp_mapping: typing.Dict[tuple, typing.Dict[str, float]],
+                            start_counts: typing.Dict[str, float]) -> None:
+        """Merge THE_TEMP_MAPPING, a set of (unnormalized) follower counts built
+        separately, into this generator's own temporary mapping by adding the counts
+        together, and do the same for START_COUNTS, a dictionary mapping sentence starts
+        to the number of times they occurred.
+        """
+        self._start_training()
+        for history, followers in the_temp_mapping.items():
+            if history in self.the_temp_mapping:
+                ours = self.the_temp_mapping[history]
+                for word, count in followers.items():
+                    ours[word] = ours.get(word, 0) + count
+            else:
+                self.the_temp_mapping[history] = followers
+        for s, count in start_counts.items():
+            self._count_start(s, count)
+
     def _finalize_mapping(self):
         """Finalize the mapping in SELF by normalizing probability frequencies of
         occurrences. This must be done once, after the model has been trained on
@@ -420,21 +1613,58 @@ class TextGenerator(object):
         assert hasattr(self.chains, 'starts'), "ERROR! The text generator's training did not result in any sentence beginnings!"
         assert self.chains.starts, "ERROR! The text generator's training did not result in any sentence beginnings!"
 
-        # Next, restrict the possible range of STARTS if we're using single-chracter chains.
-        if self.chains.character_tokens:
-            self.chains.starts = [c for c in self.chains.starts if c.isupper()]
+        self._finalize_starts()
 
         # Then, normalize the frequencies and install the new dictionary in the object's mappings.
-        the_mapping = dict()
+        the_mapping, the_totals = dict(), dict()
         for first, followset in self.the_temp_mapping.items():
             total = sum(followset.values())
             the_mapping[first] = dict([(k, v / total) for k, v in followset.items()])   # Here's the normalizing step.
+            the_totals[first] = total
         self.chains.mapping = the_mapping
+        self.chains.totals = the_totals
+        self.chains.build_sampling_index()
 
         # Clean up and mark finalized.
         del self.the_temp_mapping
         self.chains.finalized = True
 
+    def _finalize_starts(self) -> None:
+        """Install the list of sentence starts, and how often each occurred, in the
+        chains, and get rid of the counts kept during training.
+        """
+        # Restrict the possible range of STARTS if we're using single-chracter chains.
+        if self.chains.character_tokens:
+            self.chains.starts = [c for c in self.chains.starts if c.isupper()]
+        self.chains.start_weights = array('d', itertools.accumulate(self.the_start_counts[s] for s in self.chains.starts))
+        del self.the_start_counts
+
+    def partial_train(self, the_text: str,
+                      weight: typing.Union[float, int]=1.0,
+                      learn_starts: bool=True) -> None:
+        """Add THE_TEXT, a single string, to an already trained (or loaded) model, without
+        retraining it on everything it's already seen. WEIGHT and LEARN_STARTS mean
+        the same thing that they do for _train_from_text(); the Markov length and the
+        kind of tokens are those the model already has. Only the histories that occur
+        in THE_TEXT are renormalized (see MarkovChainTextModel.update()), so this is
+        quick even for very large models.
+
+        The result is the same (up to rounding errors) as training on all of the texts
+        at once, except that THE_TEXT is treated as a separate document: no chains
+        span the boundary between the old text and the new one.
+        """
+        assert the_text, "ERROR! blank text was passed to partial_train()!"
+        assert self.is_trained(), "ERROR: the model %s needs to be trained before it can be trained further!" % self
+        assert self.chains.totals is not None, "ERROR: the model %s was saved without the counts needed to train it further!" % self
+        assert not self.chains.read_only, "ERROR: the chains of %s are shared, and can't be trained!" % self
+        self.the_temp_mapping = dict()
+        self._build_mapping(self._token_list(the_text, character_tokens=self.chains.character_tokens),
+                            markov_length=self.chains.markov_length, character_tokens=self.chains.character_tokens,
+                            weight=weight, learn_starts=learn_starts)
+        self._finalize_starts()
+        self.chains.update(self.the_temp_mapping)
+        del self.the_temp_mapping
+
     @staticmethod
     def _tokenize_string(the_string: str) -> typing.List[str]:
         """Split a string into tokens, which more or less correspond to words. More aware
@@ -443,17 +1673,92 @@ class TextGenerator(object):
         """
         return re.findall(r"[\w%s]+|[%s]" % (word_punct, token_punct), the_string)
 
+    def _tokenizer_settings(self, character_tokens: bool) -> str:
+        """Describe the way that _token_list() splits text into tokens (but not the way it
+        converts them to their comparison forms), so that tokens cached by a
+        token_cache.TokenCache are only reused by a tokenizer that would produce the
+        same ones.
+        """
+        from token_cache import TOKENS_FILE_VERSION
+
+        tokenizer = type(self)._tokenize_string
+        return repr((TOKENS_FILE_VERSION, bool(character_tokens), tokenizer.__module__, tokenizer.__qualname__,
+                     word_punct, token_punct))
+
     def _token_list(self, the_string: str,
-                    character_tokens: bool=False) -> typing.List[str]:
+                    character_tokens: bool=False,
+                    token_cache: typing.Optional[TokenCache]=None) -> typing.List[str]:
         """Converts a string into a set of tokens so that the text generator can
-        process, and therefore be trained by, it.
+        process, and therefore be trained by, it. If TOKEN_CACHE is not None, the tokens
+        are taken from it if they've been stored there before, and stored there if
+        they haven't.
         """
+        if token_cache is not None:
+            vocabulary, ids = token_cache.tokens(the_string, self._tokenizer_settings(character_tokens),
+                                                 list if character_tokens else self._tokenize_string)
+            forms = [self.comparison_form(w) for w in vocabulary]   # Once per distinct token, not once per token.
+            return list(map(forms.__getitem__, ids))
         if character_tokens:
             tokens = list(the_string)
         else:
             tokens = self._tokenize_string(the_string)
         return [self.comparison_form(w) for w in tokens]
 
+    @staticmethod
+    def _read_chunks(the_files: typing.Iterable[typing.Union[str, bytes, Path]],
+                     chunk_size: int=1024 * 1024) -> typing.Iterator[str]:
+        """Read each of THE_FILES in pieces of (about) CHUNK_SIZE characters and yield the
+        pieces. A newline is yielded before the contents of each file, so that the
+        stream of text is exactly the same as the one that train() assembles in memory
+        when it's not streaming.
+        """
+        for which_file in the_files:
+            yield '\n'
+            with open(which_file) as the_file:
+                while True:
+                    chunk = the_file.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+
+    def _token_stream(self, chunks: typing.Iterable[str],
+                      character_tokens: bool=False) -> typing.Iterator[str]:
+        """Converts a stream of CHUNKS of text into a stream of tokens, producing exactly
+        the tokens that _token_list() would produce from all of CHUNKS joined together.
+        In word-token mode, any partial word at the end of a chunk is carried over and
+        tokenized along with the next chunk, so words split across chunk boundaries are
+        not broken in two.
+        """
+        carry = ""
+        for chunk in chunks:
+            if character_tokens:
+                yield from (self.comparison_form(c) for c in chunk)
+                continue
+            chunk = carry + chunk
+            split = _partial_word_at_end.search(chunk).start()
+            carry = chunk[split:]
+            yield from (self.comparison_form(w) for w in self._tokenize_string(chunk[:split]))
+        if carry:
+            yield from (self.comparison_form(w) for w in self._tokenize_string(carry))
+
+    @staticmethod
+    def _preprocess(chunks: typing.Iterable[str],
+                    preprocessors: typing.Sequence[typing.Callable[[typing.Iterable[str]], typing.Iterable[str]]]) -> typing.Iterable[str]:
+        """Pass CHUNKS, a stream of pieces of text, through each of PREPROCESSORS in turn,
+        and return the resulting stream. Each preprocessor is a function that takes an
+        iterable of chunks of text and returns (or yields) the processed text, again in
+        chunks, which needn't be the same size as the ones it was given; since text is
+        divided into chunks arbitrarily (see _read_chunks()), a preprocessor that needs
+        to see more than one character at a time has to deal with things it's looking
+        for being split between two chunks, as process_acronyms_in_chunks() does. A
+        function that just transforms a string, and doesn't care where the string was
+        split up, can be made into a preprocessor with, e.g.,
+        functools.partial(map, str.lower).
+        """
+        for p in preprocessors:
+            chunks = p(chunks)
+        return chunks
+
     def is_trained(self) -> bool:
         """Detect whether this model is trained or not."""
         return all([self.chains.finalized, self.chains.starts, self.chains.mapping, self.chains.markov_length])
@@ -462,7 +1767,9 @@ class TextGenerator(object):
                          markov_length: int=1,
                          character_tokens: bool=False,
                          weight: typing.Union[float, int]=1.0,
-                         learn_starts: bool=True) -> None:
+                         learn_starts: bool=True,
+                         token_cache: typing.Union[None, str, Path, TokenCache]=None,
+                         preprocessors: typing.Sequence[typing.Callable[[typing.Iterable[str]], typing.Iterable[str]]]=()) -> None:
         """Train the model by getting it to analyze a text passed in. Note that THE_TEXT is
         a single string here. MARKOV_LENGTH is, of course, the length of the Markov
         chains to generate; CHARACTER_TOKENS indicates whether tokens are single
@@ -470,74 +1777,420 @@ class TextGenerator(object):
         relative numerical weighting to give to this piece of text. LEARN_STARTS
         toggles whether the beginnings of sentences are added to the generator's
         .starts list, which is generally desirable but needs to be turned off in some
-        situations.
+        situations. TOKEN_CACHE, if given, is a token_cache.TokenCache (or the name of
+        a directory to keep one in) from which the tokens of THE_TEXT are taken if it
+        has been tokenized before, and in which they're stored if it hasn't.
+        PREPROCESSORS are applied to THE_TEXT before it's tokenized; see _preprocess().
         """
         assert the_text, "ERROR! blank text was passed to _train_from_text()!"
-        self._build_mapping(self._token_list(the_text, character_tokens=character_tokens),
+        if preprocessors:
+            the_text = ''.join(self._preprocess([the_text], preprocessors))
+        if isinstance(token_cache, (str, os.PathLike)):
+            from token_cache import TokenCache
+
+            token_cache = TokenCache(token_cache)
+        self._build_mapping(self._token_list(the_text, character_tokens=character_tokens, token_cache=token_cache),
                             markov_length=markov_length, character_tokens=character_tokens,
                             weight=weight, learn_starts=learn_starts)
 
     def train(self, the_files: typing.Union[str, bytes, Path, typing.List[typing.Union[str, bytes, Path]]],
               markov_length: int=1,
-              character_tokens: bool=False) -> None:
+              character_tokens: bool=False,
+              streaming: bool=False,
+              workers: int=1,
+              token_cache: typing.Union[None, str, Path, TokenCache]=None,
+              preprocessors: typing.Sequence[typing.Callable[[typing.Iterable[str]], typing.Iterable[str]]]=()) -> None:
         """Train the model from a text file, or a list of text files, supplied as THE_FILES.
         This routine is the easiest way to train a generator all at once on a single
         file or set of files that all have the same training parameters. Fiddlier
         training process will need to call _train_from_text() manually at least once,
         then _finalize_mapping when all of the mappings have been created.
+
+        If STREAMING is True, the files are read and tokenized a piece at a time, and
+        the tokens are fed into the mapping as they're produced, instead of the whole
+        text being read into memory and tokenized all at once. The resulting model is
+        exactly the same either way, but streaming keeps memory use proportional to the
+        size of the model rather than the size of the training text, which is what you
+        want for very large corpora. Note that streaming bypasses _train_from_text(),
+        so subclasses that override that method won't see the text.
+
+        If WORKERS is more than one, training is split across that many processes; see
+        _train_in_parallel(). This implies STREAMING, and produces exactly the same
+        model that training in a single process would.
+
+        If TOKEN_CACHE is given, it's a token_cache.TokenCache (or the name of a
+        directory to keep one in) that saves having to tokenize the same text again
+        when the model is retrained on it (with a different MARKOV_LENGTH, say); see
+        _train_from_text(). It can't be combined with STREAMING or WORKERS, because
+        caching the tokens means having all of them in memory at once.
+
+        PREPROCESSORS are applied to the text of THE_FILES, in order, before it's
+        tokenized (see _preprocess()): for instance, passing
+        preprocessors=[process_acronyms_in_chunks] deals with acronyms. When STREAMING,
+        they're applied as the text is read. They can't (yet) be combined with WORKERS.
         """
-        if isinstance(the_files, (str, bytes, Path)):
+        if isinstance(the_files, (str, bytes, os.PathLike)):
             the_files = [ the_files ]
         assert isinstance(the_files, (list, tuple)), "ERROR: you cannot pass an object of type %s to %s.train" % (type(the_files), self)
         assert len(the_files) > 0, "ERROR: empty file list passed to %s.train()" % self
-        the_text = ""
-        for which_file in the_files:
-            with open(which_file) as the_file:
-                the_text = the_text + '\n' + the_file.read()
-        self._train_from_text(the_text=the_text, markov_length=markov_length, character_tokens=character_tokens)
+        assert workers >= 1, "ERROR: WORKERS must be at least one!"
+        assert (token_cache is None) or not (streaming or workers > 1), "ERROR: a token cache can't be used while streaming!"
+        assert (not preprocessors) or (workers == 1), "ERROR: preprocessors can't be used when training in parallel!"
+        if workers > 1:
+            self._train_in_parallel(the_files, markov_length=markov_length, character_tokens=character_tokens, workers=workers)
+        elif streaming:
+            self._build_mapping(self._token_stream(self._preprocess(self._read_chunks(the_files), preprocessors),
+                                                   character_tokens=character_tokens),
+                                markov_length=markov_length, character_tokens=character_tokens)
+        else:
+            the_text = list()
+            for which_file in the_files:
+                with open(which_file) as the_file:
+                    the_text.append('\n' + the_file.read())
+            self._train_from_text(the_text=''.join(the_text), markov_length=markov_length, character_tokens=character_tokens,
+                                  token_cache=token_cache, preprocessors=preprocessors)
         self._finalize_mapping()
 
-    def _gen_sentence(self) -> str:
+    def _train_in_parallel(self, the_files: typing.List[typing.Union[str, bytes, Path]],
+                           markov_length: int,
+                           character_tokens: bool,
+                           workers: int) -> None:
+        """Add THE_FILES to the temporary mapping, using a pool of WORKERS processes.
+        The text is divided into shards (see _split_for_workers()), each of which is
+        tokenized and counted by a separate worker (see _train_shard()). The partial
+        counts are then added together in order, along with the histories that span
+        the boundaries between shards, so that the result is exactly what training on
+        all of the text in one process would produce.
+
+        Each worker creates a new instance of this object's class, so subclasses that
+        override the tokenizing methods or addItemToTempMapping() still get their
+        behavior; but the class must be importable by the worker processes.
+
+        If any shard turns out to be too short to be stitched to its neighbors, falls
+        back to training in this process.
+        """
+        import concurrent.futures
+
+        shards = _split_for_workers(the_files, workers)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_train_shard, itertools.repeat(type(self)), shards, itertools.repeat(markov_length),
+                                        itertools.repeat(character_tokens), [i == 0 for i in range(len(shards))]))
+
+        if (results[0][4] < markov_length + 2) or any(r[4] < markov_length + 1 for r in results[1:]):
+            log_it("INFO: shards too small to train in parallel; training in a single process instead.", 2)
+            self._build_mapping(self._token_stream(self._read_chunks(the_files), character_tokens=character_tokens),
+                                markov_length=markov_length, character_tokens=character_tokens)
+            return
+
+        self._start_training()
+        self.chains.markov_length = markov_length
+        self.chains.character_tokens = character_tokens
+        previous_tail = None
+        for the_temp_mapping, start_counts, head, tail, count in results:
+            if previous_tail is not None:           # Add the histories spanning the boundary with the previous shard.
+                self._add_history_pairs(self._history_pairs(iter(previous_tail + head), markov_length, continuation=True))
+            self._merge_temp_mapping(the_temp_mapping, start_counts)
+            previous_tail = tail
+
+    def _gen_sentence(self, rng: typing.Optional[random.Random]=None) -> str:
         """Build a sentence, starting with a random 'starting word.' Returns a string,
-        which is the generated sentence.
+        which is the generated sentence. All of the random choices are made with RNG
+        (see next()), so a random.Random instance seeded the same way always produces
+        the same sentence; if RNG is None, they're made with the global random number
+        generator.
+
+        Subclasses that override next() should accept its RNG parameter, too, and use
+        it, if they want seeded generation to be reproducible; if RNG is None, it's not
+        passed to next() at all.
         """
         assert self.is_trained(), "ERROR: the model %s needs to be trained before it can generate text!" % self
-        log_it("      _gen_sentence() called.", 4)
-        log_it("        markov_length = %d." % self.chains.markov_length, 5)
-        log_it("        the_mapping = %s." % self.chains.mapping, 5)
-        log_it("        starts = %s." % self.chains.starts, 5)
-        log_it("        allow_single_character_sentences = %s." % self.allow_single_character_sentences, 5)
-        curr = random.choice(self.chains.starts)
-        sent = curr
-        prevList = [curr]
-        # Keep adding words until we hit a period, exclamation point, or question mark
+        if log_enabled(4):
+            log_it("      _gen_sentence() called.", 4)
+            log_it("        markov_length = %d.", 5, self.chains.markov_length)
+            log_it("        the_mapping = %s.", 5, self.chains.mapping)
+            log_it("        starts = %s.", 5, self.chains.starts)
+            log_it("        allow_single_character_sentences = %s.", 5, self.allow_single_character_sentences)
+        draw_from = random if (rng is None) else rng
+        if self.chains.weighted_starts:
+            curr = self.chains.choose_start(draw_from.random())
+        else:
+            curr = draw_from.choice(self.chains.starts)
+        if type(self).next is not TextGenerator.next:
+            fast_path = None                    # Subclasses that change how tokens are picked need next() to be called.
+        elif self.chains.automaton is not None:
+            fast_path = self._automaton_tokens
+        elif isinstance(self.chains.sampling_index, chain_storage.CharacterMapping) and \
+                (self.comparison_form is TextGenerator.comparison_form):
+            fast_path = self._character_tokens
+        else:
+            fast_path = None
+        if fast_path:
+            tokens = fast_path(curr, rng)
+        else:
+            next_token = self.next if (rng is None) else functools.partial(self.next, rng=rng)
+            tokens = [curr]
+            prevList = [curr]
+            # Keep adding words until we hit a period, exclamation point, or question mark
+            while curr not in sentence_ending_punct:
+                curr = next_token(prevList, self.chains.mapping)
+                prevList.append(curr)
+                # if the prevList has gotten too long, trim it
+                while len(prevList) > self.chains.markov_length:
+                    prevList.pop(0)
+                tokens.append(curr)
+        sent = self._join_tokens(tokens)
+        acceptable = self._acceptable_sentence(sent)
+        if self.stats is not None:
+            with self.stats.lock:
+                self.stats.samples += len(tokens) - 1
+                if acceptable:
+                    self.stats.sentences += 1
+                    self.stats.tokens += len(tokens)
+                else:
+                    self.stats.retries += 1
+        if not acceptable:
+            return self._gen_sentence(rng)     # Retry, recursively.
+        import text_handling as th
+        return th.capitalize(sent)
+
+    def _automaton_tokens(self, start: str,
+                          rng: typing.Optional[random.Random]=None) -> typing.List[str]:
+        """Generate the tokens of a sentence beginning with START by walking through the
+        compiled automaton (see compile()). This draws the same random numbers (from
+        RNG, or from the global random number generator if RNG is None), and produces
+        the same tokens, as calling next() over and over would.
+        """
+        automaton, stats, markov_length = self.chains.automaton, self.stats, self.chains.markov_length
+        indptr, followers, cumulative, successors = automaton.indptr, automaton.followers, automaton.cumulative, automaton.successors
+        vocabulary, bisect_left = automaton.vocabulary, bisect.bisect_left
+        draw = random.random if (rng is None) else rng.random
+        state = automaton.start_state(self.comparison_form(start))
+        tokens, curr, context_length = [start], start, 1
         while curr not in sentence_ending_punct:
-            curr = self.next(prevList, self.chains.mapping)
-            prevList.append(curr)
-            # if the prevList has gotten too long, trim it
-            while len(prevList) > self.chains.markov_length:
-                prevList.pop(0)
-            if not self.chains.character_tokens:            # Don't add spaces between tokens that are just single characters.
-                if curr not in punct_with_no_space_before:
-                    if (len(prevList) < 2 or prevList[-2] not in punct_with_no_space_after):
-                        sent += " "                         # Add spaces between words (but not punctuation)
-            sent += curr
+            index = draw()
+            begin, end = indptr[state], indptr[state + 1]
+            if begin == end:                    # No history is known: end the sentence, just as next() does.
+                if stats is not None:
+                    with stats.lock:
+                        stats.dead_ends += 1
+                tokens.append(".")
+                break
+            if stats is not None:
+                depth = context_length - automaton.history_lengths[state]
+                if depth:
+                    with stats.lock:
+                        stats.backoffs[depth] += 1
+                context_length = min(context_length + 1, markov_length)
+            i = min(bisect_left(cumulative, index, begin, end), end - 1)
+            curr, state = vocabulary[followers[i]], successors[i]
+            tokens.append(curr)
+        return tokens
+
+    def _character_tokens(self, start: str,
+                          rng: typing.Optional[random.Random]=None) -> typing.List[str]:
+        """Generate the tokens of a sentence beginning with START from character chains
+        whose sampling index is a chain_storage.CharacterMapping. The history is kept
+        packed into a single integer, which is updated as each character is generated,
+        and the packed forms of its suffixes (which are what backing off needs) are
+        found by masking it, so no tuples are built. This draws the same random
+        numbers (from RNG, or from the global random number generator if RNG is None),
+        and produces the same tokens, as calling next() over and over would.
+        """
+        chains_index, stats, markov_length = self.chains.sampling_index, self.stats, self.chains.markov_length
+        rows, indptr, followers, cumulative = chains_index.rows, chains_index.indptr, chains_index.followers, chains_index.cumulative
+        bits, bisect_left = chains_index.bits_per_character, bisect.bisect_left
+        draw = random.random if (rng is None) else rng.random
+        markers = [1 << (bits * length) for length in range(markov_length + 1)]    # Marker bit for each history length ...
+        masks = [m - 1 for m in markers]                                            # ... and mask for its characters.
+        endings = {ord(c) for c in sentence_ending_punct}
+        code_point = ord(start)
+        code_points, packed, context_length = [code_point], code_point, 1
+        while code_point not in endings:
+            index = draw()
+            length = context_length
+            row = rows.get(markers[length] | (packed & masks[length]))
+            while (row is None) and (length > 1):   # Back off to shorter histories until we find one we know.
+                length -= 1
+                row = rows.get(markers[length] | (packed & masks[length]))
+            if row is None:                         # No history is known: end the sentence, just as next() does.
+                if stats is not None:
+                    with stats.lock:
+                        stats.dead_ends += 1
+                code_points.append(ord("."))
+                break
+            if (length < context_length) and (stats is not None):
+                with stats.lock:
+                    stats.backoffs[context_length - length] += 1
+            begin, end = indptr[row], indptr[row + 1]
+            code_point = followers[min(bisect_left(cumulative, index, begin, end), end - 1)]
+            code_points.append(code_point)
+            if context_length < markov_length:
+                context_length += 1
+            packed = ((packed << bits) | code_point) & masks[context_length]
+        return list(map(chr, code_points))
+
+    def _join_tokens(self, tokens: typing.List[str]) -> str:
+        """Assemble the list of TOKENS making up a sentence into a string, putting spaces
+        between words but not before (or after) the punctuation that shouldn't have
+        them. Character tokens are simply run together.
+        """
+        if self.chains.character_tokens:            # Don't add spaces between tokens that are just single characters.
+            return ''.join(tokens)
+        spaced_after_punct = self.chains.markov_length < 2     # Historical quirk: with chains this short, punctuation never
+        ret = [tokens[0]]                                       # suppresses the space after itself.
+        for prev, curr in zip(tokens, tokens[1:]):
+            if curr not in punct_with_no_space_before:
+                if spaced_after_punct or prev not in punct_with_no_space_after:
+                    ret.append(" ")                 # Add spaces between words (but not punctuation)
+            ret.append(curr)
+        return ''.join(ret)
+
+    def _acceptable_sentence(self, sent: str) -> bool:
+        """Returns False if SENT is a one-character sentence (other than "I") and this
+        generator doesn't allow those; True otherwise.
+        """
         if not self.allow_single_character_sentences:
             if len(sent.strip().strip(sentence_ending_punct).strip()) == 1:
                 if sent.strip().strip(sentence_ending_punct).strip().upper() != "I":
-                    sent = self._gen_sentence()    # Retry, recursively.
-        return th.capitalize(sent)
+                    return False
+        return True
+
+    @staticmethod
+    def _random_numbers(seed: typing.Optional[int]=None,
+                        block_size: int=4096) -> typing.Iterator[float]:
+        """Yield an endless stream of random numbers in the range [0, 1), drawn BLOCK_SIZE
+        at a time: with NumPy, if it's installed, and otherwise with a private
+        random.Random instance. The same SEED always produces the same stream on a
+        given installation (but NumPy and the standard library produce different
+        streams from the same seed). If SEED is None, the stream is unpredictable.
+        """
+        try:
+            import numpy
+        except ImportError:
+            rng = random.Random(seed)
+            while True:
+                yield from [rng.random() for _ in range(block_size)]
+        else:
+            rng = numpy.random.default_rng(seed)
+            while True:
+                yield from rng.random(block_size).tolist()
+
+    def gen_sentences(self, n: int,
+                      seed: typing.Optional[int]=None,
+                      batch_size: int=64) -> typing.Iterator[str]:
+        """Generate N sentences, yielding each as soon as it is finished. This is meant
+        for producing many sentences at once: up to BATCH_SIZE sentences are built
+        side by side, a token at a time, from random numbers drawn in large blocks, and
+        without the per-token overhead of calling next(). Because several sentences are
+        under construction at once, they are yielded in the order in which they're
+        finished, not the order in which they were begun.
+
+        If SEED is not None, the sentences are reproducible: the same SEED produces the
+        same sentences in the same order (see _random_numbers() for caveats). The
+        global random number generator is neither used nor disturbed.
+
+        The sentences produced are the same sorts of sentences that _gen_sentence()
+        produces, but subclasses that override next() to change how tokens are picked
+        should not use this method.
+        """
+        assert self.is_trained(), "ERROR: the model %s needs to be trained before it can generate text!" % self
+        import text_handling as th
+
+        draw = self._random_numbers(seed).__next__
+        sample_longest, choose_start, markov_length = self.chains.sample_longest, self.chains.choose_start, self.chains.markov_length
+        comparison_form = None if (self.comparison_form is TextGenerator.comparison_form) else self.comparison_form
+        stats = self.stats
+
+        def new_walk() -> typing.Tuple[typing.List[str], tuple]:
+            """Begin a new sentence: returns (tokens so far, comparison forms of the history)."""
+            start = choose_start(draw())
+            return [start], (comparison_form(start) if comparison_form else start,)
+
+        def finished(tokens: typing.List[str]) -> typing.Optional[str]:
+            """Return the completed sentence made from TOKENS, or None if it's unacceptable."""
+            sent = self._join_tokens(tokens)
+            acceptable = self._acceptable_sentence(sent)
+            if stats is not None:
+                with stats.lock:
+                    stats.samples += len(tokens) - 1
+                    if acceptable:
+                        stats.sentences += 1
+                        stats.tokens += len(tokens)
+                    else:
+                        stats.retries += 1
+            return th.capitalize(sent) if acceptable else None
+
+        started = time.perf_counter() if (stats is not None) else None
+        begun = min(n, batch_size)
+        walks = [new_walk() for _ in range(begun)]
+        while walks:
+            still_walking = list()
+            for tokens, history in walks:
+                token = tokens[-1]
+                if token not in sentence_ending_punct:
+                    token, length = sample_longest(history, draw())
+                    if token is None:
+                        token = "."
+                        if stats is not None:
+                            with stats.lock:
+                                stats.dead_ends += 1
+                    elif (length < len(history)) and (stats is not None):
+                        with stats.lock:
+                            stats.backoffs[len(history) - length] += 1
+                    tokens.append(token)
+                    history = (history + ((comparison_form(token) if comparison_form else token),))[-markov_length:]
+                    if token not in sentence_ending_punct:
+                        still_walking.append((tokens, history))
+                        continue
+                sent = finished(tokens)
+                if sent is None:                        # Unacceptable sentence? Start again.
+                    still_walking.append(new_walk())
+                    continue
+                if stats is not None:                   # Don't count the time spent by whoever's consuming the sentences.
+                    with stats.lock:
+                        stats.seconds['sampling'] += time.perf_counter() - started
+                    yield sent
+                    started = time.perf_counter()
+                else:
+                    yield sent
+                if begun < n:
+                    still_walking.append(new_walk())
+                    begun += 1
+            walks = still_walking
 
     def _produce_text(self, sentences_desired: int=1,
-                      paragraph_break_probability: float=0.25) -> str:
+                      paragraph_break_probability: float=0.25,
+                      use_pool: bool=True,
+                      rng: typing.Optional[random.Random]=None) -> str:
         """Actually generate some text. This is a generator function that produces (yields)
         one paragraph at a time. If you just need all the text at once, you might want
-        to use the convenience wrapper gen_text() instead.
+        to use the convenience wrapper gen_text() instead. Sentences are taken from the
+        pool (see enable_pool()), if there is one, unless USE_POOL is False.
+
+        If RNG is not None, it's used for all of the random choices (see
+        _gen_sentence()), and the pool isn't used, so a random.Random instance seeded
+        the same way always produces the same text.
+        """
+        for step in self._text_steps(sentences_desired, paragraph_break_probability, use_pool, rng):
+            if step is not None:
+                yield step
+
+    def _text_steps(self, sentences_desired: int,
+                    paragraph_break_probability: float,
+                    use_pool: bool,
+                    rng: typing.Optional[random.Random]) -> typing.Iterator[typing.Optional[str]]:
+        """Do the work of _produce_text() (whose parameters these are) one sentence at a
+        time: yields each paragraph when it's finished, and None after each sentence that
+        doesn't finish a paragraph, so that _aproduce_text() can let other tasks run
+        between sentences.
         """
-        log_it("_produce_text() called.", 4)
-        log_it("  Markov length is %d; requesting %d sentences." % (self.chains.markov_length, sentences_desired), 4)
-        log_it("  Legitimate starts: %s" % self.chains.starts, 5)
-        log_it("  Probability data: %s" % self.chains.mapping, 5)
+        pool = self.pool if (use_pool and (rng is None)) else None
+        draw_from = random if (rng is None) else rng
+        if log_enabled(4):
+            log_it("_produce_text() called.", 4)
+            log_it("  Markov length is %d; requesting %d sentences.", 4, self.chains.markov_length, sentences_desired)
+            log_it("  Legitimate starts: %s", 5, self.chains.starts)
+            log_it("  Probability data: %s", 5, self.chains.mapping)
         the_text = ""
         for which_sentence in range(0, sentences_desired):
             try:
@@ -545,27 +2198,178 @@ class TextGenerator(object):
                     the_text = the_text + " "   #   ... add a space after the sentence-ending punctuation.
             except IndexError:                  # If this is the very beginning of our generated text ...
                 pass                            #   ... well, we don't need to add a space to the beginning of the text, then.
-            the_text = the_text + self._gen_sentence()
-            if random.random() <= paragraph_break_probability or which_sentence == sentences_desired - 1:
-                the_text = th.multi_replace(the_text, self.final_substitutions)
+            if self.stats is None:
+                the_text = the_text + (pool.get() if (pool is not None) else self._gen_sentence(rng))
+            else:
+                started = time.perf_counter()
+                the_text = the_text + (pool.get() if (pool is not None) else self._gen_sentence(rng))
+                with self.stats.lock:
+                    self.stats.seconds['sampling'] += time.perf_counter() - started
+            if draw_from.random() <= paragraph_break_probability or which_sentence == sentences_desired - 1:
+                if pool is not None:
+                    pass                                # Pooled sentences have already had the substitutions made.
+                elif self.stats is None:
+                    the_text = self._substitution_engine().apply(the_text)
+                else:
+                    started = time.perf_counter()
+                    the_text = self._substitution_engine().apply(the_text)
+                    with self.stats.lock:
+                        self.stats.seconds['substitutions'] += time.perf_counter() - started
                 try:
                     yield the_text.strip() + "\n"
                 except RuntimeError:                    # Conforms to Python 3.7 changes in behavior. Sigh.
                     return
                 the_text = ""
+            else:
+                yield None
+
+    @staticmethod
+    def _paragraph_plan(sentences_desired: int,
+                        paragraph_break_probability: float,
+                        seed: typing.Optional[int]) -> typing.List[typing.Tuple[int, int]]:
+        """Decide how SENTENCES_DESIRED sentences are divided into paragraphs, breaking
+        paragraphs with the same probability that _produce_text() does, and pick a seed
+        for each paragraph. Returns a list of (number of sentences, seed) pairs, one per
+        paragraph, all worked out from SEED; if SEED is None, they're unpredictable.
+        """
+        rng = random.Random(seed)
+        sizes, size = list(), 0
+        for which_sentence in range(sentences_desired):
+            size += 1
+            if rng.random() <= paragraph_break_probability or which_sentence == sentences_desired - 1:
+                sizes.append(size)
+                size = 0
+        return [(size, rng.getrandbits(64)) for size in sizes]
+
+    def _gen_paragraph(self, sentences: int,
+                       rng: random.Random) -> str:
+        """Generate a paragraph of SENTENCES sentences with RNG, and make the final
+        substitutions on it. Returns it just as _produce_text() would yield it.
+        """
+        *_, paragraph = self._paragraph_steps(sentences, rng)
+        return paragraph
+
+    def _paragraph_steps(self, sentences: int,
+                         rng: random.Random) -> typing.Iterator[typing.Optional[str]]:
+        """Do the work of _gen_paragraph() (whose parameters these are) one sentence at a
+        time, just as _text_steps() does: yields None after each sentence but the last,
+        and then the paragraph.
+        """
+        the_text = list()
+        for which_sentence in range(sentences):
+            if which_sentence:
+                yield None
+            if self.stats is None:
+                the_text.append(self._gen_sentence(rng))
+            else:
+                started = time.perf_counter()
+                the_text.append(self._gen_sentence(rng))
+                with self.stats.lock:
+                    self.stats.seconds['sampling'] += time.perf_counter() - started
+        if self.stats is None:
+            yield self._substitution_engine().apply(' '.join(the_text)).strip() + "\n"
+        else:
+            started = time.perf_counter()
+            the_text = self._substitution_engine().apply(' '.join(the_text))
+            with self.stats.lock:
+                self.stats.seconds['substitutions'] += time.perf_counter() - started
+            yield the_text.strip() + "\n"
+
+    def _gen_in_parallel(self, plan: typing.List[typing.Tuple[int, int]],
+                         workers: int) -> typing.List[str]:
+        """Generate the paragraphs described by PLAN (see _paragraph_plan()) with a pool of
+        WORKERS processes, and return them in order. Each paragraph is generated from
+        its own seed, so the text is the same however many workers there are, and
+        however the paragraphs are divided up among them.
+
+        On systems that can fork(), when no other threads are running in this process,
+        the workers simply inherit this generator, sharing its memory with this process
+        until either one changes it. Otherwise (forking a process with other threads
+        running, such as the pool's, can deadlock the child) the workers are started
+        fresh: the chains are saved to a temporary binary file, which each worker
+        memory-maps, and the generator's other public attributes are copied to each
+        worker.
+
+        The workers' statistics (see enable_stats()) aren't collected.
+        """
+        import concurrent.futures, multiprocessing, tempfile
+
+        batches, per_batch, in_batch = list(), max(1, sum(n for n, seed in plan) // (4 * workers)), 0
+        for size, seed in plan:                 # Divide the paragraphs into batches of about PER_BATCH sentences.
+            if (not batches) or (in_batch >= per_batch):
+                batches.append(list())
+                in_batch = 0
+            batches[-1].append((size, seed))
+            in_batch += size
+        if ('fork' in multiprocessing.get_all_start_methods()) and (threading.active_count() == 1):
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                                                        initializer=_inherit_generation_worker, initargs=(self,)) as executor:
+                results = list(executor.map(_gen_paragraphs, batches))
+        else:
+            attributes = {k: v for k, v in vars(self).items() if (not k.startswith('_')) and (k not in ('chains', 'pool', 'stats'))}
+            with tempfile.TemporaryDirectory() as temp_dir:
+                chains_file = os.path.join(temp_dir, 'chains.chains')
+                self.chains.store_chains(chains_file, file_format='binary', compression='none')
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                                            initializer=_init_generation_worker,
+                                                            initargs=(type(self), chains_file, attributes)) as executor:
+                    results = list(executor.map(_gen_paragraphs, batches))
+        return [p for batch in results for p in batch]
+
+    def _produce_seeded_text(self, sentences_desired: int=1,
+                             paragraph_break_probability: float=0.25,
+                             seed: typing.Optional[int]=None,
+                             workers: int=1) -> typing.Iterator[str]:
+        """Yield paragraphs of text, just as _produce_text() does, but generate each
+        paragraph from its own seed, all of them worked out from SEED (see
+        _paragraph_plan()). The same SEED always produces the same text, whether it's
+        generated in this process (if WORKERS is 1) or by a pool of WORKERS processes
+        (see _gen_in_parallel()). The pool (see enable_pool()) and the global random
+        number generator aren't used.
+        """
+        assert self.is_trained(), "ERROR: the model %s needs to be trained before it can generate text!" % self
+        assert workers >= 1, "ERROR: WORKERS must be at least 1!"
+        plan = self._paragraph_plan(sentences_desired, paragraph_break_probability, seed)
+        if workers == 1:
+            for size, paragraph_seed in plan:
+                yield self._gen_paragraph(size, random.Random(paragraph_seed))
+        else:
+            yield from self._gen_in_parallel(plan, workers)
+
+    def _paragraphs(self, sentences_desired: int,
+                    paragraph_break_probability: float,
+                    seed: typing.Optional[int],
+                    workers: int) -> typing.Iterator[str]:
+        """Yield paragraphs from _produce_seeded_text(), if SEED or WORKERS asks for it, or
+        else from _produce_text().
+        """
+        if (seed is None) and (workers == 1):
+            return self._produce_text(sentences_desired, paragraph_break_probability)
+        return self._produce_seeded_text(sentences_desired, paragraph_break_probability, seed=seed, workers=workers)
 
     def gen_text(self, sentences_desired: int=1,
-                 paragraph_break_probability: float=0.25) -> str:
+                 paragraph_break_probability: float=0.25,
+                 seed: typing.Optional[int]=None,
+                 workers: int=1) -> str:
         """Generate the full amount of text required. This is just a convenience wrapper
         for _produce_text().
+
+        If SEED is given, the text is reproducible: the same SEED always produces the
+        same text from the same chains. If WORKERS is more than 1, the paragraphs are
+        generated by that many processes at once, and the text is still exactly what the
+        same SEED would produce in a single process. See _produce_seeded_text().
         """
-        return '\n'.join(self._produce_text(sentences_desired, paragraph_break_probability))
+        return '\n'.join(self._paragraphs(sentences_desired, paragraph_break_probability, seed, workers))
 
     def gen_html_frag(self, sentences_desired: int=1,
-                      paragraph_break_probability: float=0.25):
-        """Produce the same text that _produce_text would, but wrapped in HTML <p></p> tags."""
+                      paragraph_break_probability: float=0.25,
+                      seed: typing.Optional[int]=None,
+                      workers: int=1):
+        """Produce the same text that _produce_text would, but wrapped in HTML <p></p> tags.
+        SEED and WORKERS are as for gen_text().
+        """
         log_it("We're generating an HTML fragment.", 3)
-        the_text = self._produce_text(sentences_desired, paragraph_break_probability)
+        the_text = self._paragraphs(sentences_desired, paragraph_break_probability, seed, workers)
         return '\n\n'.join(['<p>%s</p>' % p.strip() for p in the_text])
 
     def _printer(self, what: str,
@@ -574,6 +2378,8 @@ class TextGenerator(object):
         COLUMNS. If COLUMNS is -1, take a whack at guessing what it should be. If
         COLUMNS is zero, do no wrapping at all.
         """
+        import text_handling as th
+
         if columns == 0:  # Wrapping is totally disabled. Print exactly as generated.
             log_it("INFO: COLUMNS is zero; not wrapping text at all", 3)
             print(what)
@@ -583,8 +2389,9 @@ class TextGenerator(object):
                 padding = 0
             else:  # Wrap to specified width (unless current terminal width is odd, in which case we're off by 1/2. Oh well.)
                 padding = max((th.terminal_width() - columns) // 2, 0)
-                log_it("INFO: COLUMNS is %s; padding text with %s spaces on each side" % (columns, padding), 3)
-                log_it("NOTE: terminal width is %s" % th.terminal_width(), 3)
+                log_it("INFO: COLUMNS is %s; padding text with %s spaces on each side", 3, columns, padding)
+                if log_enabled(3):
+                    log_it("NOTE: terminal width is %s", 3, th.terminal_width())
             what = th.multi_replace(what, [['\n\n', '\n'], ])       # Last chance to postprocess text is right here
             for the_paragraph in what.split('\n'):
                 if the_paragraph:                   # Skip any empty paragraphs that may pop up
@@ -594,13 +2401,106 @@ class TextGenerator(object):
     def print_text(self, sentences_desired: int,
                    paragraph_break_probability: float=0.25,
                    pause: float=0,
-                   columns: int=-1):
-        """Prints generated text directly to stdout."""
-        for t in self._produce_text(sentences_desired, paragraph_break_probability):
+                   columns: int=-1,
+                   seed: typing.Optional[int]=None):
+        """Prints generated text directly to stdout. SEED is as for gen_text()."""
+        for t in self._paragraphs(sentences_desired, paragraph_break_probability, seed, 1):
             time_now = time.time()
             self._printer(t, columns=columns)
+            if self.stats is not None:
+                with self.stats.lock:
+                    self.stats.seconds['printing'] += time.time() - time_now
             time.sleep(max(pause - (time.time() - time_now), 0))    # Pause until it's time for a new paragraph.
 
+    # Asynchronous counterparts of the methods above, for programs that run an asyncio event loop. They produce the
+    # same text as the methods above, but let other tasks run every .async_time_slice seconds while they're generating
+    # it, so that one long request doesn't hold up everything else. asyncio is imported only when they're used.
+    async_time_slice = 0.005        # Seconds.
+
+    async def _run_steps(self, steps: typing.Iterator[typing.Optional[str]]) -> typing.AsyncIterator[str]:
+        """Run through STEPS (as produced by _text_steps() or _paragraph_steps()),
+        yielding each paragraph that comes out of it, and letting other tasks run
+        whenever .async_time_slice seconds have passed since they last could.
+        """
+        import asyncio
+
+        deadline = time.monotonic() + self.async_time_slice
+        for step in steps:
+            if step is not None:
+                yield step
+            if time.monotonic() >= deadline:
+                await asyncio.sleep(0)
+                deadline = time.monotonic() + self.async_time_slice
+
+    async def _aproduce_text(self, sentences_desired: int=1,
+                             paragraph_break_probability: float=0.25,
+                             use_pool: bool=True,
+                             rng: typing.Optional[random.Random]=None) -> typing.AsyncIterator[str]:
+        """An asynchronous generator that yields the same paragraphs _produce_text() would,
+        letting other tasks run between sentences from time to time.
+        """
+        async for paragraph in self._run_steps(self._text_steps(sentences_desired, paragraph_break_probability, use_pool, rng)):
+            yield paragraph
+
+    async def _aparagraphs(self, sentences_desired: int,
+                           paragraph_break_probability: float,
+                           seed: typing.Optional[int],
+                           workers: int) -> typing.AsyncIterator[str]:
+        """An asynchronous generator that yields the same paragraphs _paragraphs() would.
+        With more than one worker, the event loop's default executor waits for the
+        worker processes, so that the event loop doesn't have to.
+        """
+        if (seed is None) and (workers == 1):
+            steps = self._text_steps(sentences_desired, paragraph_break_probability, True, None)
+        else:
+            assert self.is_trained(), "ERROR: the model %s needs to be trained before it can generate text!" % self
+            assert workers >= 1, "ERROR: WORKERS must be at least 1!"
+            plan = self._paragraph_plan(sentences_desired, paragraph_break_probability, seed)
+            if workers > 1:
+                import asyncio
+
+                for paragraph in await asyncio.get_running_loop().run_in_executor(None, self._gen_in_parallel, plan, workers):
+                    yield paragraph
+                return
+            steps = (step for size, paragraph_seed in plan for step in self._paragraph_steps(size, random.Random(paragraph_seed)))
+        async for paragraph in self._run_steps(steps):
+            yield paragraph
+
+    async def agen_text(self, sentences_desired: int=1,
+                        paragraph_break_probability: float=0.25,
+                        seed: typing.Optional[int]=None,
+                        workers: int=1) -> str:
+        """Asynchronous counterpart of gen_text()."""
+        return '\n'.join([p async for p in self._aparagraphs(sentences_desired, paragraph_break_probability, seed, workers)])
+
+    async def agen_html_frag(self, sentences_desired: int=1,
+                             paragraph_break_probability: float=0.25,
+                             seed: typing.Optional[int]=None,
+                             workers: int=1) -> str:
+        """Asynchronous counterpart of gen_html_frag()."""
+        log_it("We're generating an HTML fragment.", 3)
+        the_text = [p async for p in self._aparagraphs(sentences_desired, paragraph_break_probability, seed, workers)]
+        return '\n\n'.join(['<p>%s</p>' % p.strip() for p in the_text])
+
+    async def aprint_text(self, sentences_desired: int,
+                          paragraph_break_probability: float=0.25,
+                          pause: float=0,
+                          columns: int=-1,
+                          seed: typing.Optional[int]=None):
+        """Asynchronous counterpart of print_text(), which waits between paragraphs with
+        asyncio.sleep() rather than time.sleep(), so that other tasks can run during
+        the PAUSE.
+        """
+        import asyncio
+
+        async for t in self._aparagraphs(sentences_desired, paragraph_break_probability, seed, 1):
+            time_now = time.time()
+            self._printer(t, columns=columns)
+            if self.stats is not None:
+                with self.stats.lock:
+                    self.stats.seconds['printing'] += time.time() - time_now
+            await asyncio.sleep(max(pause - (time.time() - time_now), 0))    # Pause until it's time for a new paragraph.
+
 
 if __name__ == "__main__":
     gen = TextGenerator()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A cache, on disk, of the tokens that training texts are split into, so that
+retraining a model on the same texts (with a different Markov length, say, or a
+different TextGenerator.comparison_form()) doesn't have to tokenize them all over
+again. Pass a TokenCache (or the name of the directory to keep it in) to
+TextGenerator.train() or _train_from_text():
+
+    cache = token_cache.TokenCache('/var/cache/markov-tokens')
+    for length in range(1, 6):
+        genny = text_generator.TextGenerator()
+        genny.train(['/path/to/a/big/text.txt'], markov_length=length, token_cache=cache)
+
+Each text's tokens are stored in a file of their own in the cache's directory,
+named for a hash of the text and of the tokenizer's settings, so that changing
+either one simply means the cached tokens aren't found. What's stored is the
+tokens as the tokenizer produces them, before they're converted to their
+comparison forms, so generators with different comparison forms can share the
+same cache.
+
+Cache files use a simple binary format: a header, a vocabulary of the distinct
+tokens, and the text as an array of (32-bit) token IDs. All numbers are
+little-endian. The header is
+
+  magic (8 bytes), format version (uint16), reserved (uint16), vocabulary size, number of tokens (both uint64);
+
+... and is followed by these sections, each padded to a multiple of eight bytes:
+
+  vocabulary offsets: uint64[vocabulary size + 1], offsets into ...
+  vocabulary: the UTF-8 encoding of each token, end to end, in order of first appearance;
+  tokens:     uint32[number of tokens], the token IDs, in order.
+
+This module is licensed under the GNU GPL, either version 3, or (at your option)
+any later version. See the files README.md and LICENSE.md for more details.
+"""
+
+
+import hashlib
+import os
+import struct
+import sys
+import tempfile
+import typing
+
+from array import array
+from pathlib import Path
+
+import chain_storage
+
+
+TOKENS_FILE_MAGIC = b'MRKVTOK\x00'
+TOKENS_FILE_VERSION = 1
+_header = struct.Struct('<8sHHQQ')
+_HASH_SLICE = 1024 * 1024              # Characters of text encoded at a time while hashing it; see TokenCache.key().
+
+
+def _padding(length: int) -> bytes:
+    return b'\x00' * (-length % 8)
+
+
+def _encode(token: str) -> bytes:
+    return token.encode('utf-8', 'surrogatepass')       # Texts read with odd encodings can contain lone surrogates.
+
+
+def token_ids(tokens: typing.Iterable[str]) -> typing.Tuple[typing.List[str], array]:
+    """Return (vocabulary, token IDs) for TOKENS: the distinct tokens, in order of their
+    first appearance, and an array of their positions in that list.
+    """
+    ids_of = dict()
+    ids = array('I', (ids_of.setdefault(t, len(ids_of)) for t in tokens))
+    return list(ids_of), ids
+
+
+def write_tokens_file(the_file: typing.BinaryIO,
+                      vocabulary: typing.List[str],
+                      ids: array) -> None:
+    """Write the tokens [VOCABULARY[i] for i in IDS] to THE_FILE, an open binary file, in
+    the format described above.
+    """
+    vocabulary = [_encode(t) for t in vocabulary]
+    offsets = array('Q', [0])
+    for t in vocabulary:
+        offsets.append(offsets[-1] + len(t))
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+        ids = array('I', ids)
+        ids.byteswap()
+    the_file.write(_header.pack(TOKENS_FILE_MAGIC, TOKENS_FILE_VERSION, 0, len(vocabulary), len(ids)))
+    for section in (offsets.tobytes(), b''.join(vocabulary), ids.tobytes()):
+        the_file.write(section)
+        the_file.write(_padding(len(section)))
+
+
+def read_tokens_file(filename: typing.Union[str, Path]) -> typing.Tuple[typing.List[str], array]:
+    """Read a file written by write_tokens_file(). Returns (vocabulary, token IDs): the
+    tokens themselves are [vocabulary[i] for i in token IDs]. Raises ValueError if
+    the file isn't a tokens file, or is damaged.
+    """
+    with open(filename, 'rb') as the_file:
+        data = the_file.read()
+    if len(data) < _header.size:
+        raise ValueError("%s is too short to be a tokens file" % filename)
+    magic, version, _, vocab_size, num_tokens = _header.unpack_from(data)
+    if (magic != TOKENS_FILE_MAGIC) or (version != TOKENS_FILE_VERSION):
+        raise ValueError("%s is not a tokens file that this version understands" % filename)
+    pos = _header.size
+    offsets = array('Q')
+    offsets.frombytes(data[pos:pos + 8 * (vocab_size + 1)])
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    pos += 8 * (vocab_size + 1)
+    blob = data[pos:pos + offsets[-1]]
+    vocabulary = [blob[a:b].decode('utf-8', 'surrogatepass') for a, b in zip(offsets, offsets[1:])]
+    pos += offsets[-1] + len(_padding(offsets[-1]))
+    ids = array('I')
+    ids.frombytes(data[pos:pos + 4 * num_tokens])
+    if len(ids) != num_tokens:
+        raise ValueError("%s has been truncated" % filename)
+    if sys.byteorder != 'little':
+        ids.byteswap()
+    return vocabulary, ids
+
+
+class TokenCache(object):
+    """A directory full of tokenized texts. See the module docstring."""
+    def __init__(self, directory: typing.Union[str, Path]):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.hits, self.misses = 0, 0
+
+    def key(self, text: str,
+            settings: str) -> str:
+        """Return the key under which the tokens of TEXT, split up by a tokenizer described
+        by SETTINGS, are stored. TEXT is encoded and hashed a slice at a time, so that
+        hashing a large corpus doesn't need a second, encoded copy of all of it.
+        """
+        h = hashlib.sha256(_encode(settings))
+        h.update(b'\x00')
+        for start in range(0, len(text), _HASH_SLICE):
+            h.update(_encode(text[start:start + _HASH_SLICE]))
+        return h.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / (key + '.tokens')
+
+    def load(self, key: str) -> typing.Optional[typing.Tuple[typing.List[str], array]]:
+        """Return (vocabulary, token IDs) for the tokens stored under KEY, or None if there
+        aren't any (or they can't be read).
+        """
+        try:
+            return read_tokens_file(self._path(key))
+        except (IOError, ValueError):
+            return None
+
+    def store(self, key: str,
+              vocabulary: typing.List[str],
+              ids: array) -> None:
+        """Store the tokens [VOCABULARY[i] for i in IDS] under KEY. Failing to write them
+        isn't an error: they'll just have to be worked out again next time.
+        """
+        temp_name = None
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.partial', delete=False) as the_file:
+                temp_name = the_file.name
+                write_tokens_file(the_file, vocabulary, ids)
+            chain_storage.replace_file(temp_name, self._path(key))
+        except IOError:
+            if temp_name and os.path.exists(temp_name):
+                os.remove(temp_name)
+
+    def tokens(self, text: str,
+               settings: str,
+               tokenize: typing.Callable[[str], typing.List[str]]) -> typing.Tuple[typing.List[str], array]:
+        """Return (vocabulary, token IDs) for the tokens that TOKENIZE, a tokenizer described
+        by SETTINGS, splits TEXT into: from the cache, if they're there, or else by
+        calling TOKENIZE and storing what it produces.
+        """
+        key = self.key(text, settings)
+        ret = self.load(key)
+        if ret is not None:
+            self.hits += 1
+            return ret
+        self.misses += 1
+        ret = token_ids(tokenize(text))
+        self.store(key, *ret)
+        return ret
+
+    def clear(self) -> None:
+        """Delete everything in the cache."""
+        for f in self.directory.glob('*.tokens'):
+            f.unlink()